@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""benchmark-formatting.py - Itabashi formatting translation micro-benchmarks.
+
+Times translating messages between IRC formatting codes and Discord
+markdown, for messages of increasing length, along with the way messages
+were formatted before the translator existed for comparison.
+
+Usage:
+    benchmark-formatting.py [--number=<n>] [--lengths=<lengths>]
+    benchmark-formatting.py (-h | --help)
+
+Options:
+    --number=<n>            Times to translate each message [default: 20000].
+    --lengths=<lengths>     Comma-separated message lengths, in words [default: 5,20,80,320].
+    (-h | --help)           Show this message.
+"""
+import itertools
+import re
+import timeit
+
+from docopt import docopt
+from girc.formatting import escape, remove_formatting_codes, unescape
+
+from italib.formatting import (BOLD, ITALIC, UNDERLINE, RESET, discord_to_irc, irc_prefix, irc_to_discord,
+                               strip_irc_formatting)
+
+_irc_words = ['plain', BOLD + 'bold' + BOLD, ITALIC + 'italic' + ITALIC, '\x0304red\x03',
+              UNDERLINE + 'under' + UNDERLINE, 'snake_case', 'https://example.com/a_b', BOLD + 'x' + RESET]
+_discord_words = ['plain', '**bold**', '*italic*', '__under__', '~~gone~~', '<@123>', '<#456>',
+                  '<:emoji:789>', '`co*de`', 'snake_case', 'https://example.com/a_b']
+
+_plain_words = ['just', 'some', 'ordinary', 'words', 'in', 'a', 'message', 'without', 'formatting']
+
+_names = {('@', '123'): 'someone', ('#', '456'): 'general'}
+
+
+def message(words, length):
+    return ' '.join(itertools.islice(itertools.cycle(words), length))
+
+
+def old_irc_to_discord(text):
+    # what the IRC -> Discord path used to do
+    return '**<{}>** '.format('nick') + remove_formatting_codes(text)
+
+
+def old_discord_to_irc(text):
+    # what the Discord -> IRC path used to do, including clean_content's
+    #   per-message regex for mentions
+    transformations = {re.escape('<@{}>'.format(key[1])): '@' + name
+                       for key, name in _names.items() if key[0] == '@'}
+    transformations.update({re.escape('<#{}>'.format(key[1])): '#' + name
+                            for key, name in _names.items() if key[0] == '#'})
+    pattern = re.compile('|'.join(transformations))
+    text = pattern.sub(lambda match: transformations.get(re.escape(match.group(0)), ''), text)
+    return unescape('$c[grey]<$r$b{}$b$c[grey]#{}>$r '.format(escape('name'), escape('1234'))) + text
+
+
+def new_irc_to_discord(text):
+    return '**<{}>** '.format('nick') + irc_to_discord(text)
+
+
+def new_discord_to_irc(text):
+    formatted = discord_to_irc(text, _names)
+    strip_irc_formatting(formatted)
+    return irc_prefix('name', '1234') + formatted
+
+
+def run(number, lengths):
+    cases = [
+        ('irc -> discord', 'plain', _plain_words, old_irc_to_discord, new_irc_to_discord),
+        ('irc -> discord', 'formatted', _irc_words, old_irc_to_discord, new_irc_to_discord),
+        ('discord -> irc', 'plain', _plain_words, old_discord_to_irc, new_discord_to_irc),
+        ('discord -> irc', 'formatted', _discord_words, old_discord_to_irc, new_discord_to_irc),
+    ]
+    print('{:<16}{:<11}{:>7}{:>12}{:>12}{:>14}'.format('direction', 'text', 'words', 'old us', 'new us',
+                                                       'new us/word'))
+    for name, kind, words, old, new in cases:
+        for length in lengths:
+            text = message(words, length)
+            old_time = timeit.timeit(lambda: old(text), number=number) / number * 1e6
+            new_time = timeit.timeit(lambda: new(text), number=number) / number * 1e6
+            print('{:<16}{:<11}{:>7}{:>12.2f}{:>12.2f}{:>14.3f}'.format(name, kind, length, old_time, new_time,
+                                                                       new_time / length))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    run(int(arguments['--number']), [int(length) for length in arguments['--lengths'].split(',')])
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""benchmark.py - Itabashi end-to-end relay benchmark.
+
+Runs the real IRC and Discord modules against a fake IRC server and a fake
+Discord API/gateway on localhost, drives traffic across the links and
+reports throughput, relay latency and memory use.
+
+Usage:
+    benchmark.py [--links=<n>] [--rate=<r>] [--duration=<s>] [--size=<bytes>]
+                 [--direction=<dir>] [--drain=<s>] [--unthrottled] [--irc-connections=<n>]
+                 [--rate-limit-every=<n>] [--webhooks] [--flap=<s>] [--guilds=<n>] [--slow-handler=<s>]
+                 [--admission=<policy>] [--shards=<n>] [--noise=<r>]
+                 [--profile] [--profile-dir=<dir>] [--tracemalloc] [--metrics] [--log=<log>]
+    benchmark.py (-h | --help)
+
+Options:
+    --links=<n>             Number of links to create [default: 10].
+    --rate=<r>              Messages per second to send, across all links [default: 50].
+    --duration=<s>          Seconds to send messages for [default: 10].
+    --size=<bytes>          Length of each message [default: 100].
+    --direction=<dir>       irc, discord or both, the side messages start from [default: both].
+    --drain=<s>             Most seconds to wait for messages to arrive afterwards [default: 30].
+    --unthrottled           Lift our IRC flood and Discord rate limits, to measure raw overhead.
+    --irc-connections=<n>   IRC connections to spread the channels across [default: 1].
+    --rate-limit-every=<n>  Have the fake Discord API send a 429 every n messages [default: 0].
+    --webhooks              Relay IRC messages to Discord through a webhook for each channel.
+    --flap=<s>              Drop every IRC and Discord connection each s seconds while sending [default: 0].
+    --guilds=<n>            Other guilds for the fake Discord to serve, of 50 unlinked channels each [default: 0].
+    --slow-handler=<s>      Add an event handler that takes s seconds over each message, which shouldn't slow
+                            relaying down [default: 0].
+    --admission=<policy>    Let each author send 10 messages per 10 seconds in each channel, and throttle,
+                            summarize or drop the rest, or off [default: off].
+    --shards=<n>            Gateway shards to connect with [default: 1].
+    --noise=<r>             Messages per second to send in the unlinked channels of the --guilds, which should be
+                            dropped as they arrive [default: 0].
+    --profile               Time every handler and event loop callback, and report the busiest handlers.
+    --profile-dir=<dir>     With --profile, write a sampled profile of the run to this directory.
+    --tracemalloc           Trace Python memory allocations, and report the peak.
+    --metrics               Print Itabashi's own metrics at the end, in Prometheus format.
+    --log=<log>             Log warnings and errors to the specified filename [default: benchmark.log].
+    (-h | --help)           Show this message.
+"""
+import asyncio
+import contextlib
+import io
+import logging
+import math
+import re
+import resource
+import time
+import tracemalloc
+
+import discord.http
+from docopt import docopt
+
+import italib
+from italib.dedupe import FingerprintCache
+from italib.events import EventBus
+from italib.metrics import RelayMetrics
+from italib.profiling import Profiler
+from italib.routing import LinkRouter
+import itabashi
+from tests.fakediscord import FakeDiscord
+from tests.fakeirc import FakeIrcServer
+
+_sequence = re.compile(r'bench-(\d+)-')
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Benchmark:
+    def __init__(self, arguments):
+        self.links = int(arguments['--links'])
+        self.rate = float(arguments['--rate'])
+        self.duration = float(arguments['--duration'])
+        self.size = int(arguments['--size'])
+        self.direction = arguments['--direction']
+        self.drain = float(arguments['--drain'])
+        self.unthrottled = arguments['--unthrottled']
+        self.rate_limit_every = int(arguments['--rate-limit-every'])
+        self.irc_connections = int(arguments['--irc-connections'])
+        self.webhooks = arguments['--webhooks']
+        self.flap = float(arguments['--flap'])
+        self.guilds = int(arguments['--guilds'])
+        self.slow_handler = float(arguments['--slow-handler'])
+        self.admission = arguments['--admission']
+        self.shards = int(arguments['--shards'])
+        self.noise = float(arguments['--noise'])
+        self.profiler = None
+        if arguments['--profile']:
+            # one snapshot, taken while we're sending
+            self.profiler = Profiler(logging, report_interval=0, directory=arguments['--profile-dir'],
+                                     snapshot_interval=1e9, snapshot_duration=self.duration)
+        self.flaps = 0
+
+        if self.direction not in ('irc', 'discord', 'both'):
+            raise ValueError('Unknown direction: {}'.format(self.direction))
+        if self.noise and not self.guilds:
+            raise ValueError('--noise needs --guilds to send in')
+
+        self.channels = {str(300000000000000000 + i): 'bench{}'.format(i) for i in range(self.links)}
+        self.channel_ids = sorted(self.channels)
+
+        # sequence number -> time sent, and time each one arrived
+        self.sent = {}
+        self.latencies = {'irc': [], 'discord': []}
+        self.first_sent = None
+        self.last_arrived = None
+
+        self.irc_server = FakeIrcServer(on_message=self.irc_received)
+        self.discord_server = FakeDiscord(self.channels, rate_limit=self.rate_limit_every or None,
+                                          on_message=self.discord_received, extra_guilds=self.guilds)
+
+    def config(self):
+        irc_config = {
+            'nickname': 'ita',
+            'server': '127.0.0.1',
+            'port': self.irc_server.port,
+            'tls': False,
+        }
+        if self.irc_connections > 1:
+            irc_config.update(max_connections=self.irc_connections,
+                              channels_per_connection=math.ceil(self.links / self.irc_connections))
+        discord_config = {
+            'email': 'bench@example.com',
+            'password': 'bench',
+            'send_queue_size': 100000,
+            'shards': self.shards,
+            # the fake gateway doesn't limit how fast shards identify
+            'identify_interval': 0,
+        }
+        if self.webhooks:
+            discord_config['webhooks'] = {channel_id: self.discord_server.create_webhook(channel_id)
+                                          for channel_id in self.channel_ids}
+        if self.unthrottled:
+            irc_config.update(flood_rate=1000000, flood_burst=1000000, send_queue_size=1000000)
+            discord_config.update(send_limit=1000000, send_per=1.0,
+                                  global_send_limit=1000000, global_send_per=1.0,
+                                  webhook_send_limit=1000000, webhook_send_per=1.0,
+                                  webhook_global_send_limit=1000000, webhook_global_send_per=1.0,
+                                  outage_drain_rate=1000000, outage_drain_burst=1000000)
+
+        links = {}
+        for i, channel_id in enumerate(self.channel_ids):
+            links['bench-{}'.format(i)] = {
+                'name': 'Bench {}'.format(i),
+                'log': False,
+                'channels': {
+                    'discord': channel_id,
+                    'irc': '#' + self.channels[channel_id],
+                },
+            }
+
+        return {
+            'version': italib.CURRENT_CONFIG_VERSION,
+            'modules': {'irc': irc_config, 'discord': discord_config},
+            'links': links,
+            'admission': {'limit': 0} if self.admission == 'off' else {'policy': self.admission},
+        }
+
+    # arrivals
+    def arrived(self, origin, text):
+        now = time.monotonic()
+        for seq in _sequence.findall(text):
+            sent = self.sent.get(int(seq))
+            if sent is not None:
+                self.latencies[origin].append(now - sent)
+                self.last_arrived = now
+
+    def irc_received(self, client, target, text):
+        self.arrived('discord', text)
+
+    def discord_received(self, channel_id, content):
+        # coalesced messages carry several of ours
+        self.arrived('irc', content)
+
+    @property
+    def delivered(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    # running
+    @asyncio.coroutine
+    def setup(self):
+        yield from self.irc_server.start()
+        yield from self.discord_server.start()
+        discord.http.Route.BASE = self.discord_server.api_base
+
+        config = self.config()
+        events = EventBus(logging)
+        self.events = events
+        router = LinkRouter(config['links'])
+        dedupe = FingerprintCache(**config.get('dedupe', {}))
+        self.metrics = RelayMetrics()
+        self.metrics.instrument(events)
+        if self.profiler is not None:
+            self.profiler.instrument(events)
+            self.profiler.start()
+        self.metrics.start_loop_monitor(0.1)
+
+        if self.slow_handler:
+            def slow(event):
+                return asyncio.sleep(self.slow_handler)
+            for name in ('irc message', 'discord message'):
+                events.register(name, slow, timeout=self.slow_handler * 2)
+
+        ready = asyncio.Future()
+        events.register('discord ready', lambda event: ready.done() or ready.set_result(True))
+
+        self.irc = itabashi.IrcManager(logging, config, events, router=router, dedupe=dedupe,
+                                     metrics=self.metrics)
+        self.discord = itabashi.DiscordManager(logging, config, events, router=router, dedupe=dedupe,
+                                               metrics=self.metrics)
+
+        started = time.monotonic()
+        yield from asyncio.wait_for(asyncio.gather(
+            self.irc_server.wait_joined('#' + name for name in self.channels.values()),
+            ready,
+        ), 60)
+        return time.monotonic() - started
+
+    def send_one(self, seq, origin):
+        text = 'bench-{}- '.format(seq)
+        text += 'x' * max(self.size - len(text), 0)
+        channel_id = self.channel_ids[seq % self.links]
+        self.sent[seq] = time.monotonic()
+        if self.first_sent is None:
+            self.first_sent = self.sent[seq]
+
+        if origin == 'irc':
+            self.irc_server.privmsg('user{}'.format(seq % 10), '#' + self.channels[channel_id], text)
+        else:
+            self.discord_server.message_create(channel_id, 'user{}'.format(seq % 10), text)
+
+    def send_noise(self, seq):
+        channel_id = self.noise_channels[seq % len(self.noise_channels)]
+        self.discord_server.message_create(channel_id, 'noise{}'.format(seq % 10), 'noise {}'.format(seq))
+
+    @asyncio.coroutine
+    def drive(self):
+        origins = ['irc', 'discord'] if self.direction == 'both' else [self.direction]
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        seq = 0
+        noise = 0
+        self.noise_channels = sorted(channel_id for channels in self.discord_server.extra_guilds.values()
+                                     for channel_id in channels)
+        next_flap = start + self.flap if self.flap else None
+        if self.profiler is not None and self.profiler.directory is not None:
+            self.profiler.snapshot()
+
+        # send in small ticks, catching up on however many messages are due
+        while loop.time() - start < self.duration:
+            due = int((loop.time() - start) * self.rate)
+            while seq < due:
+                self.send_one(seq, origins[seq % len(origins)])
+                seq += 1
+            due = int((loop.time() - start) * self.noise)
+            while noise < due:
+                self.send_noise(noise)
+                noise += 1
+            if next_flap is not None and loop.time() >= next_flap:
+                next_flap += self.flap
+                self.flaps += 1
+                self.irc_server.disconnect()
+                yield from self.discord_server.disconnect()
+            yield from asyncio.sleep(0.005)
+
+        deadline = loop.time() + self.drain
+        while self.delivered < seq and loop.time() < deadline:
+            yield from asyncio.sleep(0.05)
+
+    @asyncio.coroutine
+    def teardown(self):
+        self.metrics.stop_loop_monitor()
+        if self.profiler is not None:
+            self.profiler.stop()
+        # logging out stops the Discord module from reconnecting
+        yield from self.discord.logout()
+        if self.discord.webhook_client is not None:
+            self.discord.webhook_client.close()
+        yield from self.discord_server.close()
+        self.irc_server.close()
+
+    def report(self, setup_time, tracing):
+        print('links: {}  rate: {}/s  duration: {}s  size: {}  direction: {}  unthrottled: {}'.format(
+            self.links, self.rate, self.duration, self.size, self.direction, bool(self.unthrottled)))
+        print('setup: {:.2f}s  irc join lines: {}  shards: {}'.format(setup_time, self.irc_server.join_lines,
+                                                                    self.shards))
+
+        elapsed = (self.last_arrived or time.monotonic()) - (self.first_sent or time.monotonic())
+        print('sent: {}  delivered: {}  lost: {}'.format(len(self.sent), self.delivered,
+                                                        len(self.sent) - self.delivered))
+        if elapsed > 0:
+            print('throughput: {:.1f} msg/s'.format(self.delivered / elapsed))
+
+        for origin, latencies in sorted(self.latencies.items()):
+            if not latencies:
+                continue
+            latencies.sort()
+            print('{} -> {}: p50 {:.2f}ms  p99 {:.2f}ms  max {:.2f}ms'.format(
+                origin, 'discord' if origin == 'irc' else 'irc',
+                percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                latencies[-1] * 1000))
+
+        if self.flap:
+            print('flaps: {}  discord resumes: {}  reconnects: {}'.format(
+                self.flaps, self.discord_server.resumes, self.metrics.reconnects.total()))
+        print('irc send queues: {}'.format(self.irc.stats))
+        print('irc outage buffers: {}'.format({name: network.outage.stats
+                                               for name, network in self.irc.networks.items()}))
+        print('discord outage buffer: {}'.format(self.discord.outage.stats))
+        print('discord send queue: {}'.format(self.discord.sender.stats))
+        if self.discord.webhook_sender is not None:
+            print('webhook send queues: {}'.format(self.discord.webhook_sender.stats))
+            print('webhook requests: {}'.format(self.discord.webhook_client.requests))
+        print('discord 429s: {}'.format(self.discord_server.rate_limited))
+        print('suppressed: {}'.format(dict(self.irc.dedupe.suppressed)))
+        print('gateway events filtered: {}'.format(int(self.metrics.gateway_filtered.total())))
+        if self.admission != 'off':
+            print('irc flood control: {}'.format(self.irc.admission.stats))
+            print('discord flood control: {}'.format(self.discord.admission.stats))
+        for name, stats in sorted(self.events.stats.items()):
+            if stats['handled']:
+                print('{}: handled {}  dropped {}  failed {}  mean {:.3f}ms  max wait {:.2f}ms'.format(
+                    name, stats['handled'], stats['dropped'], stats['failed'], stats['mean_handle_time'] * 1000,
+                    stats['max_wait_time'] * 1000))
+
+        if self.profiler is not None:
+            print('profile: max loop lag {:.1f}ms  slow callbacks: {}  stalls: {}  snapshots: {}'.format(
+                self.profiler.max_lag * 1000, self.profiler.slow_callbacks, self.profiler.stalls,
+                self.profiler.snapshots))
+            for name, count, total, longest in self.profiler.report():
+                print('  {}: {}x  {:.1f}ms  max {:.2f}ms'.format(name, count, total * 1000, longest * 1000))
+
+        # ru_maxrss is in kilobytes on linux
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        print('cpu: {:.2f}s  max rss: {:.1f}MB'.format(usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024))
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            print('traced memory: {:.1f}MB current, {:.1f}MB peak'.format(current / 1024 / 1024,
+                                                                        peak / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    logging.basicConfig(filename=arguments['--log'], level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
+
+    if arguments['--tracemalloc']:
+        tracemalloc.start()
+
+    bench = Benchmark(arguments)
+    loop = asyncio.get_event_loop()
+
+    # the IM modules print the channels they find, which isn't useful here
+    with contextlib.redirect_stdout(io.StringIO()):
+        setup_time = loop.run_until_complete(bench.setup())
+    loop.run_until_complete(bench.drive())
+
+    bench.report(setup_time, arguments['--tracemalloc'])
+    if arguments['--metrics']:
+        print(bench.metrics.registry.render(), end='')
+
+    loop.run_until_complete(bench.teardown())
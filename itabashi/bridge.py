@@ -0,0 +1,97 @@
+# the IM modules and the state they share, for a set of links
+import os
+import time
+
+from italib.archive import Archiver
+from italib.capture import TrafficCapture
+from italib.config import diff_links
+from italib.dedupe import FingerprintCache
+from italib.events import EventBus
+from italib.metrics import RelayMetrics
+from italib.routing import LinkRouter
+
+from .discord import DiscordManager
+from .irc import IrcManager
+
+
+class Bridge:
+    """Runs the IM modules for the links in the given config.
+
+    Creates the shared event bus, link router, dedupe cache and
+    metrics, starts the IRC and Discord modules with them, and archives
+    links that have ``log`` enabled. With ``connect_irc`` False, the IRC
+    module waits to take over the connections of the process we're
+    replacing (see :mod:`itabashi.upgrade`).
+    """
+
+    def __init__(self, logger, config, metrics=None, connect_irc=True):
+        self.logger = logger
+        self.config = config
+
+        self.events = EventBus(logger, **config.get('events', {}))
+        self.router = LinkRouter(config['links'])
+        self.dedupe = FingerprintCache(**config.get('dedupe', {}))
+        if metrics is None:
+            metrics = RelayMetrics()
+        self.metrics = metrics
+
+        self.irc = IrcManager(logger, config, self.events, router=self.router,
+                              dedupe=self.dedupe, metrics=metrics, connect=connect_irc)
+        self.discord = DiscordManager(logger, config, self.events, router=self.router,
+                                      dedupe=self.dedupe, metrics=metrics)
+
+        self.archiver = None
+        if any(link.get('log') for link in config['links'].values()):
+            self.archiver = Archiver(logger, config, self.events, self.router)
+        self.capture = None
+
+    def start_capture(self, path):
+        """Record the traffic both IM modules see to ``path``, for ``replay.py``."""
+        self.capture = TrafficCapture(self.logger, path, self.config)
+        self.irc.capture = self.capture
+        self.discord.capture = self.capture
+        self.logger.info('Capturing traffic to %s', path)
+
+    def reload(self, config):
+        """Apply a new config without restarting.
+
+        Only the links that changed are touched, and connections are only
+        remade if their settings changed. Returns the ``(added, removed,
+        changed)`` link names.
+        """
+        added, removed, changed = diff_links(self.config['links'], config['links'])
+        self.config = config
+        self.router.update(config['links'])
+        self.dedupe.apply_settings(**config.get('dedupe', {}))
+        self.irc.reload(config)
+        self.discord.reload(config)
+
+        if self.archiver is not None:
+            self.archiver.reload(config)
+        elif any(link.get('log') for link in config['links'].values()):
+            self.archiver = Archiver(self.logger, config, self.events, self.router)
+
+        self.logger.info('Reloaded config: %s links added, %s removed, %s changed',
+                         len(added), len(removed), len(changed))
+        return added, removed, changed
+
+    def health(self):
+        """Returns a summary of how we're doing, which is safe to pickle."""
+        metrics = self.metrics
+        return {
+            'pid': os.getpid(),
+            'time': time.time(),
+            'links': len(self.config['links']),
+            'irc_connected': self.irc.connected,
+            'irc_registered': self.irc.ready,
+            'discord_connected': all(client.is_logged_in and not client.is_closed for client in self.discord.clients),
+            'received': metrics.messages_in.total(),
+            'sent': metrics.messages_out.total(),
+            'queue_depth': {
+                'irc': self.irc.queue_depth,
+                'discord': self.discord.queue_depth,
+                'events': self.events.depth,
+            },
+            'reconnects': metrics.reconnects.total(),
+            'loop_lag': metrics.loop_lag.total(),
+        }
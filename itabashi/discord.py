@@ -2,141 +2,808 @@
 # itabashi_discord.py: discord bot
 # Developed by Antonizoon for the Bibliotheca Anonoma
 import asyncio
+import functools
+import itertools
+import json
 import sys
+import time
+import zlib
 
 import aiohttp
 import discord
+from discord.gateway import DiscordWebSocket, ReconnectWebSocket, ResumeWebSocket
 import websockets
+
+import itabashi
+from italib.admission import ADMITTED, DROPPED, AdmissionControl, admission_options
 from italib import backoff
+from italib.dedupe import FingerprintCache
+from italib import messagemap
+from italib.formatting import GREY, RESET, discord_to_irc, escape_markdown, irc_to_discord, strip_irc_formatting
+from italib.members import MemberDirectory
+from italib.messagemap import MessageMap
+from italib.metrics import RelayMetrics
+from italib.outage import OutageBuffer
+from italib.presence import PresenceAggregator
+from italib.relay import MESSAGE, RelayMessage
+from italib.routing import LinkRouter, is_discord_id
+from italib.sendqueue import SendScheduler
+from italib.webhooks import Webhook, WebhookClient
 
 loop = asyncio.get_event_loop()
 
+# gateway events we never use. we still need guild subscriptions for the
+#   member events our member directory follows, so these are sent to us
+#   and dropped as they arrive
+IGNORED_EVENTS = frozenset(['PRESENCE_UPDATE', 'TYPING_START'])
+
+# gateway events that are only about one channel's messages
+CHANNEL_EVENTS = frozenset(['MESSAGE_CREATE', 'MESSAGE_UPDATE', 'MESSAGE_DELETE', 'MESSAGE_DELETE_BULK',
+                            'MESSAGE_REACTION_ADD', 'MESSAGE_REACTION_REMOVE', 'MESSAGE_REACTION_REMOVE_ALL',
+                            'CHANNEL_PINS_UPDATE'])
+
+
+class FilteredWebSocket(DiscordWebSocket):
+    """A gateway connection that drops the events we don't need before discord.py sees them.
+
+    Each dispatched event is passed to ``keep_event`` with its name and data
+    as soon as it's decoded. Those it returns False for only move our
+    sequence number on, so discord.py never parses them into its objects or
+    caches them.
+    """
+
+    keep_event = None
+
+    @asyncio.coroutine
+    def received_message(self, msg):
+        if self.keep_event is not None:
+            if isinstance(msg, bytes):
+                msg = zlib.decompress(msg, 15, 10490000).decode('utf-8')
+            payload = json.loads(msg)
+            if payload.get('op') == self.DISPATCH and not self.keep_event(payload.get('t'), payload.get('d')):
+                if payload.get('s') is not None:
+                    self._connection.sequence = payload['s']
+                return
+        # events we keep are decoded again by discord.py, which is only
+        #   as much work as linked channels' traffic makes
+        yield from super().received_message(msg)
+
 
 class DiscordManager:
-    def __init__(self, logger, config, event_manager):
+    def __init__(self, logger, config, event_manager, router=None, dedupe=None, metrics=None):
         self.logger = logger
         self.config = config
         self.events = event_manager
 
-        self.dispatch_channels = [config['links'][name]['channels']['discord'] for name in config['links'] if 'discord' in config['links'][name]['channels']]
-        # simplifies down to a simple list of IRC chans -> Discord chans
-        self.channels = {
-            'irc': {},
-        }
-        for name in config['links']:
-            link = config['links'][name]['channels']
-            if 'discord' in link and 'irc' in link:
-                if link['irc'] not in self.channels['irc']:
-                    self.channels['irc'][link['irc']] = []
-                if link['discord'] not in self.channels['irc'][link['irc']]:
-                    self.channels['irc'][link['irc']].append(link['discord'])
+        # routing tables are normally shared with the other IM modules
+        if router is None:
+            router = LinkRouter(config['links'])
+        self.router = router
+        if dedupe is None:
+            dedupe = FingerprintCache()
+        self.dedupe = dedupe
+        if metrics is None:
+            metrics = RelayMetrics()
+        self.metrics = metrics
+        # records our traffic, if we're being captured
+        self.capture = None
 
+        # channel id -> channel object, for the channels we send to. filled in
+        #   as we first send to each channel, so startup doesn't have to look
+        #   through every channel we can see
         self.discord_channels = {}
+        # channel names we've looked for and not found since we last connected
+        self._missing_names = set()
 
         self.events.register('irc message', self.handle_irc_message)
         self.events.register('irc action', self.handle_irc_action)
+        self.events.register('irc presence', self.handle_irc_presence)
+
+        # create a client for each shard of the gateway. edits and deletions
+        #   are followed through our own message map rather than discord.py's
+        #   message cache, so that only keeps as few messages as it can. the
+        #   first client also makes our REST requests
+        discord_config = config['modules']['discord']
+        shards = discord_config.get('shards', 1)
+        if shards > 1:
+            self.clients = [discord.Client(max_messages=100, shard_id=shard_id, shard_count=shards)
+                            for shard_id in range(shards)]
+        else:
+            self.clients = [discord.Client(max_messages=100)]
+        self.client = self.clients[0]
+        # our user's ID, once we've logged in
+        self.user_id = None
+        # the clients whose shards are ready. we're connected once they all are
+        self._ready_clients = set()
+
+        # the messages we've relayed, so their edits and deletions can be too
+        self.relay_edits = discord_config.get('relay_edits', True)
+        self.messages = MessageMap(
+            self.logger,
+            memory=discord_config.get('message_map_memory', 4 * 1024 * 1024),
+            path=discord_config.get('message_map_file'),
+            max_rows=discord_config.get('message_map_rows', 1000000),
+        )
+
+        # guild members by name, so IRC users can mention them
+        self.irc_mentions = discord_config.get('irc_mentions', True)
+        self.members = MemberDirectory()
+
+        # one flooding user or bot shouldn't hold up everyone else on their links
+        self.admission = AdmissionControl(self.logger, self.dispatch_message, self.metrics,
+                                          **admission_options(config))
+
+        # joins, parts, quits and nick changes on IRC, folded into a summary
+        #   for each channel that's edited as more arrive
+        self.presence = PresenceAggregator(
+            self.publish_presence,
+            delay=discord_config.get('presence_delay', 5.0),
+            interval=discord_config.get('presence_interval', 10.0),
+            quiet=discord_config.get('presence_quiet', 60.0),
+            split_quiet=discord_config.get('presence_split_quiet', 600.0),
+            max_nicks=discord_config.get('presence_max_nicks', 1000),
+        )
+
+        # outbound messages are queued per channel so they stay in order and
+        #   obey discord's rate limits
+        self.sender = SendScheduler(
+            self.logger, self.send_message,
+            limit=discord_config.get('send_limit', 5),
+            per=discord_config.get('send_per', 5.0),
+            global_limit=discord_config.get('global_send_limit', 50),
+            global_per=discord_config.get('global_send_per', 1.0),
+            maxsize=discord_config.get('send_queue_size', 100),
+            coalesce=discord_config.get('coalesce_window', 0.0),
+            on_sent=self.handle_message_sent,
+        )
+
+        # channels with a webhook are sent IRC messages through it instead, under
+        #   the sender's nick. each webhook has its own queue and rate limits, and
+        #   they all share one pool of keep-alive connections
+        self.webhooks = {}
+        self.webhook_ids = set()
+        self.webhook_client = None
+        self.webhook_sender = None
+        self.setup_webhooks()
+
+        # IRC messages are held while we're disconnected from the gateway, and
+        #   sent on once we're back
+        self.connected = False
+        self.outage = OutageBuffer(
+            self.logger, self.deliver_irc,
+            maxlen=discord_config.get('outage_buffer_size', 200),
+            rate=discord_config.get('outage_drain_rate', 5.0),
+            burst=discord_config.get('outage_drain_burst', 10),
+        )
+        self.metrics.watch_queue('discord', lambda: self.queue_depth)
+
+        # shared by login and reconnection attempts, and reported in our metrics
+        self.retry = backoff.ExponentialBackoff()
+        self.metrics.watch_backoff('discord', self.retry)
+
+        # attach events. client.event only takes coroutine functions, so
+        #   those that need to know which client they came from are set directly
+        for client in self.clients:
+            client.on_ready = functools.partial(self.on_ready, client)
+            client.on_resumed = functools.partial(self.on_resumed, client)
+            client.event(self.on_message)
+            # called inline for every gateway event, rather than from a new
+            #   task for each like the on_ events are
+            client.handle_socket_response = self.handle_socket_response
+        self._raw_handlers = {}
+        # the last raw handler that had to wait
+        self._raw_task = None
+        if self.relay_edits:
+            self._raw_handlers.update({
+                'MESSAGE_UPDATE': self.handle_raw_edit,
+                'MESSAGE_DELETE': self.handle_raw_delete,
+                'MESSAGE_DELETE_BULK': self.handle_raw_bulk_delete,
+            })
+        if self.irc_mentions:
+            self._raw_handlers.update({
+                'READY': self.handle_raw_ready,
+                'GUILD_CREATE': self.handle_raw_guild,
+                'GUILD_DELETE': self.handle_raw_guild_delete,
+                'GUILD_MEMBERS_CHUNK': self.handle_raw_members_chunk,
+                'GUILD_MEMBER_ADD': self.handle_raw_member,
+                'GUILD_MEMBER_UPDATE': self.handle_raw_member,
+                'GUILD_MEMBER_REMOVE': self.handle_raw_member_remove,
+            })
+
+        # actually start running the clients
+        self._main_tasks = [asyncio.ensure_future(self.main_task(client)) for client in self.clients]
+
+    def setup_webhooks(self):
+        """Start the webhook client and scheduler, if we have any webhooks and haven't already."""
+        discord_config = self.config['modules']['discord']
+        if discord_config.get('webhooks') and self.webhook_client is None:
+            self.webhook_client = WebhookClient(
+                limit=discord_config.get('webhook_connections', 20),
+                keepalive_timeout=discord_config.get('webhook_keepalive', 30.0),
+                avatar_url=discord_config.get('webhook_avatar_url'),
+                user_agent='Itabashi/{}'.format(itabashi.__version__),
+            )
+            self.webhook_sender = SendScheduler(
+                self.logger, self.send_webhook,
+                limit=discord_config.get('webhook_send_limit', 5),
+                per=discord_config.get('webhook_send_per', 2.0),
+                global_limit=discord_config.get('webhook_global_send_limit', 50),
+                global_per=discord_config.get('webhook_global_send_per', 1.0),
+                maxsize=discord_config.get('send_queue_size', 100),
+                coalesce=discord_config.get('coalesce_window', 0.0),
+                on_sent=self.handle_webhook_sent,
+            )
+        self.bind_webhooks()
+
+    # start a discord.py client
+    @asyncio.coroutine
+    def main_task(self, client):
+        # guided by https://gist.github.com/Hornwitser/93aceb86533ed3538b6f
+        # thanks Hornwitser!
+        retry = self.retry
+
+        # login to Discord
+        while True:
+            if client.is_closed:
+                client._closed.clear()
+                client.http.recreate()
+            discord_config = self.config['modules']['discord']
+            try:
+                yield from client.login(discord_config['email'], discord_config['password'])
+            except (discord.HTTPException, aiohttp.ClientError):
+                self.logger.exception('discord.py failed to login, waiting and retrying')
+                yield from asyncio.sleep(retry.delay())
+            else:
+                break
+
+        # discord only lets us identify every five seconds, so shards, and
+        #   workers with identify_delay, take turns
+        discord_config = self.config['modules']['discord']
+        delay = discord_config.get('identify_delay', 0)
+        delay += discord_config.get('identify_interval', 5.0) * (client.shard_id or 0)
+        if delay:
+            yield from asyncio.sleep(delay)
 
-        # extract values we use from config
-        email = config['modules']['discord']['email']
-        password = config['modules']['discord']['password']
-
-        # create a client
-        self.client = discord.Client()
-
-        # attach events
-        self.client.event(self.on_ready)
-        self.client.event(self.on_message)
-
-        # start the discord.py client
-        @asyncio.coroutine
-        def main_task():
-            # guided by https://gist.github.com/Hornwitser/93aceb86533ed3538b6f
-            # thanks Hornwitser!
-            retry = backoff.ExponentialBackoff()
-
-            # login to Discord
-            while True:
-                try:
-                    yield from self.client.login(email, password)
-                except (discord.HTTPException, aiohttp.ClientError):
-                    logging.exception("discord.py failed to login, waiting and retrying")
-                    yield from asyncio.sleep(retry.delay())
-                else:
-                    break
-
-            # connect to Discord and reconnect when necessary
-            while self.client.is_logged_in:
-                if self.client.is_closed:
-                    self.client._closed.clear()
-                    self.client.http.recreate()
-
-                try:
-                    yield from self.client.connect()
-
-                except (discord.HTTPException, aiohttp.ClientError,
-                        discord.GatewayNotFound, discord.ConnectionClosed,
-                        websockets.InvalidHandshake,
-                        websockets.WebSocketProtocolError) as e:
-                    if isinstance(e, discord.ConnectionClosed) and e.code == 4004:
-                        raise # Do not reconnect on authentication failure
-                    logging.exception("discord.py disconnected, waiting and reconnecting")
-                    yield from asyncio.sleep(retry.delay())
-
-        # actually start running the client
-        asyncio.async(main_task())
+        # connect to Discord and reconnect when necessary
+        while client.is_logged_in:
+            if client.is_closed:
+                client._closed.clear()
+                client.http.recreate()
+
+            try:
+                yield from self.connect(client)
+
+            except (discord.HTTPException, aiohttp.ClientError,
+                    discord.GatewayNotFound, discord.ConnectionClosed,
+                    websockets.InvalidHandshake,
+                    websockets.WebSocketProtocolError) as e:
+                if isinstance(e, discord.ConnectionClosed) and e.code == 4004:
+                    raise # Do not reconnect on authentication failure
+                self.logger.exception('discord.py disconnected, waiting and reconnecting')
+                self.disconnected(client)
+                yield from asyncio.sleep(retry.delay())
+            else:
+                self.disconnected(client)
+
+    def reload(self, config):
+        """Apply a new config in place.
+
+        Links that have been added or removed only change the shared
+        router, so we just forget channels we couldn't find before. We only
+        log in again if our credentials have changed.
+        """
+        old = self.config['modules']['discord']
+        if admission_options(config) != admission_options(self.config):
+            self.admission = AdmissionControl(self.logger, self.dispatch_message, self.metrics,
+                                              **admission_options(config))
+        self.config = config
+        new = config['modules']['discord']
+
+        self._missing_names.clear()
+        self.setup_webhooks()
+        for key in self.outage.links():
+            if not self.router.is_linked('discord', key):
+                self.outage.discard(key)
+
+        if (old['email'], old['password']) != (new['email'], new['password']):
+            self.logger.info('discord: credentials changed, logging in again')
+            asyncio.ensure_future(self.restart())
+
+    @asyncio.coroutine
+    def restart(self):
+        """Log out, and log in again from scratch."""
+        for task in self._main_tasks:
+            task.cancel()
+        self.disconnected()
+        for client in self.clients:
+            yield from client.logout()
+            # a new login shouldn't try to resume the old one's session
+            client.connection.session_id = None
+            client.connection.sequence = None
+        self._main_tasks = [asyncio.ensure_future(self.main_task(client)) for client in self.clients]
+
+    @asyncio.coroutine
+    def logout(self):
+        """Log every shard's client out."""
+        for client in self.clients:
+            yield from client.logout()
+
+    @asyncio.coroutine
+    def connect(self, client):
+        """Connect a client to the gateway, and stay connected.
+
+        This is ``Client.connect``, except that if we still have the session
+        we were disconnected from it's resumed rather than identifying from
+        scratch, so Discord replays the events we missed instead of sending
+        every server and channel again, and the events we don't need are
+        dropped as soon as they arrive.
+        """
+        state = client.connection
+        resume = state.session_id is not None and state.sequence is not None
+        if resume:
+            self.logger.info('discord: resuming session %s', state.session_id)
+        client.ws = yield from self.open_gateway(client, resume)
+
+        while not client.is_closed:
+            try:
+                yield from client.ws.poll_event()
+            except (ReconnectWebSocket, ResumeWebSocket):
+                self.logger.info('discord: gateway asked us to reconnect, resuming')
+                self.disconnected(client)
+                client.ws = yield from self.open_gateway(client, state.session_id is not None)
+            except discord.ConnectionClosed as e:
+                # these mean our session can't be resumed
+                if e.code in (4007, 4009):
+                    state.session_id = None
+                    state.sequence = None
+                yield from client.close()
+                if e.code != 1000:
+                    raise
+
+    @asyncio.coroutine
+    def open_gateway(self, client, resume):
+        ws = yield from FilteredWebSocket.from_client(client, resume=resume)
+        # nothing is read from the gateway between identifying and here
+        ws.keep_event = self.keep_event
+        return ws
+
+    def keep_event(self, event, data):
+        """Returns whether discord.py should see a gateway event.
+
+        Messages and the like are only kept for linked channels, by their
+        ID, unless some links refer to a channel by name we haven't found
+        yet. Our own messages are dropped here too.
+        """
+        if event in IGNORED_EVENTS:
+            self.metrics.filtered('discord', event)
+            return False
+        if event not in CHANNEL_EVENTS:
+            return True
+        linked = self.router.is_linked('discord', data.get('channel_id') or '')
+        if not linked and not self.router.unbound_discord_names:
+            self.metrics.filtered('discord', event)
+            return False
+        if event == 'MESSAGE_CREATE':
+            author_id = data.get('author', {}).get('id')
+            if author_id == self.user_id or author_id in self.webhook_ids:
+                self.metrics.filtered('discord', event)
+                return False
+        return True
+
+    def disconnected(self, client=None):
+        """Hold messages for Discord until we're connected again.
+
+        ``client`` is the client whose shard was disconnected, or None if
+        they all were.
+        """
+        if client is None:
+            self._ready_clients.clear()
+        else:
+            self._ready_clients.discard(client)
+        if not self.connected:
+            return
+        self.connected = False
+        self.sender.pause()
+        if self.webhook_sender is not None:
+            self.webhook_sender.pause()
+        self.events.dispatch('discord disconnected', {})
+
+    def reconnected(self):
+        self.connected = True
+        self.sender.resume()
+        if self.webhook_sender is not None:
+            self.webhook_sender.resume()
+        self.outage.drain()
 
     # retrieve channel objects we use to send messages
     @asyncio.coroutine
-    def on_ready(self):
+    def on_ready(self, client):
         print('Discord -- Logged in as')
-        print(self.client.user.name)
-        print(self.client.user.id)
+        print(client.user.name)
+        print(client.user.id)
+        if client.shard_count:
+            print('shard {} of {}'.format(client.shard_id, client.shard_count))
         print('------')
+        self.user_id = client.user.id
 
-        # show all available channels and fill out our internal lists
-        print('Available Discord Channels:')
-        for channel in self.client.get_all_channels():
-            print('#%s (%s)' % (channel.name, channel.id))
-            if channel.name in self.dispatch_channels:
-                self.discord_channels[channel.name] = channel
-
-        print('------')
+        # identifying again gives us new channel objects, which we look up
+        #   again when they're next needed
+        self.discord_channels.clear()
+        self._missing_names.clear()
 
+        self._ready_clients.add(client)
+        if len(self._ready_clients) < len(self.clients):
+            return
+        # channels linked by name are found now, so the gateway can drop
+        #   messages from every other channel
+        for name in sorted(self.router.unbound_discord_names):
+            self.channel_for(name)
+        self.reconnected()
         self.events.dispatch('discord ready', {})
 
+    # a resumed session has the same channels as before, so we just carry on
+    @asyncio.coroutine
+    def on_resumed(self, client):
+        self.logger.info('discord: resumed session')
+        self._ready_clients.add(client)
+        if len(self._ready_clients) == len(self.clients):
+            self.reconnected()
+
+    def get_channel(self, channel_id):
+        """Returns the channel with the given ID from whichever shard has it, or None."""
+        for client in self.clients:
+            channel = client.get_channel(channel_id)
+            if channel is not None:
+                return channel
+        return None
+
+    def channel_for(self, key):
+        """Returns the channel with the given routing key, or None.
+
+        Channels are looked up by ID the first time they're needed. Links
+        that refer to a channel by name fall back to searching every
+        channel we can see for it, once.
+        """
+        channel = self.discord_channels.get(key)
+        if channel is not None:
+            return channel
+
+        if is_discord_id(key):
+            channel = self.get_channel(key)
+        elif key not in self._missing_names:
+            channel = discord.utils.find(
+                lambda chan: chan.type == discord.ChannelType.text and chan.name.lower() == key,
+                itertools.chain.from_iterable(client.get_all_channels() for client in self.clients))
+            if channel is None:
+                self._missing_names.add(key)
+                self.logger.warning('discord: could not find linked channel #%s', key)
+            else:
+                self.bind_channel(channel)
+
+        if channel is not None:
+            self.discord_channels[channel.id] = channel
+        return channel
+
+    def bind_channel(self, channel):
+        """Tell the router the ID of a channel that links refer to by name."""
+        self.logger.warning('discord: linked channel #%s is referred to by name, which breaks if it is renamed. '
+                            'Its ID is %s', channel.name, channel.id)
+        self.router.bind_discord_id(channel.name, channel.id)
+        # webhooks given for channel names can be keyed on their IDs now
+        self.bind_webhooks()
+
+    def bind_webhooks(self):
+        """Key our webhooks on the routing keys of the channels they post to."""
+        webhooks = {}
+        for ref, url in self.config['modules']['discord'].get('webhooks', {}).items():
+            key = self.router.key('discord', ref)
+            webhook = self.webhooks.get(key)
+            if webhook is None or webhook.url != url:
+                webhook = Webhook(url, channel=key)
+            webhook.channel = key
+            webhooks[key] = webhook
+        self.webhooks = webhooks
+        self.webhook_ids = {webhook.id for webhook in webhooks.values()}
+
+    @property
+    def queue_depth(self):
+        depth = self.sender.depth + len(self.outage)
+        if self.webhook_sender is not None:
+            depth += self.webhook_sender.depth
+        return depth
+
     # dispatching messages
     @asyncio.coroutine
     def on_message(self, message):
+        received = time.monotonic()
+
         # for our watched channels only
-        self.logger.debug('discord: raw 1')
-        if message.channel.name.lower() in self.dispatch_channels:
-            self.logger.debug('discord: raw 2')
-            # dispatch all but our own messages
-            if str(message.author) != str(self.client.user):
-                self.logger.debug('discord: raw 3 - dispatching')
-                full_message = [message.clean_content]
-                if not full_message[0]:
-                    full_message.pop(0)
-                for attachment in message.attachments:
-                    full_message.append(attachment.get('url', 'No URL for attachment'))
-
-                info = {
-                    'type': 'message',
-                    'service': 'discord',
-                    'channel': message.channel,
-                    'source': message.author,
-                    'message': ' '.join(full_message),
-                }
-
-                self.events.dispatch('discord message', info)
+        links = self.router.links_for('discord', message.channel.id)
+        if not links:
+            name = getattr(message.channel, 'name', None)
+            if name is None or name.lower() not in self.router.unbound_discord_names:
+                return
+            self.bind_channel(message.channel)
+            links = self.router.links_for('discord', message.channel.id)
+
+        # dispatch all but our own messages, including those sent through our webhooks
+        if message.author.id == self.user_id or message.author.id in self.webhook_ids:
+            return
+
+        formatted, full_message = self.format_message(message)
+        if self.dedupe.is_repeat(links, 'discord', message.author.id, full_message,
+                                 message_id=message.id, from_bot=message.author.bot):
+            return
+
+        relayed = RelayMessage('discord', MESSAGE, links, message.channel.id, message.author.name, full_message,
+                               formatted, received, discriminator=message.author.discriminator,
+                               message_id=message.id)
+        admitted = self.admission.admit(relayed, message.author.id)
+        if admitted == DROPPED:
+            return
+        if admitted == ADMITTED:
+            self.metrics.received(links, 'discord')
+            self.logger.debug('discord: dispatching message %s from channel %s', message.id, message.channel.id)
+            # waits for room if a handler is behind and mustn't lose messages
+            yield from self.events.publish('discord message', relayed)
+        if self.relay_edits:
+            self.messages.put(message.id, messagemap.DISCORD, message.channel.id, message.author.name,
+                              message.author.discriminator, self.stored_text(full_message))
+
+    def dispatch_message(self, message):
+        # messages held back from flooding authors, and summaries of those dropped
+        self.metrics.received(message.links, 'discord')
+        self.events.dispatch('discord message', message)
+
+    def format_message(self, message):
+        """Returns a message's text with IRC formatting, and as plain text.
+
+        Markdown and mentions are translated to IRC formatting once here, and
+        the plain text is that with the formatting stripped.
+        """
+        full_message = [discord_to_irc(message.content, self.mention_names(message))]
+        if not full_message[0]:
+            full_message.pop(0)
+        for attachment in message.attachments:
+            full_message.append(attachment.get('url', 'No URL for attachment'))
+        formatted = ' '.join(full_message)
+        return formatted, strip_irc_formatting(formatted)
+
+    def stored_text(self, text):
+        if len(text) > messagemap.TEXT_LIMIT:
+            return text[:messagemap.TEXT_LIMIT] + '…'
+        return text
+
+    # raw gateway events
+    def handle_socket_response(self, msg):
+        if self.capture is not None and msg.get('op') == 0:
+            self.capture.discord_in(msg['t'], msg['d'])
+        handler = self._raw_handlers.get(msg.get('t'))
+        if handler is not None:
+            try:
+                result = handler(msg['d'])
+            except Exception:
+                self.logger.exception('discord: failed to handle %s', msg.get('t'))
+                return
+            if asyncio.iscoroutine(result):
+                # handlers that have to wait, eg. for the message map to read
+                #   from disk, still run in the order their events came in
+                self._raw_task = asyncio.ensure_future(self.handle_in_turn(self._raw_task, msg.get('t'), result))
+
+    @asyncio.coroutine
+    def handle_in_turn(self, previous, event, handling):
+        if previous is not None and not previous.done():
+            yield from asyncio.wait([previous])
+        try:
+            yield from handling
+        except Exception:
+            self.logger.exception('discord: failed to handle %s', event)
+
+    # keeping the member directory up to date, a member at a time
+    def handle_raw_ready(self, data):
+        shard = data.get('shard')
+        if shard is None:
+            self.members.clear()
+        else:
+            # only this shard's guilds are sent again
+            shard_id, shard_count = shard
+            for guild_id in list(self.members.guilds):
+                if (int(guild_id) >> 22) % shard_count == shard_id:
+                    self.members.remove_guild(guild_id)
+        for guild in data.get('guilds', []):
+            self.handle_raw_guild(guild)
+
+    def handle_raw_guild(self, data):
+        if not data.get('unavailable'):
+            self.members.load(data['id'], data.get('members', []))
+
+    def handle_raw_guild_delete(self, data):
+        self.members.remove_guild(data['id'])
+
+    def handle_raw_members_chunk(self, data):
+        self.members.load(data['guild_id'], data.get('members', []))
+
+    def handle_raw_member(self, data):
+        self.members.update(data['guild_id'], data)
+
+    def handle_raw_member_remove(self, data):
+        self.members.remove(data['guild_id'], data['user']['id'])
+
+    # following edits and deletions
+    @asyncio.coroutine
+    def handle_raw_edit(self, data):
+        # edits are read from the raw gateway events, since discord.py only
+        #   reports them for messages still in its cache. updates without
+        #   content are discord filling in link previews
+        if 'content' not in data:
+            return
+        record = yield from self.messages.get(data['id'])
+        if record is None or record[0] != messagemap.DISCORD:
+            return
+        origin, channel_id, name, discriminator, old = record
+        channel = self.get_channel(channel_id)
+        if channel is None:
+            return
+
+        message = discord.Message(channel=channel, **dict(data, reactions=[]))
+        formatted, full_message = self.format_message(message)
+        if full_message == old:
+            return
+        self.messages.put(data['id'], origin, channel_id, name, discriminator, self.stored_text(full_message))
+
+        correction = messagemap.substitution(old, full_message) or formatted
+        self.logger.debug('discord: dispatching edit of message %s', data['id'])
+        self.events.dispatch('discord edit', {
+            'type': 'edit',
+            'service': 'discord',
+            'channel': channel,
+            'source': discord.User(username=name, discriminator=discriminator, id=data.get('author', {}).get('id')),
+            'message': full_message,
+            'formatted': formatted,
+            'correction': '{}(edit){} {}'.format(GREY, RESET, correction),
+        })
+
+    def handle_raw_delete(self, data):
+        return self.relay_deletions(data['channel_id'], [data['id']])
+
+    def handle_raw_bulk_delete(self, data):
+        return self.relay_deletions(data['channel_id'], data.get('ids', []))
+
+    @asyncio.coroutine
+    def relay_deletions(self, channel_id, message_ids):
+        """Tell IRC about relayed messages that have been deleted from a channel."""
+        channel = self.get_channel(channel_id)
+        if channel is None or not self.router.links_for('discord', channel_id):
+            return
+        records = []
+        for message_id in message_ids:
+            record = yield from self.messages.get(message_id)
+            if record is not None:
+                records.append(record)
+                self.messages.discard(message_id)
+        if not records:
+            return
+
+        info = {'type': 'delete', 'service': 'discord', 'channel': channel, 'source': None}
+        origin, channel_id, name, discriminator, text = records[0]
+        if len(records) > 1:
+            # a moderator clearing out a channel gets one line, not one for each message
+            info['correction'] = '{}({} relayed messages were deleted on Discord){}'.format(GREY, len(records), RESET)
+        elif origin == messagemap.DISCORD:
+            info['source'] = discord.User(username=name, discriminator=discriminator)
+            info['correction'] = '{}(deleted){} {}'.format(GREY, RESET, messagemap.excerpt(text))
+        else:
+            info['correction'] = '{}(a message from {} was deleted on Discord){}'.format(GREY, name, RESET)
+        self.events.dispatch('discord delete', info)
+
+    def mention_names(self, message):
+        """Returns the names of the users, roles and channels a message mentions."""
+        names = {('@', user.id): user.display_name for user in message.mentions}
+        names.update((('#', channel.id), channel.name) for channel in message.channel_mentions)
+        if message.server is not None:
+            names.update((('@&', role.id), role.name) for role in message.role_mentions)
+        return names
 
     # receiving messages
-    def handle_irc_message(self, event):
-        for chan in self.channels['irc'].get(event['channel'].name, []):
-            assembled_message = '**<{}>** {}'.format(event['source'].nick, event['message'])
-            asyncio.async(self.client.send_message(self.discord_channels[chan], assembled_message))
-
-    def handle_irc_action(self, event):
-        for chan in self.channels['irc'].get(event['channel'].name, []):
-            assembled_message = '**\\* {}** {}'.format(event['source'].nick, event['message'])
-            asyncio.async(self.client.send_message(self.discord_channels[chan], assembled_message))
+    def handle_irc_message(self, message):
+        line = irc_to_discord(message.formatted)
+        self.relay_irc(message, '**<{}>** '.format(escape_markdown(message.author)), line, line)
+
+    def handle_irc_action(self, message):
+        line = irc_to_discord(message.formatted)
+        self.relay_irc(message, '**\\* {}** '.format(escape_markdown(message.author)), line, '_{}_'.format(line))
+
+    def relay_irc(self, message, header, line, webhook_line):
+        self.dedupe.record_relayed(message.links, message.text)
+        for chan in self.router.destinations('irc', (message.network, message.channel), 'discord'):
+            key = self.router.key('discord', chan)
+            self.outage.send(key, (key, message.kind, message.author, header, line, webhook_line, message.received))
+
+    def handle_irc_presence(self, event):
+        destinations = {self.router.key('discord', chan) for key in event['channels']
+                        for chan in self.router.destinations('irc', key, 'discord')}
+        for key in destinations:
+            self.presence.add(key, event['kind'], event['nick'], event['detail'])
+
+    def publish_presence(self, storm):
+        if not self.connected:
+            # try again once we're back
+            self.presence.published(storm)
+            return
+        channel = self.channel_for(storm.key)
+        if channel is None:
+            self.presence.discard(storm)
+            return
+        # summaries skip the send queue, since they're updated in place rather
+        #   than sent in order, but still count towards its rate limits
+        self.sender.queue_for(channel).bucket.hit()
+        self.sender.global_bucket.hit()
+        asyncio.ensure_future(self.send_presence(channel, storm))
+
+    @asyncio.coroutine
+    def send_presence(self, channel, storm):
+        """Post a presence summary, or edit it if it's been posted already."""
+        try:
+            content = storm.render()
+            if not content:
+                # eg. someone changed their nick and back again
+                return
+            if storm.message is None:
+                storm.message = yield from self.client.send_message(channel, content)
+            else:
+                storm.message = yield from self.client.edit_message(storm.message, content)
+            if self.capture is not None:
+                self.capture.discord_out(channel.id, content)
+        except (discord.HTTPException, aiohttp.ClientError):
+            self.logger.exception('discord: failed to post presence summary to %s', channel.id)
+        finally:
+            self.presence.published(storm)
+
+    def deliver_irc(self, item):
+        """Queue a message from IRC to be sent, returning False if we're disconnected."""
+        if not self.connected:
+            return False
+        key, kind, nick, header, line, webhook_line, received = item
+        # channels linked by name may have had their ID found since this was queued
+        key = self.router.key('discord', key)
+        channel = self.channel_for(key)
+        if self.irc_mentions and channel is not None and channel.server is not None:
+            line = self.members.mention(channel.server.id, line)
+            webhook_line = self.members.mention(channel.server.id, webhook_line)
+        webhook = self.webhooks.get(key)
+        if webhook is not None:
+            # the nick is shown as the message's author, so it needn't be in the text
+            self.webhook_sender.put_nowait(webhook, '', webhook_line, key=(kind, nick),
+                                           received=received, options={'username': nick})
+            return True
+        if channel is not None:
+            self.sender.put_nowait(channel, header, line, key=(kind, nick), received=received,
+                                   options={'nick': nick})
+        return True
+
+    @asyncio.coroutine
+    def send_message(self, channel, content, nick=None):
+        message = yield from self.client.send_message(channel, content)
+        if self.capture is not None:
+            self.capture.discord_out(channel.id, content)
+        if self.relay_edits:
+            self.messages.put(message.id, messagemap.IRC, channel.id, nick or '', '', '')
+
+    @asyncio.coroutine
+    def send_webhook(self, webhook, content, username=None):
+        # discord only tells us the message's ID if we wait for it to be posted
+        limits, message_id = yield from self.webhook_client.execute(webhook, content, username=username,
+                                                                    wait=self.relay_edits)
+        # keep the webhook's bucket in step with what discord says is left in it
+        if limits is not None:
+            self.webhook_sender.queue_for(webhook).bucket.update(*limits)
+        if self.capture is not None:
+            self.capture.discord_out(webhook.channel, content)
+        if message_id is not None:
+            self.messages.put(message_id, messagemap.IRC, webhook.channel, username or '', '', '')
+
+    def handle_message_sent(self, channel, received, count):
+        self.metrics.sent(self.router.links_for('discord', channel.id), 'discord', received, count)
+
+    def handle_webhook_sent(self, webhook, received, count):
+        self.metrics.sent(self.router.links_for('discord', webhook.channel), 'discord', received, count)
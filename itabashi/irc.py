@@ -1,126 +1,1097 @@
 # Written by Daniel Oaks <daniel@danieloaks.net>
+import asyncio
+import collections
+import functools
+import logging
+import math
 import ssl
+import time
 
-from girc.formatting import escape, remove_formatting_codes
+from girc.formatting import escape, unescape
 import girc
 
 import itabashi
+from italib.admission import ADMITTED, AdmissionControl, admission_options
+from italib.backoff import ExponentialBackoff
+from italib.dedupe import FingerprintCache
+from italib.events import BLOCK
+from italib.floodcontrol import CONTROL, IrcSendQueue, max_message_bytes, pack_targets, split_message
+from italib.formatting import irc_prefix, strip_irc_formatting
+from italib.logs import RAW_LOGGER, Lazy
+from italib.metrics import RelayMetrics
+from italib.outage import OutageBuffer
+from italib import presence
+from italib.relay import ACTION, MESSAGE, RelayMessage
+from italib.routing import DEFAULT_NETWORK, LinkRouter
+
+# the events messages of each kind are dispatched as
+RELAY_EVENTS = {MESSAGE: 'irc message', ACTION: 'irc action'}
+
+# the username we connect with
+USERNAME = 'ita'
+
+# most messages from Discord we hold while another process has our connections
+HELD_MESSAGES = 1000
+
+# network settings that can only be changed by reconnecting
+CONNECTION_SETTINGS = ('server', 'port', 'tls', 'tls_verify', 'nickname', 'nickserv_password')
+
+
+def network_configs(irc_config):
+    """Returns the config for each IRC network, by name.
+
+    The IRC module's config describes the default network, and may contain a
+    ``networks`` dict of other networks. Settings the other networks don't
+    give, such as the nickname, are taken from the default network.
+    """
+    base = {key: value for key, value in irc_config.items() if key != 'networks'}
+    configs = {DEFAULT_NETWORK: base}
+    for name, config in irc_config.get('networks', {}).items():
+        configs[name] = dict(base, **config)
+    return configs
+
+
+class IrcConnection:
+    """A single connection to an IRC network, and the channels it's in.
+
+    If the connection is lost, or the server hasn't sent us anything for
+    ``ping_timeout`` seconds, we reconnect after an exponential backoff.
+    Relayed lines waiting to be sent are kept until we've registered again,
+    and our channels are joined again before they're sent.
+
+    A registered connection can also be handed over to a new process, which
+    carries on with it from :meth:`adopt` instead of connecting.
+    """
+
+    def __init__(self, manager, network, index):
+        self.manager = manager
+        self.network = network
+        self.index = index
+        self.name = '{}/{}'.format(network.name, index)
+        self.ready = False
+        self.closed = False
+
+        # channel key -> name, for channels we should be in and channels we are in
+        self.channels = {}
+        self.joined = {}
+        # folded nick -> keys of the linked channels they're in, while we're
+        #   relaying presence. girc doesn't follow nick changes, and forgets a
+        #   user's channels before we hear they've quit
+        self.members = {}
+
+        config = network.config
+        self.backoff = ExponentialBackoff()
+        self.last_seen = time.monotonic()
+        self._reconnect_handle = None
+        self._ping_handle = None
+
+        self.server = self._create_server()
+        # the ISUPPORT tokens the server sent us, to hand over with the connection
+        self.isupport = []
+
+        # everything we send goes through here to keep us under flood limits
+        self.sendq = IrcSendQueue(
+            manager.logger, self.server,
+            rate=config.get('flood_rate', 1.0),
+            burst=config.get('flood_burst', 5),
+            maxsize=config.get('send_queue_size', 500),
+            on_sent=functools.partial(manager.handle_line_sent, network.name),
+        )
+        self.configure()
+        self._schedule_ping()
+
+    def configure(self):
+        """Apply the settings from our network's config that don't need a reconnect."""
+        config = self.network.config
+        self.ping_interval = config.get('ping_interval', 60.0)
+        self.ping_timeout = config.get('ping_timeout', 180.0)
+        self.sendq.bucket.rate = config.get('flood_rate', 1.0)
+        self.sendq.bucket.capacity = config.get('flood_burst', 5)
+        self.sendq.maxsize = config.get('send_queue_size', 500)
+
+    def _create_server(self):
+        # girc can't reuse a server once it's been disconnected, so each time
+        #   we connect we start with a new one
+        config = self.network.config
+        server = self.manager.reactor.create_server(self.name)
+        nickname = config['nickname'] if not self.index else '{}-{}'.format(config['nickname'], self.index)
+        server.set_user_info(nickname, user=USERNAME)
+        if 'nickserv_password' in config:
+            server.nickserv_identify(config['nickserv_password'])
+
+        # and it gives up on a server once it's lost its connection, so we
+        #   find out about that ourselves
+        connection_lost = server.connection_lost
+
+        def lost(exc):
+            was_connected = server.connected
+            connection_lost(exc)
+            if was_connected and server is self.server:
+                self.lost(exc)
+
+        server.connection_lost = lost
+        return server
+
+    def connect(self):
+        asyncio.ensure_future(self._connect())
+
+    @asyncio.coroutine
+    def _connect(self):
+        config = self.network.config
+        use_tls = config['tls']
+        if use_tls and not config['tls_verify']:
+            use_tls = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            use_tls.verify_mode = ssl.CERT_NONE
+
+        self.manager.logger.info('irc: Started connection %s to %s/%s', self.name, config['server'], config['port'])
+        server = self.server
+        self.last_seen = time.monotonic()
+        try:
+            yield from asyncio.get_event_loop().create_connection(lambda: server, config['server'], config['port'],
+                                                                  ssl=use_tls)
+        except OSError as exc:
+            self.manager.logger.warning('irc: connection %s failed: %s', self.name, exc)
+            self._schedule_reconnect()
+            return
+        if self.manager.paused:
+            self.pause_reading()
+
+    def pause_reading(self):
+        transport = getattr(self.server, 'transport', None)
+        if transport is not None and self.server.connected and not self.closed:
+            transport.pause_reading()
+
+    def resume_reading(self):
+        transport = getattr(self.server, 'transport', None)
+        if transport is not None and self.server.connected and not self.closed:
+            # the server can't have answered our pings while we weren't reading
+            self.last_seen = time.monotonic()
+            transport.resume_reading()
+
+    def lost(self, exc):
+        """Our connection has gone, so hold lines for our channels and reconnect."""
+        if self.closed:
+            return
+        self.manager.logger.warning('irc: lost connection %s: %s', self.name, exc or 'closed')
+        self.ready = False
+        self.joined.clear()
+        self.members.clear()
+        # relayed lines wait for us to reconnect, but joins and replies are stale
+        self.sendq.pause()
+        self.sendq.clear(CONTROL)
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_handle is None:
+            delay = self.backoff.delay()
+            self.manager.logger.info('irc: reconnecting %s in %.1f seconds', self.name, delay)
+            self._reconnect_handle = asyncio.get_event_loop().call_later(delay, self.reconnect)
+
+    def restart(self):
+        """Drop our connection and connect again, eg. with new settings."""
+        if self.server.connected:
+            self.server.transport.close()
+        elif self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+            self.reconnect()
+
+    def close(self, message=None):
+        """Disconnect for good."""
+        self.closed = True
+        self.ready = False
+        for handle in (self._reconnect_handle, self._ping_handle):
+            if handle is not None:
+                handle.cancel()
+        self.sendq.pause()
+        self.sendq.clear()
+        if self.server.connected:
+            self.server.quit(message)
+            # in case the server doesn't close the connection itself
+            asyncio.get_event_loop().call_later(5.0, self.server.transport.close)
+
+    def reconnect(self):
+        self._reconnect_handle = None
+        self.server = self._create_server()
+        self.isupport = []
+        self.sendq.server = self.server
+        self.connect()
+
+    def registered(self):
+        """Join our channels and send the lines we've been holding, now that we've registered."""
+        self.ready = True
+        self.sendq.resume()
+        self.network.assign()
+        self.network.outage.drain()
+
+    def update_features(self):
+        # link routing has to follow the network's casemapping
+        features = self.server.features
+        self.manager.router.set_casemapping(features.get('casemapping'), self.network.name)
+        self.network.update_limits(features)
+
+    # handing over to a new process
+    @property
+    def transferable(self):
+        # an encrypted connection's state lives in our ssl library, so only
+        #   plain connections can be handed over
+        transport = getattr(self.server, 'transport', None)
+        return (self.ready and self.server.connected and transport is not None and
+                transport.get_extra_info('sslcontext') is None)
+
+    def suspend(self):
+        """Stop reading from and sending to the server, while we hand this connection over."""
+        self.closed = True
+        # lines relayed in the meantime are held by our network, and handed over with it
+        self.ready = False
+        if self._ping_handle is not None:
+            self._ping_handle.cancel()
+            self._ping_handle = None
+        self.sendq.pause()
+        if not self.manager.paused:
+            self.server.transport.pause_reading()
+
+    def unsuspend(self):
+        """Carry on with a connection we couldn't hand over."""
+        self.closed = False
+        self._schedule_ping()
+        if not self.manager.paused:
+            self.resume_reading()
+        self.registered()
+
+    def detach(self):
+        """Forget a connection that's been handed over, without disconnecting it."""
+        # the new process has its own copy of the socket, so closing ours
+        #   leaves the connection up
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+        self.sendq.clear()
+        self.server.transport.abort()
+
+    def handover_state(self):
+        """Returns what a new process needs to carry on with this connection, for :meth:`adopt`."""
+        server = self.server
+        members = {nick: [self.joined[key] for key in keys if key in self.joined]
+                   for nick, keys in self.members.items()}
+        return {
+            'index': self.index,
+            'nick': str(server.nick),
+            'isupport': self.isupport,
+            'capabilities': [str(cap) for cap in server.capabilities.enabled],
+            # the start of a line we haven't had the rest of yet
+            'partial': server._new_data,
+            'channels': list(self.channels.values()),
+            'joined': list(self.joined.values()),
+            'members': members,
+            'queue': self.sendq.pending(),
+            'tokens': self.sendq.bucket.tokens,
+        }
+
+    def adopt(self, state, sock):
+        """Carry on with a connection handed over by the process we're replacing.
+
+        ``state`` is what that process's :meth:`handover_state` returned,
+        and ``sock`` is the connection's socket. Our network should give us
+        our channels before it lets any of its connections register.
+        """
+        server = self.server
+        server.nick = state['nick']
+        server.connect_info['user']['nick'] = state['nick']
+        for tokens in state['isupport']:
+            server.features.ingest(*tokens)
+        self.isupport = state['isupport']
+        if state['capabilities']:
+            server.capabilities.ingest('ack', [' '.join(state['capabilities'])])
+        server.registered = True
+        server.ready = True
+        server._new_data = state['partial']
+        self.update_features()
+
+        router = self.manager.router
+        network = self.network
+        for name in state['channels']:
+            key = router.key('irc', (network.name, name))
+            if router.is_linked('irc', key) and key not in network.assignments:
+                self.channels[key] = name
+                network.assignments[key] = self
+        self.joined = {router.key('irc', (network.name, name)): name for name in state['joined']}
+        if self.manager.relay_presence:
+            for nick, names in state['members'].items():
+                self.members[nick] = {router.key('irc', (network.name, name)) for name in names}
+
+        for verb, params, received in state['queue']:
+            self.sendq.send(verb, params, received=received)
+        # and we carry on from however much of the flood limit it had used
+        self.sendq.bucket.charge(self.sendq.bucket.capacity - state['tokens'])
+
+        asyncio.ensure_future(self._adopt(sock))
+
+    @asyncio.coroutine
+    def _adopt(self, sock):
+        server = self.server
+
+        # girc would start registering all over again
+        def connection_made(transport):
+            server.transport = transport
+            server.connected = True
+
+        server.connection_made = connection_made
+        self.last_seen = time.monotonic()
+        try:
+            yield from asyncio.get_event_loop().create_connection(lambda: server, sock=sock)
+        except OSError as exc:
+            self.manager.logger.warning('irc: could not take over connection %s: %s', self.name, exc)
+            sock.close()
+            self.joined.clear()
+            self.members.clear()
+            self._schedule_reconnect()
+            return
+        self.manager.logger.info('irc: took over connection %s as %s', self.name, server.nick)
+        if self.manager.paused:
+            self.pause_reading()
+        self.registered()
+
+    def _schedule_ping(self):
+        self._ping_handle = asyncio.get_event_loop().call_later(self.ping_interval, self.check_alive)
+
+    def check_alive(self):
+        """Ping the server if it's gone quiet, and drop the connection if it stays quiet."""
+        self._schedule_ping()
+        if not self.server.connected or self.manager.paused:
+            return
+        quiet = time.monotonic() - self.last_seen
+        if quiet >= self.ping_timeout:
+            self.manager.logger.warning('irc: no reply from %s for %d seconds', self.name, quiet)
+            self.server.transport.close()
+        elif quiet >= self.ping_interval:
+            self.sendq.send('PING', ['itabashi'], priority=CONTROL)
+
+    def sync(self):
+        """Join the channels we should be in, and part the ones we shouldn't.
+
+        Channels are joined and parted in as few lines as the server allows.
+        """
+        if not self.ready:
+            return
+        targmax = self.server.features.get('targmax') or {}
+
+        joins = []
+        for key, name in self.channels.items():
+            if key not in self.joined:
+                joins.append(name)
+                self.joined[key] = name
+        for targets in pack_targets(joins, 'JOIN', targmax.get('join')):
+            self.sendq.send('JOIN', [targets], priority=CONTROL)
+
+        parts = [self.joined.pop(key) for key in [key for key in self.joined if key not in self.channels]]
+        for targets in pack_targets(parts, 'PART', targmax.get('part')):
+            self.sendq.send('PART', [targets], priority=CONTROL)
+
+    def load(self):
+        """Recent traffic across our channels."""
+        traffic = self.network.traffic
+        return sum(traffic[key] for key in self.channels)
+
+
+class IrcNetwork:
+    """A pool of connections to one IRC network, and which channels each is in.
+
+    We start with ``connections`` connections (1 by default). Once the first
+    connection has registered we know the network's channel limits from
+    ISUPPORT (CHANLIMIT or MAXCHANNELS), along with ``channels_per_connection``
+    if set, and open more connections if the channels won't fit, up to
+    ``max_connections``.
+
+    Channels are given to the connection with the least recent traffic that
+    has room for them. Every ``rebalance_interval`` seconds, if a connection's
+    send queue has ``busy_queue_depth`` or more lines waiting, its busiest
+    channel is moved to a quieter connection, opening a new one if there's
+    room in the pool, so one busy channel doesn't hold up every other link.
+    """
+
+    def __init__(self, manager, name, config):
+        self.manager = manager
+        self.name = name
+        self.config = config
+
+        self.configure()
+
+        self.chanlimit = None
+        self.connections = []
+        self.assignments = {}
+        # channel key -> lines relayed recently, halved at every rebalance
+        self.traffic = collections.Counter()
+
+        # lines for channels whose connection is down are held here until it's
+        #   back, and then drained no faster than we're allowed to send them
+        self.outage = OutageBuffer(
+            manager.logger, self.deliver,
+            maxlen=config.get('outage_buffer_size', 200),
+            rate=config.get('outage_drain_rate', config.get('flood_rate', 1.0)),
+            burst=config.get('outage_drain_burst', config.get('flood_burst', 5)),
+        )
+
+        self._rebalance_handle = None
+
+    def configure(self):
+        config = self.config
+        self.min_connections = max(config.get('connections', 1), 1)
+        self.max_connections = max(config.get('max_connections', 1), self.min_connections)
+        self.channels_per_connection = config.get('channels_per_connection')
+        self.rebalance_interval = config.get('rebalance_interval', 60.0)
+        self.busy_queue_depth = config.get('busy_queue_depth', 10)
+
+    def start(self):
+        # connections handed over by the process we're replacing keep their places
+        handed, held = self.manager.handover.pop(self.name, ({}, ()))
+        for index in range(max([self.min_connections] + [index + 1 for index in handed])):
+            self.add_connection(handed.get(index))
+        for channel, message, received in held:
+            self.send(channel, message, received)
+        if self.max_connections > 1:
+            self._schedule_rebalance()
+
+    def reconfigure(self, config):
+        """Apply a new config, only reconnecting if our connection settings changed."""
+        reconnect = [key for key in CONNECTION_SETTINGS if config.get(key) != self.config.get(key)]
+        self.config = config
+        self.configure()
+        self.outage.bucket.rate = config.get('outage_drain_rate', config.get('flood_rate', 1.0))
+        self.outage.bucket.capacity = config.get('outage_drain_burst', config.get('flood_burst', 5))
+        for connection in self.connections:
+            connection.configure()
+        if reconnect:
+            self.manager.logger.info('irc: %s changed on %s, reconnecting', ', '.join(reconnect), self.name)
+            for connection in self.connections:
+                connection.restart()
+        if self.max_connections > 1 and self._rebalance_handle is None:
+            self._schedule_rebalance()
+
+    def stop(self, message=None):
+        """Disconnect from the network, because no links use it any more."""
+        if self._rebalance_handle is not None:
+            self._rebalance_handle.cancel()
+            self._rebalance_handle = None
+        for connection in self.connections:
+            connection.close(message)
+            self.manager.connections.pop(connection.name, None)
+        self.connections = []
+        self.assignments = {}
+
+    def add_connection(self, handover=None):
+        connection = IrcConnection(self.manager, self, len(self.connections))
+        self.connections.append(connection)
+        self.manager.connections[connection.name] = connection
+        if handover is None:
+            connection.connect()
+        else:
+            connection.adopt(*handover)
+        return connection
+
+    def nicks(self):
+        return {connection.server.nick.lower() for connection in self.connections}
+
+    def connection_for(self, channel):
+        return self.assignments.get(self.manager.router.key('irc', (self.name, channel)))
+
+    def text_bytes(self, channel):
+        """Returns how many bytes of text fit in a single message to one of our channels.
+
+        Until the channel has a connection, we allow for the longest nick
+        any of our connections could have.
+        """
+        connection = self.connection_for(channel)
+        if connection is not None:
+            return max_message_bytes(connection.server.nick, connection.server.connect_info['user']['user'], channel)
+        nick = self.config['nickname']
+        if self.max_connections > 1:
+            nick = '{}-{}'.format(nick, self.max_connections - 1)
+        return max_message_bytes(nick, USERNAME, channel)
+
+    def update_limits(self, features):
+        limits = features.get('chanlimit')
+        if isinstance(limits, dict):
+            limit = limits.get('#') or min((value for value in limits.values() if value), default=None)
+        else:
+            limit = features.get('maxchannels')
+        if isinstance(limit, int) and limit > 0:
+            self.chanlimit = limit
+
+    def channel_limit(self):
+        limits = [limit for limit in (self.channels_per_connection, self.chanlimit) if limit]
+        return min(limits) if limits else None
+
+    def assign(self):
+        """Give each of our linked channels a connection, opening more if needed."""
+        router = self.manager.router
+        channels = {router.key('irc', chan): chan[1]
+                    for chan in router.channels.get('irc', ()) if chan[0] == self.name}
+
+        limit = self.channel_limit()
+        if limit:
+            wanted = min(max(self.min_connections, math.ceil(len(channels) / limit)), self.max_connections)
+            if len(channels) > wanted * limit:
+                self.manager.logger.warning('irc: %s has %s channels but only room for %s on %s connections',
+                                            self.name, len(channels), wanted * limit, wanted)
+            while len(self.connections) < wanted:
+                self.add_connection()
+
+        # forget channels that are no longer linked
+        for key in [key for key in self.assignments if key not in channels]:
+            del self.assignments.pop(key).channels[key]
+        for key in self.outage.links():
+            if key not in channels:
+                self.outage.discard(key)
+
+        for key in sorted(channels, key=lambda key: -self.traffic[key]):
+            if key in self.assignments:
+                continue
+            connection = self._least_loaded(limit)
+            if connection is None:
+                continue
+            connection.channels[key] = channels[key]
+            self.assignments[key] = connection
+
+        for connection in self.connections:
+            connection.sync()
+        # lines held for channels that didn't have a connection can go now
+        self.outage.drain()
+
+    def _least_loaded(self, limit, exclude=None):
+        candidates = [connection for connection in self.connections
+                      if connection is not exclude and (limit is None or len(connection.channels) < limit)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda connection: (connection.load(), len(connection.channels),
+                                                       connection.index))
+
+    def move(self, key, source, target):
+        """Move a channel, and the lines waiting to be sent to it, to another connection."""
+        name = source.channels.pop(key)
+        target.channels[key] = name
+        self.assignments[key] = target
+
+        for verb, params, received in source.sendq.take(name):
+            target.sendq.send(verb, params, received=received)
+
+        self.manager.logger.info('irc: moved %s from %s to %s', name, source.name, target.name)
+        target.sync()
+        source.sync()
+
+    def _schedule_rebalance(self):
+        self._rebalance_handle = asyncio.get_event_loop().call_later(self.rebalance_interval, self.rebalance)
+
+    def rebalance(self):
+        self._schedule_rebalance()
+
+        busiest = max(self.connections, key=lambda connection: (len(connection.sendq), connection.load()))
+        if len(busiest.sendq) >= self.busy_queue_depth and len(busiest.channels) > 1:
+            target = self._least_loaded(self.channel_limit(), exclude=busiest)
+            if ((target is None or len(target.sendq) >= self.busy_queue_depth) and
+                    len(self.connections) < self.max_connections):
+                target = self.add_connection()
+            if target is not None:
+                hottest = max(busiest.channels, key=lambda key: self.traffic[key])
+                self.move(hottest, busiest, target)
+
+        for key in list(self.traffic):
+            self.traffic[key] //= 2
+            if not self.traffic[key]:
+                del self.traffic[key]
+
+    def send(self, channel, message, received=None):
+        """Send a message to one of our channels, on whichever connection is in it.
+
+        Returns False if the message had to be held until that connection is
+        ready.
+        """
+        key = self.manager.router.key('irc', (self.name, channel))
+        self.traffic[key] += 1
+        return self.outage.send(key, (channel, message, received))
+
+    def deliver(self, item):
+        channel, message, received = item
+        connection = self.connection_for(channel)
+        if connection is None or not connection.ready:
+            return False
+        connection.sendq.msg(channel, message, received=received)
+        return True
 
 
 class IrcManager:
-    def __init__(self, logger, config, event_manager):
+    def __init__(self, logger, config, event_manager, router=None, dedupe=None, metrics=None, connect=True):
         self.logger = logger
+        self.raw_logger = logging.getLogger(RAW_LOGGER)
         self.config = config
         self.events = event_manager
 
-        self.dispatch_channels = [config['links'][name]['channels']['irc'] for name in config['links'] if 'irc' in config['links'][name]['channels']]
-        # simplifies down to a simple list of Discord chans -> IRC chans
-        self.channels = {
-            'discord': {},
-        }
-        for name in config['links']:
-            link = config['links'][name]['channels']
-            if 'discord' in link and 'irc' in link:
-                if link['discord'] not in self.channels['discord']:
-                    self.channels['discord'][link['discord']] = []
-                if link['irc'] not in self.channels['discord'][link['discord']]:
-                    self.channels['discord'][link['discord']].append(link['irc'])
+        # routing tables are normally shared with the other IM modules
+        if router is None:
+            router = LinkRouter(config['links'])
+        self.router = router
+        if dedupe is None:
+            dedupe = FingerprintCache()
+        self.dedupe = dedupe
+        if metrics is None:
+            metrics = RelayMetrics()
+        self.metrics = metrics
+        # records our traffic, if we're being captured
+        self.capture = None
+        # joins, parts, quits and nick changes are summarised on discord
+        self.relay_presence = config['modules']['irc'].get('relay_presence', False)
+        # one flooding user shouldn't hold up everyone else on their links
+        self.admission = AdmissionControl(logger, self.dispatch_message, self.metrics,
+                                          **admission_options(config))
 
-        reactor = girc.Reactor()
+        # we reconnect by ourselves, so girc mustn't stop the loop when every
+        #   connection is down
+        reactor = girc.Reactor(auto_close=False)
+        self.reactor = reactor
 
         # register irc handlers
         reactor.register_event('in', 'raw', self.handle_reactor_raw_in, priority=1)
         reactor.register_event('out', 'raw', self.handle_reactor_raw_out, priority=1)
+        reactor.register_event('in', 'features', self.handle_reactor_features)
+        reactor.register_event('in', 'endofmotd', self.handle_reactor_ready)
+        reactor.register_event('in', 'nomotd', self.handle_reactor_ready)
         reactor.register_event('in', 'ctcp', self.handle_reactor_ctcp)
         reactor.register_event('in', 'pubmsg', self.handle_reactor_pubmsgs)
         reactor.register_event('in', 'pubaction', self.handle_reactor_pubactions)
+        reactor.register_event('in', 'namreply', self.handle_reactor_names)
+        reactor.register_event('in', 'join', self.handle_reactor_join)
+        reactor.register_event('in', 'part', self.handle_reactor_part)
+        reactor.register_event('in', 'kick', self.handle_reactor_kick)
+        reactor.register_event('in', 'quit', self.handle_reactor_quit)
+        reactor.register_event('in', 'nick', self.handle_reactor_nick)
 
-        # register itabashi handlers
-        self.events.register('discord ready', self.handle_discord_ready)
-        self.events.register('discord disconnected', self.handle_discord_disconnected)
-        self.events.register('discord message', self.handle_discord_message)
+        # register itabashi handlers. they share one queue, which keeps them in
+        #   order, and it blocks rather than dropping since the connection
+        #   events mustn't be dropped. the Discord module waits for room
+        self.events.register('discord ready', self.handle_discord_ready, overflow=BLOCK)
+        self.events.register('discord disconnected', self.handle_discord_disconnected, overflow=BLOCK)
+        self.events.register('discord message', self.handle_discord_message, overflow=BLOCK)
+        self.events.register('discord edit', self.handle_discord_correction, overflow=BLOCK)
+        self.events.register('discord delete', self.handle_discord_correction, overflow=BLOCK)
 
-        # setup connection
-        self.irc = reactor.create_server('ita')
-        self.irc.set_user_info(config['modules']['irc']['nickname'], user='ita')
-        self.irc.join_channels(*[config['links'][name]['channels']['irc'] for name in config['links'] if 'irc' in config['links'][name]['channels']])
-        if 'nickserv_password' in config['modules']['irc']:
-            self.irc.nickserv_identify(config['modules']['irc']['nickserv_password'])
+        # connect to every network our links use
+        # server name -> connection
+        self.connections = {}
+        self.networks = {}
+        self.paused = False
+        # network name -> ({index: (state, socket)}, held lines), for the
+        #   connections we're taking over from another process
+        self.handover = {}
+        # connections we're handing over to another process
+        self._handing_over = []
+        # discord channel id -> ID of the last message from it we relayed,
+        #   so the process taking over from us knows where to carry on
+        self.relayed = {}
+        # (time, channel id, prefix, text, received, message id) for what
+        #   Discord sends while another process has our connections
+        self.held = None
+        # when we're taking over from another process, we wait for adopt()
+        if connect:
+            self.update_networks()
+        else:
+            self.held = collections.deque(maxlen=HELD_MESSAGES)
 
-        use_tls = config['modules']['irc']['tls']
-        if use_tls and not config['modules']['irc']['tls_verify']:
-            use_tls = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-            use_tls.verify_mode = ssl.CERT_NONE
+        # stop reading from IRC while a handler of our events that mustn't
+        #   drop them is behind. that's never for long, since we can't answer
+        #   the server's pings while we're not reading
+        self.events.watch_pressure(self.pause_reading, self.resume_reading,
+                                   events=list(RELAY_EVENTS.values()) + ['irc presence'])
+
+        self.metrics.watch_queue('irc', lambda: self.queue_depth)
+        self.metrics.watch_reconnects('irc', lambda: sum(connection.backoff.retries
+                                                         for connection in self.connections.values()))
+
+    def update_networks(self):
+        """Connect to the networks our links use, and disconnect from those they don't."""
+        configs = network_configs(self.config['modules']['irc'])
+        names = {link.get('network', DEFAULT_NETWORK) for link in self.config['links'].values()
+                 if link['channels'].get('irc')} or {DEFAULT_NETWORK}
+
+        for name in sorted(names):
+            if name not in configs:
+                self.logger.error('irc: links refer to network %s, which is not configured', name)
+                continue
+            network = self.networks.get(name)
+            if network is None:
+                self.networks[name] = IrcNetwork(self, name, configs[name])
+                self.networks[name].start()
+            elif network.config != configs[name]:
+                network.reconfigure(configs[name])
+
+        for name in [name for name in self.networks if name not in names or name not in configs]:
+            self.logger.info('irc: no links use %s any more, disconnecting', name)
+            self.networks.pop(name).stop()
+
+    def reload(self, config):
+        """Apply a new config in place.
+
+        Channels that have been linked or unlinked are joined or parted, and
+        only networks whose connection settings have changed reconnect. The
+        shared router should already have the new links.
+        """
+        if admission_options(config) != admission_options(self.config):
+            self.admission = AdmissionControl(self.logger, self.dispatch_message, self.metrics,
+                                              **admission_options(config))
+        self.config = config
+        self.relay_presence = config['modules']['irc'].get('relay_presence', False)
+        if not self.relay_presence:
+            for connection in self.connections.values():
+                connection.members.clear()
+        self.update_networks()
+        for network in self.networks.values():
+            network.assign()
+
+    def prepare_handover(self, limit=None):
+        """Stop using the connections that can be handed over to a new process.
+
+        Returns the state to pass to the new process's :meth:`adopt`, and
+        the sockets to send with it. Afterwards, call
+        :meth:`complete_handover` once the new process has them, or
+        :meth:`cancel_handover` to carry on as we were.
+
+        From here on we hold what Discord sends rather than relaying it. The
+        new process has been following Discord too, and relays what it's
+        had since the last message we relayed from each channel.
+        """
+        self.held = collections.deque(maxlen=HELD_MESSAGES)
+        connections = [connection for connection in self.connections.values() if connection.transferable]
+        self._handing_over = connections[:limit]
+        sockets = []
+        networks = {}
+        for connection in self._handing_over:
+            connection.suspend()
+            state = connection.handover_state()
+            state['socket'] = len(sockets)
+            sockets.append(connection.server.transport.get_extra_info('socket'))
+            networks.setdefault(connection.network.name, {'connections': [], 'held': []})
+            networks[connection.network.name]['connections'].append(state)
+        for name, network in self.networks.items():
+            held = [item for items in network.outage.pending().values() for item in items]
+            if held:
+                networks.setdefault(name, {'connections': [], 'held': []})['held'] = held
+        return {'networks': networks, 'relayed': dict(self.relayed), 'time': time.time()}, sockets
+
+    def cancel_handover(self):
+        for connection in self._handing_over:
+            connection.unsuspend()
+        self._handing_over = []
+        self.release_held()
+
+    def complete_handover(self, message=None):
+        """Let go of the connections we've handed over, and quit the rest."""
+        for connection in self._handing_over:
+            connection.detach()
+        for connection in self.connections.values():
+            if connection not in self._handing_over:
+                connection.close(message)
+        self._handing_over = []
+        # the new process relays what we've held
+        self.held = None
+
+    def adopt(self, state, sockets):
+        """Carry on with the connections handed over by the process we're replacing.
+
+        ``state`` and ``sockets`` are what that process's
+        :meth:`prepare_handover` returned. Networks that weren't handed
+        over are connected to as usual, and connections to networks we
+        don't use any more are quit. Then we relay what Discord has sent
+        us since that process stopped relaying it.
+        """
+        self.handover = {}
+        for name, network in state['networks'].items():
+            handed = {connection['index']: (connection, sockets[connection['socket']])
+                      for connection in network['connections']}
+            self.handover[name] = (handed, network['held'])
+        self.update_networks()
+
+        for name, (handed, _) in self.handover.items():
+            self.logger.info('irc: no links use %s any more, disconnecting', name)
+            for _, sock in handed.values():
+                try:
+                    sock.sendall(b'QUIT :Upgrading\r\n')
+                except OSError:
+                    pass
+                sock.close()
+        self.handover = {}
+        self.release_held(state.get('relayed'), state.get('time'))
+
+    def start(self):
+        """Connect to our networks as usual, when there's no process to take over from."""
+        self.update_networks()
+        self.release_held()
 
-        self.irc.connect(config['modules']['irc']['server'], config['modules']['irc']['port'], ssl=use_tls)
+    def release_held(self, relayed=None, since=None):
+        """Relay the messages from Discord we've held while another process had our connections.
 
-        self.logger.info('irc: Started and connected to {}/{}'.format(
-            config['modules']['irc']['server'], config['modules']['irc']['port']))
+        Messages that process has relayed already are skipped: those up to
+        the message ID it last relayed from their channel, in ``relayed``,
+        and edits and deletions before the time it stopped, ``since``.
+        """
+        held, self.held = self.held, None
+        relayed = relayed or {}
+        for stamp, channel_id, prefix, text, received, message_id in held or ():
+            if message_id is not None:
+                last = relayed.get(channel_id)
+                if last is not None and int(message_id) <= int(last):
+                    continue
+            elif since is not None and stamp < since:
+                continue
+            self.relay_discord(channel_id, prefix, text, received, message_id)
+
+    def pause_reading(self):
+        self.paused = True
+        for connection in self.connections.values():
+            connection.pause_reading()
+
+    def resume_reading(self):
+        self.paused = False
+        for connection in self.connections.values():
+            connection.resume_reading()
+
+    @property
+    def connected(self):
+        return any(connection.server.connected for connection in self.connections.values())
+
+    @property
+    def ready(self):
+        return any(connection.ready for connection in self.connections.values())
+
+    @property
+    def queue_depth(self):
+        return (sum(len(connection.sendq) for connection in self.connections.values()) +
+                sum(len(network.outage) for network in self.networks.values()))
+
+    @property
+    def stats(self):
+        return {name: connection.sendq.stats for name, connection in self.connections.items()}
 
     # display
     def handle_reactor_raw_in(self, event):
-        try:
-            self.logger.debug('raw irc: {}  -> {}'.format(event['server'].name, escape(event['data'])))
-        except (UnicodeDecodeError, UnicodeEncodeError):
-            self.logger.debug('raw irc: {}  -> {}'.format(event['server'].name, 'Data coule not be displayed'))
+        connection = self.connections.get(event['server'].name)
+        if connection is not None:
+            connection.last_seen = time.monotonic()
+            if self.capture is not None:
+                self.capture.irc_in(connection.network.name, event['data'])
+        if self.raw_logger.isEnabledFor(logging.DEBUG):
+            self.raw_logger.debug('raw irc: %s  -> %s', event['server'].name, Lazy(escape, event['data']))
 
     def handle_reactor_raw_out(self, event):
-        try:
-            self.logger.debug('raw irc: {} <-  {}'.format(event['server'].name, escape(event['data'])))
-        except (UnicodeDecodeError, UnicodeEncodeError):
-            self.logger.debug('raw irc: {} <-  {}'.format(event['server'].name, 'Data could not be displayed'))
+        # lines girc sends by itself, such as PONGs, still count towards flood limits
+        connection = self.connections.get(event['server'].name)
+        if connection is not None:
+            connection.sendq.charge()
+        if self.raw_logger.isEnabledFor(logging.DEBUG):
+            self.raw_logger.debug('raw irc: %s <-  %s', event['server'].name, Lazy(escape, event['data']))
+
+    def handle_reactor_features(self, event):
+        connection = self.connections[event['server'].name]
+        # the first parameter is our nick, and the last is 'are supported by this server'
+        connection.isupport.append(list(event['params'][1:-1]))
+        connection.update_features()
+
+    # start sending queued lines and join our channels once we've registered
+    def handle_reactor_ready(self, event):
+        self.connections[event['server'].name].registered()
 
     # VERSION and such
     def handle_reactor_ctcp(self, event):
+        sendq = self.connections[event['server'].name].sendq
+        nick = event['source'].nick
         if event['ctcp_verb'] == 'version':
-            event['source'].ctcp_reply('VERSION', 'Itabashi (板橋)/{}'.format(itabashi.__version__))
+            sendq.ctcp_reply(nick, 'VERSION', 'Itabashi (板橋)/{}'.format(itabashi.__version__))
         elif event['ctcp_verb'] == 'source':
-            event['source'].ctcp_reply('SOURCE', 'https://github.com/bibanon/itabashi')
+            sendq.ctcp_reply(nick, 'SOURCE', 'https://github.com/bibanon/itabashi')
         elif event['ctcp_verb'] == 'clientinfo':
-            event['source'].ctcp_reply('CLIENTINFO', 'ACTION CLIENTINFO SOURCE VERSION')
+            sendq.ctcp_reply(nick, 'CLIENTINFO', 'ACTION CLIENTINFO SOURCE VERSION')
 
     # dispatching messages
     def handle_reactor_pubmsgs(self, event):
+        # girc escapes messages, but not the text of the CTCPs actions are
+        self.dispatch_public(event, MESSAGE, unescape(event['message']))
+
+    def handle_reactor_pubactions(self, event):
+        self.dispatch_public(event, ACTION, event['message'])
+
+    def dispatch_public(self, event, kind, formatted):
+        """Dispatch a channel message, whose text with its raw IRC formatting is ``formatted``."""
+        received = time.monotonic()
         if event['source'].is_me:
             return
-        if event['target'].name in self.dispatch_channels:
-            info = {
-                'type': 'message',
-                'service': 'irc',
-                'channel': event['channel'],
-                'source': event['source'],
-                'message': remove_formatting_codes(event['message']),
-            }
+        network = self.connections[event['server'].name].network
+        # our other connections to this network may share a channel while it's being moved
+        if event['source'].nick.lower() in network.nicks():
+            return
+
+        channel = (network.name, event['target'].name)
+        links = self.router.links_for('irc', channel)
+        if not links:
+            return
 
-            self.events.dispatch('irc message', info)
+        message = strip_irc_formatting(formatted)
+        msgid = (event.get('tags') or {}).get('msgid')
+        if self.dedupe.is_repeat(links, 'irc', event['source'].nick, message, message_id=msgid):
+            return
 
-    def handle_reactor_pubactions(self, event):
-        if event['source'].is_me:
+        relayed = RelayMessage('irc', kind, links, event['target'].name, event['source'].nick, message,
+                               formatted, received, network=network.name)
+        if self.admission.admit(relayed) == ADMITTED:
+            self.dispatch_message(relayed)
+
+    def dispatch_message(self, message):
+        network = self.networks.get(message.network)
+        if network is not None:
+            network.traffic[self.router.key('irc', (message.network, message.channel))] += 1
+        self.metrics.received(message.links, 'irc')
+        self.events.dispatch(RELAY_EVENTS[message.kind], message)
+
+    # dispatching presence. members are only followed in linked channels, and
+    #   names replies tell us who was there before us
+    def presence_connection(self, event):
+        if not self.relay_presence:
+            return None
+        return self.connections.get(event['server'].name)
+
+    def linked_keys(self, connection, channels):
+        keys = [self.router.key('irc', (connection.network.name, name)) for name in channels]
+        return [key for key in keys if self.router.is_linked('irc', key)]
+
+    def is_bridge(self, connection, nick):
+        return nick.lower() in connection.network.nicks()
+
+    def handle_reactor_names(self, event):
+        connection = self.presence_connection(event)
+        keys = self.linked_keys(connection, [event['channel'].name]) if connection is not None else None
+        if not keys:
+            return
+        for user in event.get('users') or ():
+            connection.members.setdefault(user.nick.lower(), set()).add(keys[0])
+
+    def handle_reactor_join(self, event):
+        connection = self.presence_connection(event)
+        if connection is None or self.is_bridge(connection, event['source'].nick):
+            return
+        keys = self.linked_keys(connection, [channel.name for channel in event['channels']])
+        if keys:
+            nick = event['source'].nick
+            connection.members.setdefault(nick.lower(), set()).update(keys)
+            self.dispatch_presence(connection, presence.JOIN, nick, keys)
+
+    def handle_reactor_part(self, event):
+        connection = self.presence_connection(event)
+        if connection is None:
+            return
+        self.left(connection, event['source'].nick, [channel.name for channel in event['channels']])
+
+    def handle_reactor_kick(self, event):
+        # girc gives the channel as 'user' and the kicked nick as 'message',
+        #   so we go by the params, which are the channel and the nick
+        connection = self.presence_connection(event)
+        params = event.get('params') or ()
+        if connection is not None and len(params) > 1:
+            self.left(connection, params[1], [params[0]])
+
+    def left(self, connection, nick, channels):
+        keys = self.linked_keys(connection, channels)
+        if not keys:
+            return
+        if self.is_bridge(connection, nick):
+            # we're not in these channels any more, so we can't follow anyone in them
+            for nick in list(connection.members):
+                connection.members[nick].difference_update(keys)
+                if not connection.members[nick]:
+                    del connection.members[nick]
+            return
+        joined = connection.members.get(nick.lower())
+        if joined is not None:
+            joined.difference_update(keys)
+            if not joined:
+                del connection.members[nick.lower()]
+        self.dispatch_presence(connection, presence.PART, nick, keys)
+
+    def handle_reactor_quit(self, event):
+        connection = self.presence_connection(event)
+        if connection is None or self.is_bridge(connection, event['source'].nick):
+            return
+        nick = event['source'].nick
+        keys = connection.members.pop(nick.lower(), None)
+        if keys:
+            reason = event.get('message')
+            if reason:
+                reason = strip_irc_formatting(unescape(reason))
+            self.dispatch_presence(connection, presence.QUIT, nick, list(keys), reason)
+
+    def handle_reactor_nick(self, event):
+        connection = self.presence_connection(event)
+        if connection is None or self.is_bridge(connection, event['source'].nick) or not event.get('new_nick'):
             return
-        if event['target'].name in self.dispatch_channels:
-            info = {
-                'type': 'message',
-                'service': 'irc',
-                'channel': event['channel'],
-                'source': event['source'],
-                'message': remove_formatting_codes(event['message']),
-            }
+        nick = event['source'].nick
+        keys = connection.members.pop(nick.lower(), None)
+        if keys:
+            connection.members[event['new_nick'].lower()] = keys
+            self.dispatch_presence(connection, presence.NICK, nick, list(keys), event['new_nick'])
 
-            self.events.dispatch('irc action', info)
+    def dispatch_presence(self, connection, kind, nick, keys, detail=None):
+        self.events.dispatch('irc presence', {
+            'type': 'presence',
+            'service': 'irc',
+            'network': connection.network.name,
+            'channels': keys,
+            'kind': kind,
+            'nick': nick,
+            'detail': detail,
+        })
 
     # receiving messages
     def handle_discord_ready(self, event):
         # don't actually dispatch messages here because that would be spammy
         #   and very, very annoying after a while
         return
-        for channel in self.dispatch_channels:
-            self.irc.msg(channel, 'Discord attached')
+        for network, channel in self.router.channels.get('irc', ()):
+            if network in self.networks:
+                self.networks[network].send(channel, 'Discord attached')
 
     def handle_discord_disconnected(self, event):
-        for channel in self.dispatch_channels:
-            self.irc.msg(channel, 'Discord disconnected')
+        # messages for discord are held until it's back, so there's nothing
+        #   to tell our channels
+        self.logger.info('irc: discord disconnected, holding messages for it')
+
+    def handle_discord_message(self, message):
+        self.dedupe.record_relayed(message.links, message.text)
+        prefix = irc_prefix(message.author, message.discriminator)
+        self.relay_discord(message.channel, prefix, message.formatted, message.received, message.message_id)
+
+    def handle_discord_correction(self, event):
+        # edits and deletions of relayed messages, as a short line saying what changed
+        source = event['source']
+        prefix = irc_prefix(source.name, source.discriminator) if source is not None else ''
+        self.relay_discord(event['channel'].id, prefix, event['correction'])
+
+    def relay_discord(self, channel_id, prefix, text, received=None, message_id=None):
+        if self.held is not None:
+            # another process has our connections, or is taking them
+            self.held.append((time.time(), channel_id, prefix, text, received, message_id))
+            return
+        if message_id is not None:
+            self.relayed[channel_id] = message_id
+        prefix_bytes = len(prefix.encode('utf-8'))
+        for network_name, chan in self.router.destinations('discord', channel_id, 'irc'):
+            network = self.networks.get(network_name)
+            if network is None:
+                continue
+            # long and multi-line messages are split, with each line keeping
+            #   the prefix. lines for a channel that doesn't have a connection
+            #   yet are held by the network until it does
+            lines = split_message(text, network.text_bytes(chan) - prefix_bytes)
+            for i, line in enumerate(lines):
+                # only the last line carries the receive time, so the message
+                #   is counted once it's been sent in full
+                network.send(chan, prefix + line, received=received if i == len(lines) - 1 else None)
 
-    def handle_discord_message(self, event):
-        assembled_message = '$c[grey]<$r$b{}$b$c[grey]#{}>$r {}'.format(escape(event['source'].name), escape(event['source'].discriminator), escape(event['message']))
-        for chan in self.channels['discord'].get(event['channel'].name, []):
-            self.irc.msg(chan, assembled_message)
+    def handle_line_sent(self, network, verb, params, received):
+        if self.capture is not None and verb == 'PRIVMSG':
+            self.capture.irc_out(network, params[0], params[1])
+        if received is not None:
+            self.metrics.sent(self.router.links_for('irc', (network, params[0])), 'irc', received)
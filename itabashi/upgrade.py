@@ -0,0 +1,234 @@
+# handing our IRC connections to a new process, so we can be upgraded
+#   without reconnecting to IRC
+import array
+import asyncio
+import json
+import os
+import socket
+import struct
+
+HANDOVER_VERSION = 1
+
+REQUEST = b'itabashi upgrade\n'
+ACCEPTED = b'ok\n'
+
+# the length of the state that follows, and how many sockets came with it
+_header = struct.Struct('!II')
+
+# the most file descriptors linux passes in one message
+MAX_SOCKETS = 253
+
+
+def _read_line(sock):
+    line = b''
+    while not line.endswith(b'\n'):
+        data = sock.recv(64)
+        if not data:
+            break
+        line += data
+    return line
+
+
+def _read_exactly(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(min(length - len(data), 65536))
+        if not chunk:
+            raise ValueError('the handover was cut short')
+        data += chunk
+    return bytes(data)
+
+
+def send_handover(sock, state, sockets):
+    """Send our state, and the sockets it refers to, down a Unix socket."""
+    data = json.dumps(dict(state, version=HANDOVER_VERSION), ensure_ascii=False).encode('utf-8')
+    fds = array.array('i', [handed.fileno() for handed in sockets])
+    ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)] if fds else []
+    sock.sendmsg([_header.pack(len(data), len(fds))], ancillary)
+    sock.sendall(data)
+
+
+def receive_handover(sock):
+    """Returns the state and sockets sent with :func:`send_handover`."""
+    fds = array.array('i')
+    header, ancillary, flags, _ = sock.recvmsg(_header.size, socket.CMSG_SPACE(MAX_SOCKETS * fds.itemsize))
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+
+    try:
+        if len(header) < _header.size or flags & socket.MSG_CTRUNC:
+            raise ValueError('the handover was cut short')
+        length, count = _header.unpack(header)
+        if count != len(sockets):
+            raise ValueError('expected {} sockets but got {}'.format(count, len(sockets)))
+        state = json.loads(_read_exactly(sock, length).decode('utf-8'))
+        if state.get('version') != HANDOVER_VERSION:
+            raise ValueError('the running process hands over state this version of Itabashi can\'t read')
+    except Exception:
+        for handed in sockets:
+            handed.close()
+        raise
+    return state, sockets
+
+
+def request_handover(path, timeout=30.0):
+    """Ask the process listening on ``path`` to hand over its IRC connections.
+
+    Returns the state and sockets it handed over. Once this returns, the
+    connections are ours, and the other process is on its way out.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    with sock:
+        sock.connect(path)
+        sock.sendall(REQUEST)
+        state, sockets = receive_handover(sock)
+        try:
+            sock.sendall(ACCEPTED)
+        except OSError:
+            for handed in sockets:
+                handed.close()
+            raise
+    return state, sockets
+
+
+@asyncio.coroutine
+def take_over(logger, bridge, path, timeout=30.0):
+    """Take over the IRC connections of the process listening on ``path``.
+
+    We wait until we're connected to Discord first, since the other process
+    relays Discord's messages to IRC until it hands over. If there's no
+    process to take over from, we connect to IRC as usual. Returns True if
+    we took over.
+    """
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not bridge.discord.connected and loop.time() < deadline:
+        yield from asyncio.sleep(0.1)
+
+    try:
+        state, sockets = yield from loop.run_in_executor(None, request_handover, path, timeout)
+    except (OSError, ValueError) as exc:
+        logger.warning('upgrade: could not take over from %s, connecting to IRC instead: %s', path, exc)
+        bridge.irc.start()
+        return False
+    logger.info('upgrade: took over %s IRC connections from %s', len(sockets), path)
+    bridge.irc.adopt(state['irc'], sockets)
+    return True
+
+
+class UpgradeServer:
+    """Hands our IRC connections over to a new process started with ``startlink.py upgrade``.
+
+    We listen on a Unix socket that only our user can connect to. When a
+    new process asks, we stop reading from IRC and relay whatever's
+    already on its way there, then send the new process the sockets of our
+    registered IRC connections along with their state, such as our nick,
+    the channels we're in, ISUPPORT, the lines waiting to be sent and the
+    last message we relayed from each Discord channel. Once
+    it has them, we quit any connections that couldn't be handed over,
+    such as TLS ones, send what's left for Discord, and call
+    ``on_handover``. If the handover fails, we carry on as we were.
+
+    Parameters
+    ----------
+    logger
+        Logger to report handovers to.
+    bridge : Bridge
+        The bridge whose connections we hand over.
+    path : str
+        Path of the Unix socket to listen on.
+    on_handover
+        Function called once a new process has taken over, which should stop us.
+    timeout : float
+        Seconds to wait for the new process at each step, and to spend
+        sending what's left for Discord. Defaults to 10.
+    """
+
+    def __init__(self, logger, bridge, path, on_handover, *, timeout=10.0):
+        self.logger = logger
+        self.bridge = bridge
+        self.path = path
+        self.on_handover = on_handover
+        self.timeout = timeout
+        self.sock = None
+        self._busy = False
+
+    def start(self):
+        # a process that's gone away leaves its socket behind, and a process
+        #   we've just taken over from has already stopped listening on it
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(1)
+        sock.setblocking(False)
+        self.sock = sock
+        asyncio.get_event_loop().add_reader(sock.fileno(), self._accept)
+
+    def close(self):
+        if self.sock is not None:
+            asyncio.get_event_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+
+    def _accept(self):
+        try:
+            conn, _ = self.sock.accept()
+        except OSError:
+            return
+        if self._busy:
+            conn.close()
+            return
+        asyncio.ensure_future(self.hand_over(conn))
+
+    @asyncio.coroutine
+    def hand_over(self, conn):
+        loop = asyncio.get_event_loop()
+        bridge = self.bridge
+        self._busy = True
+        conn.setblocking(True)
+        conn.settimeout(self.timeout)
+        try:
+            request = yield from loop.run_in_executor(None, _read_line, conn)
+            if request != REQUEST:
+                self.logger.warning('upgrade: ignoring unknown request %r', request)
+                return
+
+            # whatever's already on its way to IRC goes with the connections
+            self.logger.info('upgrade: handing our IRC connections over to a new process')
+            yield from self._settle(lambda: bridge.events.depth)
+            state, sockets = bridge.irc.prepare_handover(MAX_SOCKETS)
+            try:
+                yield from loop.run_in_executor(None, send_handover, conn, {'irc': state}, sockets)
+                reply = yield from loop.run_in_executor(None, _read_line, conn)
+            except (OSError, ValueError) as exc:
+                reply = None
+                self.logger.warning('upgrade: handover failed: %s', exc)
+            if reply != ACCEPTED:
+                self.logger.warning('upgrade: the new process did not take over, carrying on')
+                bridge.irc.cancel_handover()
+                return
+        finally:
+            conn.close()
+            self._busy = False
+
+        self.close()
+        bridge.irc.complete_handover('Upgrading')
+        self.logger.info('upgrade: handed over %s IRC connections, sending what is left for Discord', len(sockets))
+        yield from self._settle(lambda: bridge.events.depth + bridge.discord.queue_depth)
+        self.on_handover()
+
+    @asyncio.coroutine
+    def _settle(self, depth):
+        deadline = asyncio.get_event_loop().time() + self.timeout
+        while depth() and asyncio.get_event_loop().time() < deadline:
+            yield from asyncio.sleep(0.1)
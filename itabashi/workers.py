@@ -0,0 +1,425 @@
+# running links across several worker processes
+import asyncio
+import copy
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from italib.backoff import ExponentialBackoff
+from italib.logs import start_logging
+from italib.profiling import Profiler
+from italib.routing import DEFAULT_NETWORK, LinkRouter
+
+from .bridge import Bridge
+
+
+def partition_links(links, count, previous=None):
+    """Split links into ``count`` shards of roughly the same size.
+
+    Links that share a channel are always put in the same shard, since a
+    channel joined from two processes would have its messages relayed
+    twice. If the ``previous`` shards are given, groups of links stay in
+    the shard most of them were already in, so reloading the config doesn't
+    move links between workers. Returns a list of ``links`` dicts, some of
+    which may be empty.
+    """
+    router = LinkRouter(links)
+
+    # union-find over links, joining any two that share a channel
+    parent = {name: name for name in links}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    owners = {}
+    for name in sorted(links):
+        for service, chans in links[name]['channels'].items():
+            if not chans:
+                continue
+            if not isinstance(chans, (list, tuple)):
+                chans = [chans]
+            for chan in chans:
+                if service == 'irc':
+                    chan = (links[name].get('network', DEFAULT_NETWORK), chan)
+                key = (service, router.key(service, chan))
+                if key in owners:
+                    parent[find(name)] = find(owners[key])
+                else:
+                    owners[key] = name
+
+    groups = {}
+    for name in sorted(links):
+        groups.setdefault(find(name), []).append(name)
+
+    shards = [{} for _ in range(count)]
+    placed = set()
+    for group in groups.values():
+        votes = [sum(name in old for name in group) for old in (previous or [])[:count]]
+        if votes and max(votes):
+            shard = shards[votes.index(max(votes))]
+            for name in group:
+                shard[name] = links[name]
+            placed.add(group[0])
+
+    # biggest groups first, each onto the emptiest shard
+    for group in sorted(groups.values(), key=lambda group: (-len(group), group[0])):
+        if group[0] in placed:
+            continue
+        shard = min(shards, key=len)
+        for name in group:
+            shard[name] = links[name]
+
+    return shards
+
+
+def worker_config(config, links, shard):
+    """Returns the config a worker runs with."""
+    config = copy.deepcopy(config)
+    config['links'] = links
+
+    # every worker has its own IRC connection, so each needs its own nick
+    if shard:
+        irc_config = config['modules']['irc']
+        for network in [irc_config] + list(irc_config.get('networks', {}).values()):
+            if 'nickname' in network:
+                network['nickname'] = '{}{}'.format(network['nickname'], shard)
+        # and its own message map, since sqlite files are best kept to one process
+        discord_config = config['modules']['discord']
+        if discord_config.get('message_map_file'):
+            discord_config['message_map_file'] = '{}.{}'.format(discord_config['message_map_file'], shard)
+
+        # every worker also has its own gateway session. gateway shards split
+        #   guilds, but workers split links by channel and we don't know which
+        #   guild each channel is in, so each worker sees every guild, and
+        #   drops the events for other workers' channels as they arrive.
+        #   workers identify in turn, as discord asks
+        identifies = max(discord_config.get('shards', 1), 1)
+        discord_config['identify_delay'] = (discord_config.get('identify_delay', 0) +
+                                            shard * identifies * discord_config.get('identify_interval', 5.0))
+
+    return config
+
+
+def run_worker(config, shard, options, conn, control=None):
+    """Entry point for worker processes.
+
+    Runs a :class:`~itabashi.bridge.Bridge` for the given config, sending
+    a health report down ``conn`` every ``health_interval`` seconds and
+    reloading with each new config sent down ``control``. Exits if the
+    supervisor goes away.
+    """
+    start_logging('{}.{}'.format(options['log'], shard), options['log_level'],
+                  raw_rate=options['raw_rate'], raw_sample=options['raw_sample'])
+    logger = logging
+    logger.info('Worker %s started with %s links', shard, len(config['links']))
+
+    loop = asyncio.get_event_loop()
+    bridge = Bridge(logger, config)
+    bridge.metrics.start_loop_monitor()
+
+    profile = options.get('profile')
+    if profile is not None:
+        # each worker writes its snapshots to its own directory
+        if profile.get('directory'):
+            profile = dict(profile, directory=os.path.join(profile['directory'], 'worker-{}'.format(shard)))
+        profiler = Profiler(logger, **profile)
+        profiler.instrument(bridge.events)
+        profiler.start()
+    if options.get('capture'):
+        bridge.start_capture('{}.{}'.format(options['capture'], shard))
+
+    supervisor = os.getppid()
+    interval = options.get('health_interval', 5.0)
+
+    def report():
+        if os.getppid() != supervisor:
+            logger.warning('Worker %s lost its supervisor, exiting', shard)
+            loop.stop()
+            return
+        health = bridge.health()
+        health['shard'] = shard
+        try:
+            conn.send(health)
+        except (BrokenPipeError, EOFError, OSError):
+            loop.stop()
+            return
+        loop.call_later(interval, report)
+
+    def receive():
+        try:
+            while control.poll():
+                bridge.reload(control.recv())
+        except (EOFError, OSError):
+            loop.remove_reader(control.fileno())
+
+    if control is not None:
+        loop.add_reader(control.fileno(), receive)
+
+    report()
+    loop.run_forever()
+
+
+class _Worker:
+    __slots__ = ('shard', 'config', 'process', 'conn', 'control', 'backoff', 'health', 'last_seen',
+                 'restarts', 'restart_handle', 'retired')
+
+    def __init__(self, shard, config):
+        self.shard = shard
+        self.config = config
+        self.process = None
+        self.conn = None
+        self.control = None
+        self.backoff = ExponentialBackoff()
+        self.health = {}
+        self.last_seen = 0
+        self.restarts = 0
+        self.restart_handle = None
+        self.retired = False
+
+
+class Supervisor:
+    """Runs links across several worker processes, and keeps them running.
+
+    Links are split between workers with :func:`partition_links`, and each
+    worker runs its own IRC and Discord modules for its shard. Workers that
+    die are restarted after an :class:`~italib.backoff.ExponentialBackoff`
+    delay, and workers that stop sending health reports for
+    ``health_timeout`` seconds are killed and restarted. :meth:`reload`
+    hands each worker its share of a new config without restarting it.
+
+    Parameters
+    ----------
+    logger
+        Logger to report worker problems to.
+    config : dict
+        The full config, whose links are split between the workers.
+    count : int
+        Number of workers to run. Shards that end up with no links don't
+        get a worker.
+    options : dict
+        Passed to :func:`run_worker`, with the ``log``, ``log_level``,
+        ``raw_rate`` and ``raw_sample`` logging options, and optionally
+        ``profile``, the arguments to start a
+        :class:`~italib.profiling.Profiler` with, and ``capture``, the path
+        each worker captures its traffic to with its shard number appended.
+    health_interval : float
+        How often workers send health reports. Defaults to 5 seconds.
+    health_timeout : float
+        How long a worker may go without reporting. Defaults to 30 seconds.
+    """
+
+    def __init__(self, logger, config, count, options, *, health_interval=5.0, health_timeout=30.0):
+        self.logger = logger
+        self.options = dict(options, health_interval=health_interval)
+        self.health_timeout = health_timeout
+        self.count = count
+        self.stopping = False
+        self._metrics = None
+
+        # workers are spawned rather than forked so they don't inherit our event loop
+        self._context = multiprocessing.get_context('spawn')
+        self._check_handle = None
+
+        self.workers = []
+        for shard, links in enumerate(partition_links(config['links'], count)):
+            if links:
+                self.workers.append(_Worker(shard, worker_config(config, links, shard)))
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        self._schedule_check()
+
+    def reload(self, config):
+        """Split the links of a new config between the workers, and send each its share.
+
+        Links stay on the worker they were already on. Workers are started
+        for shards that gain their first links, and stopped for shards that
+        lose all of theirs.
+        """
+        workers = {worker.shard: worker for worker in self.workers}
+        previous = [workers[shard].config['links'] if shard in workers else {} for shard in range(self.count)]
+
+        for shard, links in enumerate(partition_links(config['links'], self.count, previous=previous)):
+            worker = workers.get(shard)
+            new_config = worker_config(config, links, shard)
+            if worker is None:
+                if links:
+                    worker = _Worker(shard, new_config)
+                    self.workers.append(worker)
+                    self._watch(worker)
+                    self._spawn(worker)
+            elif not links:
+                self.logger.info('supervisor: worker %s has no links left, stopping it', shard)
+                self._retire(worker)
+            elif new_config != worker.config:
+                worker.config = new_config
+                if worker.control is not None:
+                    try:
+                        worker.control.send(new_config)
+                    except OSError:
+                        # it's exiting, and will be restarted with the new config
+                        pass
+        self.workers.sort(key=lambda worker: worker.shard)
+
+    def _retire(self, worker):
+        worker.retired = True
+        self.workers.remove(worker)
+        if worker.restart_handle is not None:
+            worker.restart_handle.cancel()
+        if worker.process is not None and worker.process.is_alive():
+            worker.process.terminate()
+
+    def stop(self, timeout=5.0):
+        """Stop every worker, waiting up to ``timeout`` seconds for them to exit."""
+        self.stopping = True
+        loop = asyncio.get_event_loop()
+        if self._check_handle is not None:
+            self._check_handle.cancel()
+
+        for worker in self.workers:
+            if worker.restart_handle is not None:
+                worker.restart_handle.cancel()
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    os.kill(worker.process.pid, signal.SIGKILL)
+                self._forget(loop, worker)
+
+    def _spawn(self, worker):
+        worker.restart_handle = None
+        if self.stopping:
+            return
+
+        receiver, sender = self._context.Pipe(duplex=False)
+        control_receiver, control_sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(target=run_worker, name='itabashi-worker-{}'.format(worker.shard),
+                                        args=(worker.config, worker.shard, self.options, sender, control_receiver),
+                                        daemon=True)
+        process.start()
+        sender.close()
+        control_receiver.close()
+
+        worker.process = process
+        worker.conn = receiver
+        worker.control = control_sender
+        worker.last_seen = time.monotonic()
+
+        loop = asyncio.get_event_loop()
+        loop.add_reader(receiver.fileno(), self._receive, worker)
+        loop.add_reader(process.sentinel, self._exited, worker)
+
+        self.logger.info('supervisor: started worker %s (pid %s) with %s links',
+                         worker.shard, process.pid, len(worker.config['links']))
+
+    def _forget(self, loop, worker):
+        if worker.conn is not None:
+            loop.remove_reader(worker.conn.fileno())
+            worker.conn.close()
+            worker.conn = None
+        if worker.control is not None:
+            worker.control.close()
+            worker.control = None
+        if worker.process is not None:
+            loop.remove_reader(worker.process.sentinel)
+
+    def _receive(self, worker):
+        try:
+            while worker.conn.poll():
+                worker.health = worker.conn.recv()
+                worker.last_seen = time.monotonic()
+        except (EOFError, OSError):
+            # the worker's gone, which _exited deals with
+            asyncio.get_event_loop().remove_reader(worker.conn.fileno())
+
+    def _exited(self, worker):
+        loop = asyncio.get_event_loop()
+        self._forget(loop, worker)
+        worker.process.join()
+        if self.stopping or worker.retired:
+            return
+
+        delay = worker.backoff.delay()
+        worker.restarts += 1
+        self.logger.warning('supervisor: worker %s (pid %s) exited with %s, restarting in %.1fs',
+                            worker.shard, worker.process.pid, worker.process.exitcode, delay)
+        worker.process = None
+        worker.restart_handle = loop.call_later(delay, self._spawn, worker)
+
+    def _schedule_check(self):
+        self._check_handle = asyncio.get_event_loop().call_later(
+            self.options['health_interval'], self._check)
+
+    def _check(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.process is None or not worker.process.is_alive():
+                continue
+            if now - worker.last_seen > self.health_timeout:
+                self.logger.warning('supervisor: worker %s (pid %s) has not reported for %.0fs, killing it',
+                                    worker.shard, worker.process.pid, now - worker.last_seen)
+                worker.process.terminate()
+        self._schedule_check()
+
+    # health
+    def alive(self, worker):
+        return (worker.process is not None and worker.process.is_alive() and
+                time.monotonic() - worker.last_seen <= self.health_timeout)
+
+    def status(self):
+        """Returns the health of every worker, and totals across them."""
+        workers = {}
+        totals = dict(workers=len(self.workers), alive=0, restarts=0, received=0, sent=0, links=0)
+        for worker in self.workers:
+            alive = self.alive(worker)
+            workers[worker.shard] = dict(worker.health, alive=alive, restarts=worker.restarts,
+                                         last_seen=time.monotonic() - worker.last_seen)
+            totals['alive'] += alive
+            totals['restarts'] += worker.restarts
+            totals['received'] += worker.health.get('received', 0)
+            totals['sent'] += worker.health.get('sent', 0)
+            totals['links'] += len(worker.config['links'])
+        return {'totals': totals, 'workers': workers}
+
+    def register_metrics(self, registry):
+        """Report worker health through the given metrics registry."""
+        up = registry.gauge('itabashi_worker_up', 'Whether each worker is running and reporting.', ['shard'])
+        restarts = registry.counter('itabashi_worker_restarts_total', 'Times each worker has been restarted.',
+                                    ['shard'])
+        age = registry.gauge('itabashi_worker_last_report_seconds', 'Seconds since each worker last reported.',
+                             ['shard'])
+        received = registry.counter('itabashi_messages_received_total',
+                                    'Messages received and dispatched, by worker.', ['shard'])
+        sent = registry.counter('itabashi_messages_sent_total', 'Messages relayed, by worker.', ['shard'])
+        depth = registry.gauge('itabashi_send_queue_depth', 'Messages waiting in the outbound queues.',
+                               ['shard', 'service'])
+        lag = registry.gauge('itabashi_event_loop_lag_seconds', 'Event loop lag reported by each worker.',
+                             ['shard'])
+        self._metrics = (up, restarts, age, received, sent, depth, lag)
+
+        for worker in self.workers:
+            self._watch(worker)
+
+    def _watch(self, worker):
+        if self._metrics is None:
+            return
+        up, restarts, age, received, sent, depth, lag = self._metrics
+        shard = worker.shard
+        up.labels(shard).set_function(lambda: int(self.alive(worker)))
+        restarts.labels(shard).set_function(lambda: worker.restarts)
+        age.labels(shard).set_function(lambda: time.monotonic() - worker.last_seen)
+        received.labels(shard).set_function(lambda: worker.health.get('received', 0))
+        sent.labels(shard).set_function(lambda: worker.health.get('sent', 0))
+        lag.labels(shard).set_function(lambda: worker.health.get('loop_lag', 0))
+        for service in ('irc', 'discord'):
+            depth.labels(shard, service).set_function(
+                lambda service=service: worker.health.get('queue_depth', {}).get(service, 0))
@@ -0,0 +1,241 @@
+# keeping one flooding author from holding up a whole link
+import asyncio
+import collections
+import time
+
+from .formatting import GREY, RESET
+from .relay import MESSAGE, RelayMessage
+
+# what happens to messages over the limit
+THROTTLE = 'throttle'
+SUMMARIZE = 'summarize'
+DROP = 'drop'
+POLICIES = (THROTTLE, SUMMARIZE, DROP)
+
+# what happened to a message
+ADMITTED = 'admitted'
+HELD = 'held'
+DROPPED = 'dropped'
+
+
+def admission_options(config):
+    """Returns the :class:`AdmissionControl` options a config asks for.
+
+    Flood control is off unless the config has an ``admission`` section,
+    so upgrading doesn't change how existing links relay.
+    """
+    options = config.get('admission')
+    if options is None:
+        return {'limit': 0}
+    return options
+
+
+class _Window:
+    """A sliding-window count of one author's messages in one channel.
+
+    The window is estimated from counts of the current and previous fixed
+    windows, weighting the previous by how much of it the sliding window
+    still covers, which takes a few numbers per author however many
+    messages they send.
+    """
+
+    __slots__ = ('start', 'current', 'previous', 'last', 'flooding', 'held', 'release', 'dropped', 'sample',
+                 'handle')
+
+    def __init__(self, now):
+        self.start = now
+        self.current = 0
+        self.previous = 0
+        self.last = now
+        self.flooding = False
+        # messages waiting to be released, and when the next may be
+        self.held = 0
+        self.release = now
+        # messages dropped since the last summary, and the last of them
+        self.dropped = 0
+        self.sample = None
+        self.handle = None
+
+    def count(self, now, per):
+        elapsed = now - self.start
+        if elapsed >= per:
+            self.previous = self.current if elapsed < 2 * per else 0
+            self.current = 0
+            self.start += per * (elapsed // per)
+        return self.previous * (1 - (now - self.start) / per) + self.current
+
+    @property
+    def busy(self):
+        return bool(self.held) or self.handle is not None
+
+
+class AdmissionControl:
+    """Limits how fast each author's messages are let into each link.
+
+    Each author in each channel may send ``limit`` messages in any
+    ``per`` seconds. What happens to their messages beyond that depends on
+    ``policy``:
+
+    ``throttle``
+        Messages are held, and let through in order at the allowed rate.
+        Once an author has ``max_held`` messages held, more are dropped.
+    ``summarize``
+        Messages are dropped, and a line saying how many were is let
+        through in their place every ``per`` seconds while they are.
+    ``drop``
+        Messages are dropped.
+
+    Counts are kept for at most ``max_authors`` authors, least recently
+    active first, and authors are forgotten once they've been idle for
+    ``idle`` seconds, so memory is bounded however many people talk.
+
+    Parameters
+    ----------
+    logger
+        Logger to report flooding authors to.
+    dispatch
+        Function called with the messages that are let through later, and
+        with summaries.
+    metrics : RelayMetrics
+        Optional metrics to count held, dropped and summarized messages in.
+    limit : int
+        Messages each author may send per ``per`` seconds, 0 to let every
+        message through. Defaults to 10.
+    per : float
+        Length of the sliding window in seconds. Defaults to 10.
+    policy : str
+        ``throttle``, ``summarize`` or ``drop``. Defaults to ``throttle``.
+    max_held : int
+        Most messages held for each author. Defaults to 50.
+    max_authors : int
+        Most authors counted at once. Defaults to 10000.
+    idle : float
+        Seconds after which a quiet author is forgotten. Defaults to 300.
+    """
+
+    def __init__(self, logger, dispatch, metrics=None, *, limit=10, per=10.0, policy=THROTTLE, max_held=50,
+                 max_authors=10000, idle=300.0):
+        if policy not in POLICIES:
+            raise ValueError('admission policy must be one of {}, not {}'.format(', '.join(POLICIES), policy))
+        self.logger = logger
+        self.dispatch = dispatch
+        self.metrics = metrics
+        self.limit = limit
+        self.per = per
+        self.policy = policy
+        self.max_held = max_held
+        self.max_authors = max_authors
+        self.idle = max(idle, 2 * per)
+
+        # (service, network, channel, author) -> _Window, least recently active first
+        self._windows = collections.OrderedDict()
+
+        # (service, network, channel, author) -> messages held back or dropped
+        self.flooders = collections.Counter()
+        self.held = 0
+        self.dropped = 0
+        self.summarized = 0
+
+    def __len__(self):
+        return len(self._windows)
+
+    @property
+    def stats(self):
+        return {
+            'authors': len(self._windows),
+            'held': self.held,
+            'dropped': self.dropped,
+            'summarized': self.summarized,
+            'flooders': ['{} in {}'.format(key[3], key[2]) for key, _ in self.flooders.most_common(10)],
+        }
+
+    def admit(self, message, author_id=None):
+        """Count a message against its author, returning what happened to it.
+
+        Returns :data:`ADMITTED` if it should be dispatched now,
+        :data:`HELD` if it will be passed to ``dispatch`` later, or
+        :data:`DROPPED`. Authors are told apart by ``author_id`` if it's
+        given, and by their name otherwise.
+        """
+        if not self.limit:
+            return ADMITTED
+        now = time.monotonic()
+        key = (message.service, message.network, message.channel, author_id or message.author.lower())
+        window = self._windows.get(key)
+        if window is None:
+            self._evict(now)
+            window = self._windows[key] = _Window(now)
+        else:
+            self._windows.move_to_end(key)
+        window.last = now
+
+        # later messages wait behind held ones, so they stay in order
+        if not window.held and window.count(now, self.per) < self.limit:
+            window.current += 1
+            window.flooding = False
+            return ADMITTED
+
+        if not window.flooding:
+            window.flooding = True
+            self.logger.warning('%s: %s is flooding %s, messages over %s per %ss are being %s', message.service,
+                                message.author, message.channel, self.limit, self.per,
+                                'held back' if self.policy == THROTTLE else 'dropped')
+
+        if self.policy == THROTTLE and window.held < self.max_held:
+            window.held += 1
+            window.release = max(window.release, now) + self.per / self.limit
+            asyncio.get_event_loop().call_later(window.release - now, self._release, window, message)
+            self._flooding(key, message, 'held')
+            self.held += 1
+            return HELD
+
+        window.dropped += 1
+        window.sample = message
+        self._flooding(key, message, 'dropped')
+        self.dropped += 1
+        if self.policy == SUMMARIZE and window.handle is None:
+            window.handle = asyncio.get_event_loop().call_later(self.per, self._summarize, window)
+        return DROPPED
+
+    def _flooding(self, key, message, action):
+        self.flooders[key] += 1
+        # only the worst flooders are remembered for long
+        if len(self.flooders) > 2 * self.max_authors:
+            self.flooders = collections.Counter(dict(self.flooders.most_common(self.max_authors)))
+        if self.metrics is not None:
+            self.metrics.flooded(message.links, message.service, action)
+
+    def _release(self, window, message):
+        window.held -= 1
+        # roll the window first, so a release after it has moved on counts
+        #   towards the window it happens in
+        window.count(time.monotonic(), self.per)
+        window.current += 1
+        self.dispatch(message)
+
+    def _summarize(self, window):
+        window.handle = None
+        count, message = window.dropped, window.sample
+        window.dropped, window.sample = 0, None
+        if not count:
+            return
+        text = 'sent {} more line{} that {} relayed'.format(count, 's' if count > 1 else '',
+                                                            "wasn't" if count == 1 else "weren't")
+        summary = RelayMessage(message.service, MESSAGE, message.links, message.channel, message.author,
+                               '({})'.format(text), '{}({}){}'.format(GREY, text, RESET), time.monotonic(),
+                               network=message.network, discriminator=message.discriminator)
+        self.summarized += 1
+        if self.metrics is not None:
+            self.metrics.flooded(message.links, message.service, 'summarized')
+        self.dispatch(summary)
+
+    def _evict(self, now):
+        # authors with messages still to let through or summarize keep their
+        #   window unless we're full. if they're evicted anyway, those are
+        #   still let through, just not counted against them
+        windows = self._windows
+        while windows:
+            key, window = next(iter(windows.items()))
+            if len(windows) < self.max_authors and (now - window.last < self.idle or window.busy):
+                break
+            del windows[key]
@@ -0,0 +1,387 @@
+# per-link message archive
+import asyncio
+import atexit
+import bisect
+import concurrent.futures
+import gzip
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+
+from .events import SPILL
+from .routing import DEFAULT_NETWORK
+
+# each index entry describes one batch: timestamp of its first record,
+#   byte offset of the batch in the uncompressed segment, and record count
+INDEX_ENTRY = struct.Struct('<dQI')
+
+
+def encode_record(record):
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class Segment:
+    """A single append-only segment of an archive, along with its index.
+
+    Segments are named after the millisecond timestamp they were started
+    at. Records are stored as JSON lines in ``<name>.log``, which becomes
+    ``<name>.log.gz`` once the segment is compressed. The index in
+    ``<name>.idx`` refers to offsets in the uncompressed data either way.
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.start = int(name) / 1000
+        self.log_path = os.path.join(directory, name + '.log')
+        self.gz_path = self.log_path + '.gz'
+        self.idx_path = os.path.join(directory, name + '.idx')
+
+        self.index = []
+        self.size = 0
+        self.count = 0
+        self.compressed = os.path.exists(self.gz_path) and not os.path.exists(self.log_path)
+
+    def load_index(self):
+        self.index = []
+        if os.path.exists(self.idx_path):
+            with open(self.idx_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            self.index = [entry for entry in INDEX_ENTRY.iter_unpack(data[:usable])]
+
+        self.count = sum(entry[2] for entry in self.index)
+
+        if self.compressed:
+            # compressed segments are never written to again
+            self.size = sys.maxsize
+        elif os.path.exists(self.log_path):
+            # drop any partially-written record from an unclean shutdown
+            with open(self.log_path, 'rb+') as f:
+                data = f.read()
+                self.size = data.rfind(b'\n') + 1
+                f.truncate(self.size)
+
+    def snapshot(self):
+        """Return a read-only copy of our state, for use outside the lock."""
+        copy = Segment.__new__(Segment)
+        copy.__dict__.update(self.__dict__)
+        copy.index = list(self.index)
+        return copy
+
+    def read(self, offset, end):
+        """Yield the records between the given offsets."""
+        if offset >= end:
+            return
+
+        if not self.compressed:
+            try:
+                with open(self.log_path, 'rb') as f:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        while offset < end:
+                            newline = data.find(b'\n', offset, end)
+                            if newline == -1:
+                                break
+                            yield json.loads(data[offset:newline].decode('utf-8'))
+                            offset = newline + 1
+                return
+            except FileNotFoundError:
+                # we've been compressed since our snapshot was taken
+                pass
+
+        with gzip.open(self.gz_path, 'rb') as f:
+            f.seek(offset)
+            while offset < end:
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                yield json.loads(line.decode('utf-8'))
+
+
+class LinkArchive:
+    """Archive of the messages relayed over a single link.
+
+    Batches of records are appended to the newest segment, and after each
+    batch an entry is appended to the segment's index. Once a segment grows
+    past ``segment_size`` bytes or ``segment_age`` seconds a new one is
+    started, and the old one is gzipped if ``compress`` is set.
+
+    The indexes are small enough to keep in memory, so queries only touch
+    the parts of the segments they need. Uncompressed segments are read
+    through mmap, and compressed ones by seeking in the gzip stream.
+
+    Appends are expected to come from a single writer thread, and queries
+    are safe to run from other threads at the same time.
+    """
+
+    def __init__(self, directory, name, *, segment_size=4 * 1024 * 1024,
+                 segment_age=24 * 60 * 60, compress=True):
+        self.name = name
+        self.directory = os.path.join(directory, name)
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.compress = compress
+
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.segments = []
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.endswith('.idx'):
+                segment = Segment(self.directory, filename[:-4])
+                segment.load_index()
+                self.segments.append(segment)
+
+    def _new_segment(self, now):
+        name = '{:015d}'.format(int(now * 1000))
+        segment = Segment(self.directory, name)
+        open(segment.idx_path, 'ab').close()
+        with self._lock:
+            self.segments.append(segment)
+
+        # compress previous segments that are still sitting around uncompressed
+        if self.compress:
+            for old in self.segments[:-1]:
+                if not old.compressed:
+                    self._compress(old)
+
+        return segment
+
+    def _compress(self, segment):
+        with open(segment.log_path, 'rb') as src, gzip.open(segment.gz_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        with self._lock:
+            segment.compressed = True
+        os.remove(segment.log_path)
+
+    def append(self, records):
+        """Append a batch of records to the archive."""
+        if not records:
+            return
+
+        data = b''.join(encode_record(record) for record in records)
+        now = records[0].get('t', time.time())
+
+        segment = self.segments[-1] if self.segments else None
+        if (segment is None or segment.compressed or
+                (segment.size and segment.size + len(data) > self.segment_size) or
+                now - segment.start > self.segment_age):
+            segment = self._new_segment(now)
+
+        with open(segment.log_path, 'ab') as f:
+            f.write(data)
+        entry = (now, segment.size, len(records))
+        with open(segment.idx_path, 'ab') as f:
+            f.write(INDEX_ENTRY.pack(*entry))
+
+        with self._lock:
+            segment.index.append(entry)
+            segment.size += len(data)
+            segment.count += len(records)
+
+    def _snapshot(self):
+        with self._lock:
+            return [segment.snapshot() for segment in self.segments]
+
+    def tail(self, count):
+        """Return the last ``count`` records, oldest first."""
+        results = []
+
+        for segment in reversed(self._snapshot()):
+            needed = count - len(results)
+            if needed <= 0:
+                break
+
+            # walk back through the batches until we have enough records
+            available = 0
+            offset = segment.size
+            for ts, batch_offset, batch_count in reversed(segment.index):
+                available += batch_count
+                offset = batch_offset
+                if available >= needed:
+                    break
+
+            records = list(segment.read(offset, segment.size))
+            results[:0] = records[-needed:]
+
+        return results
+
+    def between(self, start, end=None):
+        """Yield the records from ``start`` to ``end`` (unix timestamps), oldest first."""
+        if end is None:
+            end = time.time()
+
+        segments = self._snapshot()
+        for i, segment in enumerate(segments):
+            if segment.start > end:
+                break
+            if i + 1 < len(segments) and segments[i + 1].start <= start:
+                continue
+            if not segment.index:
+                continue
+
+            # records in the batch before the first one starting after
+            #   ``start`` may still be in range, so we start from there
+            timestamps = [entry[0] for entry in segment.index]
+            position = max(bisect.bisect_left(timestamps, start) - 1, 0)
+
+            for record in segment.read(segment.index[position][1], segment.size):
+                if record['t'] < start:
+                    continue
+                if record['t'] > end:
+                    return
+                yield record
+
+    def search(self, text, start=0, end=None):
+        """Yield the records between ``start`` and ``end`` mentioning ``text``."""
+        text = text.lower()
+        for record in self.between(start, end):
+            if text in record['m'].lower() or text in record['a'].lower():
+                yield record
+
+
+class Archiver:
+    """Archives messages on every link that has ``log`` enabled.
+
+    Listens to the message events dispatched by the IM modules, and buffers
+    records for each link. Buffers are written out on a background thread
+    every ``flush_interval`` seconds, or as soon as they hold ``batch_size``
+    records, so disk I/O never happens on the event loop.
+
+    Settings are read from the optional ``archive`` section of the config,
+    and :meth:`reload` applies new ones.
+    """
+
+    def __init__(self, logger, config, event_manager, router):
+        self.logger = logger
+        self.config = config
+        self.events = event_manager
+        self.router = router
+
+        self.apply_settings()
+
+        self.archives = {}
+        self._pending = {}
+        self._flush_handle = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self.update_links(config['links'])
+
+        # the archive should have every message, so bursts spill over rather
+        #   than being dropped
+        self.events.register('irc message', self.handle_irc_message, overflow=SPILL)
+        self.events.register('irc action', self.handle_irc_action, overflow=SPILL)
+        self.events.register('discord message', self.handle_discord_message, overflow=SPILL)
+
+        atexit.register(self.close)
+
+    def apply_settings(self):
+        archive_config = self.config.get('archive', {})
+        self.directory = archive_config.get('directory', 'archive')
+        self.flush_interval = archive_config.get('flush_interval', 2.0)
+        self.batch_size = archive_config.get('batch_size', 500)
+
+    def reload(self, config):
+        """Apply a new config in place.
+
+        Links start and stop being archived as their ``log`` settings
+        change. If the ``archive`` section has changed, what's buffered is
+        written out with the old settings, and every link's archive is
+        opened again with the new ones.
+        """
+        old = self.config.get('archive', {})
+        self.config = config
+        if config.get('archive', {}) != old:
+            self.flush()
+            self.archives.clear()
+            self.apply_settings()
+        self.update_links(config['links'])
+
+    def update_links(self, links):
+        """Start archiving links that have ``log`` enabled, and stop archiving those that don't."""
+        archive_config = self.config.get('archive', {})
+        for name, link in links.items():
+            if link.get('log') and name not in self.archives:
+                self.archives[name] = LinkArchive(
+                    self.directory, name,
+                    segment_size=archive_config.get('segment_size', 4 * 1024 * 1024),
+                    segment_age=archive_config.get('segment_age', 24 * 60 * 60),
+                    compress=archive_config.get('compress', True),
+                )
+        for name in [name for name in self.archives if not links.get(name, {}).get('log')]:
+            if name in self._pending:
+                self.flush(name)
+            del self.archives[name]
+
+    def record(self, service, channel, kind, author, message, network=None):
+        """Buffer a message for every logged link the channel belongs to.
+
+        IRC channels are looked up on the given ``network``, which is also
+        recorded if it isn't the default one.
+        """
+        ref = channel if network is None else (network, channel)
+        links = [name for name in self.router.links_for(service, ref) if name in self.archives]
+        if not links:
+            return
+
+        record = {
+            't': time.time(),
+            's': service,
+            'k': kind,
+            'c': channel,
+            'a': author,
+            'm': message,
+        }
+        if network is not None and network != DEFAULT_NETWORK:
+            record['n'] = network
+
+        for name in links:
+            pending = self._pending.setdefault(name, [])
+            pending.append(record)
+            if len(pending) >= self.batch_size:
+                self.flush(name)
+
+        if self._pending and self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self, name=None):
+        """Hand buffered records to the writer thread."""
+        if name is None:
+            self._flush_handle = None
+            names = list(self._pending)
+        else:
+            names = [name]
+
+        loop = asyncio.get_event_loop()
+        for name in names:
+            records = self._pending.pop(name, None)
+            if records:
+                future = loop.run_in_executor(self._executor, self.archives[name].append, records)
+                future.add_done_callback(self._written)
+
+    def _written(self, future):
+        if future.exception() is not None:
+            self.logger.error('archive: failed to write records: %s', future.exception())
+
+    def close(self):
+        """Write out anything still buffered, and wait for the writer to finish."""
+        self._executor.shutdown(wait=True)
+        for name, records in self._pending.items():
+            self.archives[name].append(records)
+        self._pending = {}
+
+    # handlers
+    def handle_irc_message(self, message):
+        self.record('irc', message.channel, message.kind, message.author, message.text, network=message.network)
+
+    def handle_irc_action(self, message):
+        self.record('irc', message.channel, message.kind, message.author, message.text, network=message.network)
+
+    def handle_discord_message(self, message):
+        self.record('discord', message.channel, message.kind, message.tag, message.text)
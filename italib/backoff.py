@@ -23,6 +23,8 @@ class ExponentialBackoff:
     integral : bool
         Set to True if whole periods of base is desirable, otherwise any
         number in between may be returnd. Defaults to False.
+
+    The total number of delays handed out is kept in :attr:`retries`.
     """
 
     def __init__(self, base=1, *, integral=False):
@@ -30,6 +32,7 @@ class ExponentialBackoff:
 
         self._exp = 0
         self._max = 10
+        self.retries = 0
         self._reset_time = base * 2 ** 11
         self._last_invocation = time.monotonic()
 
@@ -57,5 +60,6 @@ class ExponentialBackoff:
         if interval > self._reset_time:
             self._exp = 0
 
+        self.retries += 1
         self._exp = min(self._exp + 1, self._max)
         return self._randfunc(0, self._base * 2 ** self._exp)
@@ -0,0 +1,154 @@
+# recording the traffic the IM modules see, so it can be replayed later
+import asyncio
+import atexit
+import concurrent.futures
+import gzip
+import json
+import time
+
+from .admission import admission_options
+from .routing import DEFAULT_NETWORK
+
+CAPTURE_VERSION = 1
+
+# record kinds
+IRC_IN = 'i'
+DISCORD_IN = 'd'
+IRC_OUT = 'I'
+DISCORD_OUT = 'D'
+
+# gateway events that are either constant chatter, or the state discord sends
+#   us on connecting rather than traffic. READY is kept, but only our user ID
+SKIPPED_EVENTS = frozenset(['PRESENCE_UPDATE', 'TYPING_START', 'GUILD_CREATE', 'GUILD_MEMBERS_CHUNK'])
+
+
+def _encode(record):
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def capture_header(config):
+    """Returns what a replay needs to know about the config a capture was made with."""
+    irc_config = config['modules']['irc']
+    networks = [(DEFAULT_NETWORK, irc_config)] + list(irc_config.get('networks', {}).items())
+    return {
+        'version': CAPTURE_VERSION,
+        'started': time.time(),
+        'links': config['links'],
+        'nicknames': {name: network.get('nickname', irc_config.get('nickname')) for name, network in networks},
+        'webhooks': sorted(config['modules']['discord'].get('webhooks', {})),
+        'admission': admission_options(config),
+    }
+
+
+class TrafficCapture:
+    """Records the traffic the IM modules see, to replay later.
+
+    A capture is a gzipped file of JSON lines. The first line is a header
+    from :func:`capture_header`, and each line after that is a list, which
+    starts with the seconds since the capture started and the kind of
+    record it is:
+
+    ``[t, 'i', network, line]``
+        A raw line from an IRC server.
+    ``[t, 'd', event, data]``
+        A gateway event from Discord, besides those in
+        :data:`SKIPPED_EVENTS`.
+    ``[t, 'I', network, target, text]``
+        A message we sent to IRC.
+    ``[t, 'D', channel_id, content]``
+        A message we sent to Discord.
+
+    Records are buffered, and written every ``flush_interval`` seconds by a
+    background thread, each batch as its own gzip member, so a capture cut
+    short can still be read up to its last batch.
+    """
+
+    def __init__(self, logger, path, config, *, flush_interval=1.0, batch_size=5000):
+        self.logger = logger
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.started = time.monotonic()
+
+        # a capture always starts a new file
+        open(path, 'wb').close()
+        self._pending = [capture_header(config)]
+        self._flush_handle = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        # stats
+        self.records = 0
+
+        self.flush()
+        atexit.register(self.close)
+
+    def irc_in(self, network, line):
+        self._record(IRC_IN, network, line)
+
+    def discord_in(self, event, data):
+        if event in SKIPPED_EVENTS:
+            return
+        if event == 'READY':
+            data = {'user': {'id': data['user']['id']}}
+        self._record(DISCORD_IN, event, data)
+
+    def irc_out(self, network, target, text):
+        self._record(IRC_OUT, network, target, text)
+
+    def discord_out(self, channel_id, content):
+        self._record(DISCORD_OUT, channel_id, content)
+
+    def _record(self, *record):
+        self._pending.append([round(time.monotonic() - self.started, 4)] + list(record))
+        self.records += 1
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Hand buffered records to the writer thread."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        records, self._pending = self._pending, []
+        if records:
+            future = asyncio.get_event_loop().run_in_executor(self._executor, self._write, records)
+            future.add_done_callback(self._written)
+
+    def _write(self, records):
+        with gzip.open(self.path, 'ab') as f:
+            f.write(b''.join(_encode(record) for record in records))
+
+    def _written(self, future):
+        if future.exception() is not None:
+            self.logger.error('capture: failed to write %s: %s', self.path, future.exception())
+
+    def close(self):
+        """Write out anything still buffered, and wait for the writer to finish."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._executor.shutdown(wait=True)
+        if self._pending:
+            records, self._pending = self._pending, []
+            self._write(records)
+
+
+def read_capture(path):
+    """Returns the header of the capture at ``path``, and an iterator over its records."""
+    f = gzip.open(path, 'rb')
+    header = json.loads(f.readline().decode('utf-8'))
+    if header.get('version') != CAPTURE_VERSION:
+        raise ValueError('{} is not a capture this version of Itabashi can read'.format(path))
+
+    def records():
+        with f:
+            try:
+                for line in f:
+                    yield json.loads(line.decode('utf-8'))
+            except (EOFError, OSError, ValueError):
+                # the capture was cut short in the middle of a batch
+                return
+
+    return header, records()
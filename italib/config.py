@@ -0,0 +1,133 @@
+# loading, upgrading and watching the config file
+import asyncio
+import json
+import os
+
+from . import CURRENT_CONFIG_VERSION
+
+
+class ConfigError(Exception):
+    """The config file couldn't be loaded."""
+
+
+def _slug(name):
+    slug = ''.join(char if char.isalnum() else '-' for char in name.lower()).strip('-')
+    return slug or 'link'
+
+
+def _upgrade_from_0(config):
+    # configs from before the version key could have their links as a list,
+    #   as create-config.py used to start them, and links without a name or
+    #   log setting
+    config.setdefault('modules', {})
+    links = config.get('links') or {}
+    if isinstance(links, list):
+        named = {}
+        for i, link in enumerate(links):
+            base = slug = _slug(link.get('name') or 'link-{}'.format(i))
+            suffix = 1
+            while slug in named:
+                suffix += 1
+                slug = '{}-{}'.format(base, suffix)
+            named[slug] = link
+        links = named
+    for slug, link in links.items():
+        link.setdefault('name', slug)
+        link.setdefault('log', False)
+    config['links'] = links
+
+
+# version -> function upgrading a config from that version to the next
+_upgrades = {
+    0: _upgrade_from_0,
+}
+
+
+def upgrade_config(config):
+    """Upgrade a config to :data:`~italib.CURRENT_CONFIG_VERSION`, in place.
+
+    Returns the version the config was at. Raises :class:`ConfigError` if
+    the config is newer than we understand.
+    """
+    original = version = config.get('version', 0)
+    if version > CURRENT_CONFIG_VERSION:
+        raise ConfigError('Config version {} is newer than this version of Itabashi understands ({})'.format(
+            version, CURRENT_CONFIG_VERSION))
+    while version < CURRENT_CONFIG_VERSION:
+        _upgrades[version](config)
+        version += 1
+    config['version'] = version
+    return original
+
+
+def load_config(path, logger=None):
+    """Load and upgrade the config file at ``path``.
+
+    Upgrades are only made to the loaded config, and logged to ``logger``
+    if one is given. Raises :class:`ConfigError` if the file can't be read
+    or isn't a valid config.
+    """
+    try:
+        with open(path, 'r') as config_file:
+            config = json.loads(config_file.read())[0]
+    except (OSError, ValueError, IndexError, KeyError) as exc:
+        raise ConfigError('Could not load {}: {}'.format(path, exc))
+    if not isinstance(config, dict):
+        raise ConfigError('Could not load {}: not a config'.format(path))
+
+    version = upgrade_config(config)
+    if logger is not None and version != config['version']:
+        logger.info('Upgraded config from version %s to %s', version, config['version'])
+
+    links = config.setdefault('links', {})
+    if not isinstance(links, dict):
+        raise ConfigError('Could not load {}: links should be an object'.format(path))
+    for name, link in links.items():
+        if not isinstance(link, dict) or not isinstance(link.get('channels'), dict):
+            raise ConfigError('Link {} has no channels'.format(name))
+    return config
+
+
+def diff_links(old, new):
+    """Returns the ``(added, removed, changed)`` link names between two ``links`` dicts."""
+    added = sorted(name for name in new if name not in old)
+    removed = sorted(name for name in old if name not in new)
+    changed = sorted(name for name in new if name in old and new[name] != old[name])
+    return added, removed, changed
+
+
+class ConfigWatcher:
+    """Calls ``callback()`` when the file at ``path`` changes.
+
+    The file's modification time and size are checked every ``interval``
+    seconds, which works everywhere and costs next to nothing.
+    """
+
+    def __init__(self, path, callback, interval=5.0):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self._stat = self._current()
+        self._handle = None
+
+    def _current(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def start(self):
+        self._handle = asyncio.get_event_loop().call_later(self.interval, self._check)
+
+    def stop(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _check(self):
+        self.start()
+        current = self._current()
+        if current is not None and current != self._stat:
+            self._stat = current
+            self.callback()
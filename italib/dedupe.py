@@ -0,0 +1,130 @@
+# relay loop and duplicate suppression
+import collections
+import re
+import time
+
+# irc formatting codes and discord markdown, which relays tend to add or drop
+_formatting = re.compile(r'\x03\d{0,2}(?:,\d{1,2})?|[\x02\x0f\x16\x1d\x1f*_~`]')
+# nick prefixes that relays put in front of the messages they forward
+_relay_prefix = re.compile(r'^(?:\s*(?:<[^>]{1,64}>|\[[^\]]{1,64}\]))+\s*')
+_whitespace = re.compile(r'\s+')
+
+
+def normalize(text):
+    """Reduce a message to the text that survives being relayed.
+
+    Returns the normalized text, and whether it carried a relay prefix.
+    """
+    text = _formatting.sub('', text)
+    text, prefixes = _relay_prefix.subn('', text)
+    return _whitespace.sub(' ', text).strip().casefold(), bool(prefixes)
+
+
+class FingerprintCache:
+    """A bounded cache of recently seen message fingerprints.
+
+    Fingerprints are hashes, so each entry costs the same however long the
+    message was. Entries expire ``ttl`` seconds after they were last seen,
+    and once there are ``maxsize`` of them the least recently seen entry is
+    evicted first.
+
+    The IM modules use this to catch three sorts of repeats:
+
+    * ``replay`` - a message ID we've already relayed, eg. after a reconnect.
+    * ``echo`` - text we just relayed to a channel coming back from it, which
+      happens when another bridge shares one of our channels.
+    * ``duplicate`` - the same author saying the same thing on the same link
+      again within ``ttl``, when the service gives us no message IDs. People
+      often repeat themselves ("yes", "ok"), so this is only checked when
+      ``duplicates`` is True.
+
+    Counts of suppressed messages are kept in :attr:`suppressed`.
+    """
+
+    def __init__(self, maxsize=4096, ttl=30.0, duplicates=False):
+        self._entries = collections.OrderedDict()
+        self.suppressed = collections.Counter()
+        self.apply_settings(maxsize, ttl, duplicates)
+
+    def apply_settings(self, maxsize=4096, ttl=30.0, duplicates=False):
+        """Change our settings in place, eg. from a reloaded config.
+
+        Entries already seen keep the expiry they were given, and the
+        oldest are evicted straight away if there are now too many.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.duplicates = duplicates
+        self._expire(time.monotonic())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        entries = self._entries
+        while entries:
+            key, expires = next(iter(entries.items()))
+            if expires > now and len(entries) <= self.maxsize:
+                break
+            del entries[key]
+
+    def add(self, *key):
+        now = time.monotonic()
+        fingerprint = hash(key)
+        self._entries[fingerprint] = now + self.ttl
+        self._entries.move_to_end(fingerprint)
+        self._expire(now)
+
+    def check(self, *key):
+        """Returns True if the key was seen within ``ttl``, and records it."""
+        now = time.monotonic()
+        self._expire(now)
+
+        fingerprint = hash(key)
+        seen = fingerprint in self._entries
+        self._entries[fingerprint] = now + self.ttl
+        self._entries.move_to_end(fingerprint)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return seen
+
+    # helpers used by the IM modules
+    def record_relayed(self, links, message):
+        """Remember text we've just relayed on the given links."""
+        text, _ = normalize(message)
+        if text:
+            for link in links:
+                self.add('echo', link, text)
+
+    def is_repeat(self, links, service, author, message, message_id=None, from_bot=False):
+        """Returns True if the given inbound message should be dropped.
+
+        Only messages from bots, or that look like they've been relayed, are
+        checked for echoes, so people repeating what was just said on the
+        other side of a link aren't mistaken for a relay loop.
+        """
+        if message_id is not None and self.check('id', service, message_id):
+            self.suppressed['replay'] += 1
+            return True
+
+        text, relayed = normalize(message)
+        if not text:
+            return False
+
+        if relayed or from_bot:
+            for link in links:
+                if self._contains('echo', link, text):
+                    self.suppressed['echo'] += 1
+                    return True
+
+        if message_id is None and self.duplicates:
+            for link in links:
+                if self.check('message', link, author, text):
+                    self.suppressed['duplicate'] += 1
+                    return True
+
+        return False
+
+    def _contains(self, *key):
+        expires = self._entries.get(hash(key))
+        return expires is not None and expires > time.monotonic()
@@ -0,0 +1,442 @@
+# passing events between the IM modules without running handlers inline
+import asyncio
+import collections
+import time
+
+DROP_OLDEST = 'drop-oldest'
+BLOCK = 'block'
+SPILL = 'spill'
+
+OVERFLOW_POLICIES = (DROP_OLDEST, BLOCK, SPILL)
+
+# seconds a worker handles events for before letting other tasks run
+TURN_LENGTH = 0.005
+
+
+def handler_name(handler):
+    """Returns a readable name for a handler, eg. ``IrcManager.handle_discord_message``."""
+    owner = getattr(handler, '__self__', None)
+    name = getattr(handler, '__name__', None) or repr(handler)
+    if owner is not None:
+        return '{}.{}'.format(type(owner).__name__, name)
+    return getattr(handler, '__qualname__', name)
+
+
+class Subscription:
+    """A handler registered with an :class:`EventBus`.
+
+    Events for the handler are queued on its :class:`Consumer`, along with
+    those for the consumer's other handlers. Handlers can be plain
+    functions or coroutine functions. Coroutines are cancelled if they
+    take longer than ``timeout`` seconds, and plain functions that take
+    longer are logged, since they can't be interrupted.
+    """
+
+    def __init__(self, consumer, event, handler, *, priority=10, timeout=10.0):
+        self.consumer = consumer
+        self.event = event
+        self.handler = handler
+        self.name = handler_name(handler)
+        self.priority = priority
+        self.timeout = timeout
+
+        # stats
+        self.queued = 0
+        self.handled = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.handle_time = 0.0
+        self.max_handle_time = 0.0
+        self.max_wait_time = 0.0
+
+    def __repr__(self):
+        return '<Subscription {} -> {}>'.format(self.event, self.name)
+
+    def __len__(self):
+        return self.queued
+
+    @property
+    def stats(self):
+        return {
+            'depth': self.queued,
+            'handled': self.handled,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'mean_handle_time': self.handle_time / self.handled if self.handled else 0.0,
+            'max_handle_time': self.max_handle_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+    def close(self):
+        """Stop handling events, and unregister from the bus."""
+        self.consumer.bus.unregister(self)
+
+    @asyncio.coroutine
+    def handle(self, queued, info):
+        started = time.monotonic()
+        bus = self.consumer.bus
+        try:
+            result = self.handler(info)
+            if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+                yield from asyncio.wait_for(result, self.timeout)
+            elif time.monotonic() - started > self.timeout:
+                bus.logger.warning('events: %s took %.1fs handling %s',
+                                   self.name, time.monotonic() - started, self.event)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            bus.logger.warning('events: %s timed out handling %s after %.1fs', self.name, self.event, self.timeout)
+        except Exception:
+            self.failed += 1
+            bus.logger.exception('events: %s failed handling %s', self.name, self.event)
+        took = time.monotonic() - started
+        self.handled += 1
+        self.handle_time += took
+        self.max_handle_time = max(self.max_handle_time, took)
+        self.max_wait_time = max(self.max_wait_time, started - queued)
+        if bus.on_handled is not None:
+            bus.on_handled(self, started - queued, took)
+        return started + took
+
+
+class Consumer:
+    """The handlers of one consumer, such as an IM module, and their queue of events.
+
+    Every consumer has one bounded queue for the events of all its
+    handlers, and its own worker task which runs them in the order the
+    events were dispatched, so a consumer sees one channel's messages,
+    actions and edits in the order they happened, and a slow or failing
+    consumer only holds up its own events. Exceptions from handlers are
+    logged and the next event is handled.
+
+    When the queue is full, what happens to new events depends on
+    ``overflow``:
+
+    ``drop-oldest``
+        The oldest queued event is dropped to make room.
+    ``block``
+        :meth:`put` waits for room. Events dispatched without waiting are
+        queued anyway, and the bus tells the producers of our events to
+        slow down until the queue has room again. If that takes longer than
+        the bus allows, the producers carry on and we drop our oldest
+        events instead until we have room.
+    ``spill``
+        Events spill into a second buffer of ``spill_size`` events, which
+        is handled once the queue has room. When that's full too, its
+        oldest events are dropped.
+    """
+
+    def __init__(self, bus, name, *, maxsize=1000, overflow=DROP_OLDEST, spill_size=10000):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        self.bus = bus
+        self.name = name
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill_size = spill_size
+        self.subscriptions = []
+
+        # (time queued, subscription, info)
+        self._queue = collections.deque()
+        self._spill = collections.deque()
+        self._putters = collections.deque()
+        self._task = None
+        self._congested = False
+        # the bus stopped waiting for us to have room
+        self._overflowing = False
+        self._warned = False
+
+    def __repr__(self):
+        return '<Consumer {}>'.format(self.name)
+
+    def __len__(self):
+        return len(self._queue) + len(self._spill)
+
+    @property
+    def options(self):
+        return {'maxsize': self.maxsize, 'overflow': self.overflow, 'spill_size': self.spill_size}
+
+    def full(self):
+        return len(self._queue) >= self.maxsize
+
+    def put_nowait(self, subscription, info):
+        """Queue an event without waiting. Returns False if an event had to be dropped."""
+        ok = True
+        subscription.queued += 1
+        if self.full():
+            if self.overflow == DROP_OLDEST or self._overflowing:
+                self._drop(self._queue.popleft())
+                ok = False
+                self._warn('queue for {} is full, dropping its oldest events'.format(self.name))
+            elif self.overflow == SPILL:
+                if len(self._spill) >= self.spill_size:
+                    self._drop(self._spill.popleft())
+                    ok = False
+                self._spill.append((time.monotonic(), subscription, info))
+                subscription.spilled += 1
+                self._warn('queue for {} is full, spilling events'.format(self.name))
+                self._start()
+                return ok
+            elif not self._congested:
+                self._congested = True
+                self.bus.congested(self)
+
+        self._queue.append((time.monotonic(), subscription, info))
+        self._start()
+        return ok
+
+    @asyncio.coroutine
+    def put(self, subscription, info):
+        """Queue an event, waiting for room if our overflow policy is ``block``."""
+        if self.overflow == BLOCK and (self.full() or self._putters):
+            # wait in line behind anyone already waiting, so events stay in order
+            waiter = asyncio.Future()
+            self._putters.append(waiter)
+            yield from waiter
+            while self.full():
+                waiter = asyncio.Future()
+                self._putters.appendleft(waiter)
+                yield from waiter
+        self.put_nowait(subscription, info)
+
+    def remove(self, subscription):
+        """Stop handling events for one of our handlers, forgetting those queued for it."""
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+        self._queue = collections.deque(item for item in self._queue if item[1] is not subscription)
+        self._spill = collections.deque(item for item in self._spill if item[1] is not subscription)
+        subscription.queued = 0
+        if not self.subscriptions and self._task is not None:
+            self._task.cancel()
+
+    def _drop(self, item):
+        subscription = item[1]
+        subscription.queued -= 1
+        subscription.dropped += 1
+
+    def _warn(self, message):
+        # only warn once each time the queue fills up
+        if not self._warned:
+            self._warned = True
+            self.bus.logger.warning('events: %s', message)
+
+    def _start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def _next(self):
+        item = self._queue.popleft()
+        item[1].queued -= 1
+        if self._spill and not self.full():
+            self._queue.append(self._spill.popleft())
+
+        if not self.full():
+            self._overflowing = False
+            if self._congested:
+                self._congested = False
+                self.bus.relieved(self)
+            while self._putters:
+                waiter = self._putters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+        if not self:
+            self._warned = False
+        return item
+
+    @asyncio.coroutine
+    def _run(self):
+        try:
+            turn = time.monotonic()
+            while self._queue:
+                queued, subscription, info = self._next()
+                finished = yield from subscription.handle(queued, info)
+
+                # let everything else have a turn once we've had ours
+                if finished - turn >= TURN_LENGTH:
+                    yield from asyncio.sleep(0)
+                    turn = time.monotonic()
+        finally:
+            self._task = None
+
+
+class EventBus:
+    """Passes events between the IM modules, giving each consumer its own queue.
+
+    Keeps the ``register(event, handler)`` and ``dispatch(event, info)``
+    shape of girc's ``EventManager``, but :meth:`dispatch` only queues the
+    event for each handler, and returns straight away. Handlers then run
+    from their consumer's worker task, as :class:`Consumer` describes.
+    Producers that can wait should use :meth:`publish`, which waits for
+    room in the queues of consumers with the ``block`` overflow policy.
+    Producers that can't should register with :meth:`watch_pressure` to be
+    told when to stop reading, and when to start again. Producers aren't
+    kept waiting for more than ``max_pause`` seconds, since one that stops
+    reading from a connection for too long can be dropped by its server.
+
+    Parameters
+    ----------
+    logger
+        Logger to report handler failures and overflows to.
+    queue_size : int
+        Default number of events queued for each consumer. Defaults to 1000.
+    overflow : str
+        Default overflow policy, one of :data:`OVERFLOW_POLICIES`. Defaults
+        to ``drop-oldest``.
+    timeout : float
+        Default seconds a handler may take for each event. Defaults to 10.
+    spill_size : int
+        Default size of the buffer events spill into. Defaults to 10000.
+    max_pause : float
+        Most seconds producers are paused for while a ``block`` consumer
+        is full, after which it drops its oldest events instead until it
+        has room. 0 waits for as long as it takes. Defaults to 30.
+    """
+
+    def __init__(self, logger, *, queue_size=1000, overflow=DROP_OLDEST, timeout=10.0, spill_size=10000,
+                 max_pause=30.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+        self.logger = logger
+        self.defaults = dict(maxsize=queue_size, overflow=overflow, spill_size=spill_size)
+        self.timeout = timeout
+        self.max_pause = max_pause
+
+        # event name -> subscriptions, in priority order
+        self.events = {}
+        # owner -> consumer
+        self.consumers = {}
+        self.on_handled = None
+
+        # [pause, resume, events produced or None for all of them, paused]
+        self._pressure = []
+        # full consumer -> handle of the call that stops us waiting for it
+        self._congested = {}
+        # times we stopped waiting for a full consumer
+        self.pauses_expired = 0
+
+    def register(self, event, handler, priority=10, *, timeout=None, **options):
+        """Call ``handler(info)`` for each ``event`` dispatched.
+
+        Handlers that are methods of the same object share a consumer, and
+        so a queue, and other handlers each have their own. ``options``
+        override the bus defaults for the consumer's queue, and are
+        ``maxsize``, ``overflow`` and ``spill_size``. They're set by the
+        first handler registered for a consumer, and the consumer's other
+        handlers may not ask for different ones. ``timeout`` overrides the
+        bus default for this handler. Returns the :class:`Subscription`.
+        """
+        owner = getattr(handler, '__self__', handler)
+        consumer = self.consumers.get(owner)
+        if consumer is None:
+            name = type(owner).__name__ if owner is not handler else handler_name(handler)
+            consumer = self.consumers[owner] = Consumer(self, name, **dict(self.defaults, **options))
+        elif any(consumer.options[key] != value for key, value in options.items()):
+            raise ValueError('{} already queues its events with {}'.format(consumer.name, consumer.options))
+
+        subscription = Subscription(consumer, event, handler, priority=priority,
+                                    timeout=self.timeout if timeout is None else timeout)
+        consumer.subscriptions.append(subscription)
+        subscriptions = self.events.setdefault(event, [])
+        subscriptions.append(subscription)
+        subscriptions.sort(key=lambda subscription: subscription.priority)
+        return subscription
+
+    def unregister(self, subscription):
+        subscriptions = self.events.get(subscription.event, [])
+        if subscription in subscriptions:
+            subscriptions.remove(subscription)
+        consumer = subscription.consumer
+        consumer.remove(subscription)
+        if not consumer.subscriptions:
+            for owner, known in list(self.consumers.items()):
+                if known is consumer:
+                    del self.consumers[owner]
+            self.relieved(consumer)
+
+    def dispatch(self, event, info):
+        """Queue an event for its handlers, without waiting."""
+        for subscription in self.events.get(event, ()):
+            subscription.consumer.put_nowait(subscription, info)
+
+    @asyncio.coroutine
+    def publish(self, event, info):
+        """Queue an event for its handlers, waiting for room where they ask us to."""
+        for subscription in list(self.events.get(event, ())):
+            yield from subscription.consumer.put(subscription, info)
+
+    # backpressure
+    def watch_pressure(self, pause, resume, events=None):
+        """Call ``pause()`` when a ``block`` consumer's queue overflows, and ``resume()`` once it has room.
+
+        ``events`` are the events the producer dispatches, and it's only
+        paused for consumers that handle one of them. By default it's
+        paused for every consumer.
+        """
+        self._pressure.append([pause, resume, None if events is None else frozenset(events), False])
+        self._update_pressure()
+
+    def congested(self, consumer):
+        if consumer in self._congested:
+            return
+        self.logger.warning('events: queue for %s is full, pausing its producers', consumer.name)
+        handle = None
+        if self.max_pause:
+            handle = asyncio.get_event_loop().call_later(self.max_pause, self._stop_waiting, consumer)
+        self._congested[consumer] = handle
+        self._update_pressure()
+
+    def relieved(self, consumer):
+        if consumer not in self._congested:
+            return
+        handle = self._congested.pop(consumer)
+        if handle is not None:
+            handle.cancel()
+        self.logger.info('events: queue for %s has room again', consumer.name)
+        self._update_pressure()
+
+    def _stop_waiting(self, consumer):
+        del self._congested[consumer]
+        self.pauses_expired += 1
+        self.logger.warning('events: queue for %s has been full for %gs, resuming its producers and dropping '
+                            'its oldest events', consumer.name, self.max_pause)
+        consumer._overflowing = True
+        self._update_pressure()
+
+    def _update_pressure(self):
+        for watcher in self._pressure:
+            pause, resume, events, paused = watcher
+            congested = any(events is None or any(subscription.event in events
+                                                  for subscription in consumer.subscriptions)
+                            for consumer in self._congested)
+            if congested != paused:
+                watcher[3] = congested
+                if congested:
+                    pause()
+                else:
+                    resume()
+
+    # stats
+    @property
+    def subscriptions(self):
+        return [subscription for subscriptions in self.events.values() for subscription in subscriptions]
+
+    @property
+    def depth(self):
+        return sum(len(consumer) for consumer in self.consumers.values())
+
+    @property
+    def stats(self):
+        """Returns the stats of every handler, keyed on ``event: handler``."""
+        stats = {}
+        for subscription in self.subscriptions:
+            name = base = '{}: {}'.format(subscription.event, subscription.name)
+            suffix = 1
+            while name in stats:
+                suffix += 1
+                name = '{} ({})'.format(base, suffix)
+            stats[name] = subscription.stats
+        return stats
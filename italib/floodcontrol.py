@@ -0,0 +1,273 @@
+# outbound flood control and line splitting for IRC connections
+import asyncio
+import collections
+import re
+
+from .ratelimit import TokenBucket
+
+# RFC1459 line limit, including the trailing \r\n
+IRC_LINE_LENGTH = 512
+
+# longest hostname we expect the server to put in our prefix
+MAX_HOST_LENGTH = 63
+
+# str.splitlines also breaks on control codes such as \x1d and \x1e, which
+#   are IRC's italic and strikethrough formatting
+_newlines = re.compile(r'\r\n|\r|\n')
+
+# priority lanes, lower numbers are sent first
+CONTROL = 0
+RELAY = 1
+LANES = (CONTROL, RELAY)
+
+
+def max_message_bytes(nick, user, target, verb='PRIVMSG', line_length=IRC_LINE_LENGTH):
+    """Returns how many bytes of text fit in a single message to ``target``.
+
+    The server prepends our ``nick!user@host`` prefix when relaying our
+    messages to other clients, so we have to leave room for it. We don't
+    know our host so we assume the longest one we're likely to be given.
+    """
+    # :nick!~user@host VERB target :text\r\n
+    overhead = (len(':!~@  ') + len(nick.encode('utf-8')) + len(user.encode('utf-8')) +
+                MAX_HOST_LENGTH + len(verb) + len(' :') + len(target.encode('utf-8')) + 2)
+    return line_length - overhead
+
+
+def _split_word(word, max_bytes):
+    """Split a word into a head of at most ``max_bytes`` and the remainder.
+
+    The head is always at least one character, even if that's more than
+    ``max_bytes``, so splitting a word always gets somewhere.
+    """
+    head = word.encode('utf-8')[:max(max_bytes, 0)].decode('utf-8', 'ignore') or word[:1]
+    return head, word[len(head):]
+
+
+def split_message(text, max_bytes):
+    """Split text into lines of at most ``max_bytes`` UTF-8 encoded bytes.
+
+    Lines are broken at newlines and then on word boundaries where possible.
+    Words longer than a whole line are broken between characters, never in
+    the middle of a multi-byte character. Blank lines, and lines of only
+    spaces, are dropped, since servers refuse to send them.
+    """
+    lines = []
+
+    def add(line):
+        if line.strip():
+            lines.append(line)
+
+    for paragraph in _newlines.split(text):
+        current = []
+        size = 0
+
+        for word in paragraph.split(' '):
+            word_size = len(word.encode('utf-8'))
+            needed = word_size + 1 if current else word_size
+
+            if size + needed <= max_bytes:
+                current.append(word)
+                size += needed
+                continue
+
+            if current:
+                add(' '.join(current))
+
+            while word_size > max_bytes:
+                head, word = _split_word(word, max_bytes)
+                add(head)
+                word_size = len(word.encode('utf-8'))
+
+            current = [word]
+            size = word_size
+
+        add(' '.join(current))
+
+    return lines
+
+
+def pack_targets(targets, verb='JOIN', max_targets=None, line_length=IRC_LINE_LENGTH):
+    """Pack targets into as few comma-separated lists as fit on a line.
+
+    Each list fits in a single ``verb`` line to the server, and holds at
+    most ``max_targets`` targets if the server gives a limit, as in its
+    TARGMAX.
+    """
+    # VERB targets\r\n
+    max_bytes = line_length - len(verb) - len(' \r\n')
+    packed = []
+    current = []
+    size = 0
+
+    for target in targets:
+        target_size = len(target.encode('utf-8'))
+        if current and (size + 1 + target_size > max_bytes or (max_targets and len(current) >= max_targets)):
+            packed.append(','.join(current))
+            current = []
+        size = size + 1 + target_size if current else target_size
+        current.append(target)
+
+    if current:
+        packed.append(','.join(current))
+    return packed
+
+
+class IrcSendQueue:
+    """Flood-controlled outbound queue for a single IRC connection.
+
+    Lines are sent through a token bucket so we stay under the server's
+    flood limits. Each line goes into a priority lane, and lower lanes are
+    always emptied first so that CTCP replies and other control traffic
+    never wait behind relayed messages. Lanes are bounded, and when a lane
+    is full its oldest line is dropped.
+
+    The queue starts paused, and should be resumed once the connection has
+    registered. Lines sent to the server without going through the queue,
+    such as girc's automatic PONGs, can be accounted for with :meth:`charge`.
+
+    Parameters
+    ----------
+    logger
+        Logger to report drops to.
+    server : girc.client.ServerConnection
+        The connection to send lines through.
+    rate : float
+        Lines allowed each second once the burst is used up. Defaults to 1.
+    burst : int
+        Lines that can be sent at once. Defaults to 5.
+    maxsize : int
+        Maximum number of lines held in each lane. Defaults to 500.
+    on_sent
+        Optional function called as ``on_sent(verb, params, received)`` after
+        each line is sent, where ``received`` is the monotonic time given
+        when the line was queued, or None.
+    """
+
+    def __init__(self, logger, server, *, rate=1.0, burst=5, maxsize=500, on_sent=None):
+        self.logger = logger
+        self.server = server
+        self.maxsize = maxsize
+        self.bucket = TokenBucket(rate, burst)
+        self.paused = True
+        self.on_sent = on_sent
+
+        self._lanes = {lane: collections.deque() for lane in LANES}
+        self._task = None
+        self._sending = False
+
+        # stats
+        self.sent = {lane: 0 for lane in LANES}
+        self.dropped = {lane: 0 for lane in LANES}
+        self.charged = 0
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes.values())
+
+    @property
+    def depth(self):
+        return {lane: len(queue) for lane, queue in self._lanes.items()}
+
+    @property
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'sent': dict(self.sent),
+            'dropped': dict(self.dropped),
+            'charged': self.charged,
+            'tokens': self.bucket.tokens,
+        }
+
+    def send(self, verb, params, priority=RELAY, received=None):
+        """Queue a line to be sent to the server."""
+        lane = self._lanes[priority]
+        if len(lane) >= self.maxsize:
+            lane.popleft()
+            self.dropped[priority] += 1
+            self.logger.warning('irc: send queue lane %s for %s is full, dropped oldest line',
+                                priority, self.server.name)
+        lane.append((verb, params, received))
+        self._wake()
+
+    def msg(self, target, message, priority=RELAY, received=None):
+        self.send('PRIVMSG', [target, message], priority=priority, received=received)
+
+    def notice(self, target, message, priority=RELAY, received=None):
+        self.send('NOTICE', [target, message], priority=priority, received=received)
+
+    def ctcp_reply(self, target, ctcp_verb, argument=None):
+        atoms = [ctcp_verb]
+        if argument is not None:
+            atoms.append(argument)
+        self.notice(target, '\x01{}\x01'.format(' '.join(atoms)), priority=CONTROL)
+
+    def charge(self):
+        """Account for a line that was sent without going through the queue."""
+        if not self._sending:
+            self.bucket.charge()
+            self.charged += 1
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._wake()
+
+    def clear(self, priority=None):
+        """Drop every queued line, or just those in the given lane."""
+        for lane, queue in self._lanes.items():
+            if priority is None or lane == priority:
+                queue.clear()
+
+    def take(self, target):
+        """Remove and return the pending relayed lines for the given target.
+
+        Lines are returned as ``(verb, params, received)`` tuples, which can
+        be passed to :meth:`send` on another queue.
+        """
+        lane = self._lanes[RELAY]
+        taken = [line for line in lane if line[1] and line[1][0] == target]
+        if taken:
+            self._lanes[RELAY] = collections.deque(line for line in lane if not (line[1] and line[1][0] == target))
+        return taken
+
+    def pending(self):
+        """Returns the relayed lines waiting to be sent, without removing them.
+
+        Lines are returned as ``(verb, params, received)`` tuples, oldest
+        first.
+        """
+        return list(self._lanes[RELAY])
+
+    def _wake(self):
+        if self._task is None and not self.paused and len(self):
+            self._task = asyncio.ensure_future(self._run())
+
+    def _next(self):
+        for lane in LANES:
+            if self._lanes[lane]:
+                return lane, self._lanes[lane].popleft()
+
+    @asyncio.coroutine
+    def _run(self):
+        try:
+            while not self.paused and len(self):
+                delay = self.bucket.delay()
+                if delay:
+                    yield from asyncio.sleep(delay)
+                    continue
+
+                self.bucket.consume()
+                lane, (verb, params, received) = self._next()
+
+                self._sending = True
+                try:
+                    self.server.send(verb, params=params)
+                finally:
+                    self._sending = False
+                self.sent[lane] += 1
+                if self.on_sent is not None:
+                    self.on_sent(verb, params, received)
+        finally:
+            self._task = None
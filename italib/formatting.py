@@ -0,0 +1,249 @@
+# translating message formatting between IRC control codes and Discord markdown
+import re
+
+# mIRC formatting codes
+BOLD = '\x02'
+COLOUR = '\x03'
+HEX_COLOUR = '\x04'
+RESET = '\x0f'
+MONOSPACE = '\x11'
+REVERSE = '\x16'
+ITALIC = '\x1d'
+STRIKETHROUGH = '\x1e'
+UNDERLINE = '\x1f'
+
+GREY = COLOUR + '14'
+
+# a spoiler's text is hidden by colouring it black on black
+SPOILER = COLOUR + '01,01'
+
+# matches a single formatting code, with any colours it sets
+_irc_code = (r'\x03(?:\d{1,2}(?:,\d{1,2})?)?|\x04(?:[0-9a-fA-F]{6}(?:,[0-9a-fA-F]{6})?)?|'
+             r'[\x02\x0f\x11\x16\x1d\x1e\x1f]')
+_irc_codes = re.compile(_irc_code)
+
+# splits IRC text into plain text and tokens. URLs are tokens so that their
+#   contents aren't escaped, which would break them, but looking for them is
+#   slow so they're only looked for in text that has them
+_irc_tokens = re.compile(r'(?=[\x02-\x04\x0f\x11\x16\x1d-\x1f])({})'.format(_irc_code))
+_irc_url_tokens = re.compile(r'({}|https?://[^\s\x00-\x1f]+)'.format(_irc_code))
+
+_irc_styles = {
+    BOLD: '**',
+    ITALIC: '*',
+    UNDERLINE: '__',
+    STRIKETHROUGH: '~~',
+}
+
+_markdown_characters = '\\*_~`|'
+
+# each alternative is wrapped in a named group, so match.lastgroup says which
+#   matched. the lookahead lets the regex skip past plain text quickly, rather
+#   than trying every alternative at every character
+_discord_token = r'''
+    (?P<block>```(?:[\w+-]*\n)?(?P<block_text>.*?)```)
+  | (?P<code>``?(?P<code_text>[^`]+?)``?)
+  | (?P<escape>\\(?P<escaped>[^\w\s]))
+  | (?P<mention><(?P<mention_kind>@!?|@&|\#)(?P<mention_id>\d+)>)
+  | (?P<emoji><a?:(?P<emoji_name>\w+):\d+>)
+  | (?P<url><?(?P<url_text>https?://[^\s<>]+)>?)
+  | (?P<marker>\*\*|\*|~~|\|\||(?<!\w)__?|__?(?!\w))
+'''
+_discord_token_starts = '`\\<*~|_'
+_discord_tokens = re.compile(r'(?=[`\\<*~|_])(?:{})'.format(_discord_token), re.DOTALL | re.VERBOSE)
+
+# bare URLs can start with any 'h', which slows things down a lot, so this is
+#   only used for text that has URLs in it
+_discord_url_tokens = re.compile(r'(?=[`\\<*~|_h])(?:{})'.format(_discord_token), re.DOTALL | re.VERBOSE)
+
+# token -> the group holding the text it's replaced with
+_token_text = {
+    'block': 'block_text',
+    'code': 'code_text',
+    'escape': 'escaped',
+    'url': 'url_text',
+}
+
+# italic markers only open right before text, and only close right after
+#   it, so '5 * 3 * 2' is left alone
+_flanked_markers = frozenset(['*', '_'])
+
+# markdown marker -> IRC codes to open and close it with
+_markdown_styles = {
+    '**': (BOLD, BOLD),
+    '*': (ITALIC, ITALIC),
+    '_': (ITALIC, ITALIC),
+    '__': (UNDERLINE, UNDERLINE),
+    '~~': (STRIKETHROUGH, STRIKETHROUGH),
+    '||': (SPOILER, COLOUR),
+}
+
+# what discord shows for mentions of things it doesn't know about
+_unknown_mentions = {
+    '@': '@deleted-user',
+    '@&': '@deleted-role',
+    '#': '#deleted-channel',
+}
+
+
+def strip_irc_formatting(text):
+    """Returns the given IRC text with all formatting codes removed."""
+    if text.isprintable():
+        return text
+    return _irc_codes.sub('', text)
+
+
+def escape_markdown(text):
+    """Escape the characters Discord would take as markdown."""
+    # a replace for each character is much quicker than str.translate
+    for char in _markdown_characters:
+        if char in text:
+            text = text.replace(char, '\\' + char)
+    return text
+
+
+def _defuse_mentions(text):
+    return text.replace('@everyone', '@\u200beveryone').replace('@here', '@\u200bhere')
+
+
+def irc_prefix(name, discriminator):
+    """Returns the prefix we put before lines from a Discord user on IRC."""
+    return '{}<{}{}{}{}{}#{}>{} '.format(GREY, RESET, BOLD, name, BOLD, GREY, discriminator, RESET)
+
+
+def _close(out, markers):
+    # discord only closes a style if there's no whitespace just inside it
+    last = out[-1] if out else ''
+    stripped = last.rstrip()
+    if len(stripped) != len(last):
+        out[-1] = stripped
+        out.append(markers)
+        out.append(last[len(stripped):])
+    else:
+        out.append(markers)
+
+
+def _write(out, active, opened, text):
+    if opened == active:
+        out.append(text)
+        return
+
+    # close the styles that are no longer active, and any opened inside them
+    common = 0
+    while common < len(opened) and common < len(active) and opened[common] == active[common]:
+        common += 1
+    if common < len(opened):
+        _close(out, ''.join(_irc_styles[style] for style in reversed(opened[common:])))
+        del opened[common:]
+
+    # and only open styles right before text that they apply to
+    if common < len(active) and not text.isspace():
+        content = text.lstrip()
+        if len(content) != len(text):
+            out.append(text[:len(text) - len(content)])
+        out.append(''.join(_irc_styles[style] for style in active[common:]))
+        opened.extend(active[common:])
+        text = content
+
+    out.append(text)
+
+
+def irc_to_discord(text):
+    """Translate IRC formatting codes into Discord markdown.
+
+    Bold, italics, underline and strikethrough become their markdown
+    equivalents, colours and reverse are dropped, and a reset ends every
+    style. Markdown already in the text is escaped, and ``@everyone`` and
+    ``@here`` are broken up so they don't notify anyone. Works in a single
+    pass over the text.
+    """
+    # most messages have no formatting or links at all
+    has_urls = '://' in text
+    if not has_urls and text.isprintable():
+        return _defuse_mentions(escape_markdown(text))
+
+    out = []
+    # styles that are turned on, in the order they were, and those we've
+    #   written the opening markers for
+    active = []
+    opened = []
+
+    tokens = _irc_url_tokens if has_urls else _irc_tokens
+    for i, piece in enumerate(tokens.split(text)):
+        if not piece:
+            continue
+        # odd pieces are the tokens we split on
+        if not i % 2:
+            _write(out, active, opened, escape_markdown(piece))
+        elif piece in _irc_styles:
+            if piece in active:
+                active.remove(piece)
+            else:
+                active.append(piece)
+        elif piece == RESET:
+            del active[:]
+        elif piece[0] not in (COLOUR, HEX_COLOUR, MONOSPACE, REVERSE):
+            _write(out, active, opened, piece)
+
+    _write(out, [], opened, '')
+    return _defuse_mentions(''.join(out))
+
+
+def discord_to_irc(text, names=None):
+    """Translate Discord markdown into IRC formatting codes.
+
+    Bold, italics, underline, strikethrough and spoilers become IRC
+    formatting, and code is passed through as it is. Markers that are
+    never closed are left as they are. Mentions are rendered using
+    ``names``, which maps ``(kind, id)`` to a name, where ``kind`` is ``@``
+    for users, ``@&`` for roles and ``#`` for channels. Custom emoji
+    become ``:name:``. Works in a single pass over the text.
+    """
+    # most messages have no markdown, mentions or emoji at all
+    if not any(char in text for char in _discord_token_starts):
+        return text
+
+    names = names or {}
+    parts = []
+    # marker -> index in parts of its opening marker, while it's unclosed
+    unclosed = {}
+
+    pos = 0
+    tokens = _discord_url_tokens if '://' in text else _discord_tokens
+    for match in tokens.finditer(text):
+        if match.start() > pos:
+            parts.append(text[pos:match.start()])
+        pos = match.end()
+
+        kind = match.lastgroup
+        if kind == 'marker':
+            marker = match.group(kind)
+            if marker in _flanked_markers:
+                if marker in unclosed:
+                    usable = match.start() and not text[match.start() - 1].isspace()
+                else:
+                    usable = pos < len(text) and not text[pos].isspace()
+                if not usable:
+                    parts.append(marker)
+                    continue
+            if marker in unclosed:
+                opening, closing = _markdown_styles[marker]
+                parts[unclosed.pop(marker)] = opening
+                parts.append(closing)
+            else:
+                unclosed[marker] = len(parts)
+                parts.append(marker)
+        elif kind == 'mention':
+            mention_kind = match.group('mention_kind').rstrip('!')
+            name = names.get((mention_kind, match.group('mention_id')))
+            if name is None:
+                parts.append(_unknown_mentions[mention_kind])
+            else:
+                parts.append(mention_kind[0] + name)
+        elif kind == 'emoji':
+            parts.append(':{}:'.format(match.group('emoji_name')))
+        else:
+            parts.append(match.group(_token_text[kind]))
+
+    parts.append(text[pos:])
+    return ''.join(parts)
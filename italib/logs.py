@@ -0,0 +1,135 @@
+# background, rate-limited logging
+import atexit
+import logging
+import logging.handlers
+import queue
+
+from .ratelimit import TokenBucket
+
+LOG_FORMAT = '%(asctime)s %(levelname)s:%(name)s:%(message)s'
+
+# raw protocol traffic is logged here so it can be sampled separately
+RAW_LOGGER = 'itabashi.raw'
+
+
+def parse_level(level):
+    """Returns the numeric logging level for the given name or number."""
+    if isinstance(level, int):
+        return level
+    value = logging.getLevelName(level.upper())
+    if not isinstance(value, int):
+        raise ValueError('Unknown logging level: {}'.format(level))
+    return value
+
+
+class Lazy:
+    """Defers calling ``fn(*args)`` until the log record is formatted.
+
+    Records we pass to the background writer are formatted on its thread,
+    so wrapping expensive arguments in this keeps them off the event loop,
+    and records that get filtered out never pay for them at all.
+    """
+
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        try:
+            return str(self.fn(*self.args))
+        except (UnicodeDecodeError, UnicodeEncodeError):
+            return 'Data could not be displayed'
+
+
+class RateLimitFilter(logging.Filter):
+    """Samples and rate limits the records passing through it.
+
+    Only one in every ``sample`` records is considered, and of those at most
+    ``rate`` a second are let through, with bursts of up to ``burst``. The
+    next record let through notes how many were suppressed before it.
+    """
+
+    def __init__(self, rate=None, burst=None, sample=1):
+        super().__init__()
+        self.sample = max(int(sample), 1)
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate, burst or rate)
+
+        self.suppressed = 0
+        self._seen = 0
+        self._pending = 0
+
+    def filter(self, record):
+        self._seen += 1
+        if (self._seen % self.sample or
+                (self.bucket is not None and not self.bucket.consume())):
+            self.suppressed += 1
+            self._pending += 1
+            return False
+
+        # only annotate %-style records, where it's safe to add another arg
+        if self._pending and isinstance(record.args, tuple) and record.args:
+            record.msg = str(record.msg) + ' [%d suppressed]'
+            record.args = record.args + (self._pending,)
+            self._pending = 0
+        return True
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    """Hands records to a :class:`logging.handlers.QueueListener` unformatted.
+
+    The stock QueueHandler formats each record before queueing it, which
+    would do the formatting work on the event loop. We only render
+    tracebacks here, since they can't outlive the frames they refer to, and
+    leave the rest for the listener's thread. If the queue is full, records
+    are dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_logging(filename, level=logging.INFO, *, raw_rate=10, raw_sample=1, queue_size=10000):
+    """Start logging to the given file from a background thread.
+
+    Arguments:
+    filename -- File to append log records to
+    level -- Logging level name or number, defaults to INFO
+    raw_rate -- Maximum raw traffic records logged per second, 0 for no limit
+    raw_sample -- Only consider one in this many raw traffic records
+    queue_size -- Records to hold for the writer before dropping them
+    Returns:
+    The running QueueListener, which is also stopped when we exit"""
+    log_queue = queue.Queue(queue_size)
+
+    file_handler = logging.FileHandler(filename, encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+
+    root = logging.getLogger()
+    root.setLevel(parse_level(level))
+    root.addHandler(BackgroundHandler(log_queue))
+
+    logging.getLogger(RAW_LOGGER).addFilter(RateLimitFilter(raw_rate, sample=raw_sample))
+
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
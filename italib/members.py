@@ -0,0 +1,170 @@
+# finding discord guild members by name, so IRC users can mention them
+import bisect
+import re
+
+# shortest prefix of a name an @mention may use
+MIN_PREFIX = 3
+
+# mentions IRC users type: @name anywhere, or name: and name, at the start of
+#   a line, as IRC clients put them when tab-completing. names may contain
+#   backslashes from having their markdown escaped
+_mention = re.compile(r'(?:(?<!\S)@(?P<at>[^\s@]+))|(?:^(?P<address>[^\s@:,]+)[:,](?=\s|$))')
+_trailing = '.,:;!?)\'"'
+
+
+def fold(name):
+    return name.casefold()
+
+
+def member_names(user, nick=None):
+    """Returns the folded names a member can be mentioned by."""
+    names = [fold(user['username']), fold('{}#{}'.format(user['username'], user['discriminator']))]
+    if nick:
+        names.append(fold(nick))
+    # names with spaces can't be typed as a single word, so they're also
+    #   known without them
+    names.extend([name.replace(' ', '') for name in names if ' ' in name])
+    # a tuple takes a lot less memory than a set, which adds up in big guilds
+    return tuple(dict.fromkeys(names))
+
+
+class _Guild:
+    __slots__ = ('names', 'members', 'sorted')
+
+    def __init__(self):
+        # folded name -> member id, or the set of member ids sharing it
+        self.names = {}
+        # member id -> the names they're known by
+        self.members = {}
+        # every name in order, for prefix lookups. None while it needs rebuilding
+        self.sorted = None
+
+
+class MemberDirectory:
+    """Finds members of each Discord guild by name.
+
+    Every member is indexed under their username, their ``name#1234`` tag
+    and their nickname, folded so lookups ignore case. Names with spaces are
+    also indexed without them. The index is kept up to date a member at a
+    time from the gateway's member events, so looking up a name is a single
+    dict access however large the guild is. A name shared by more than one
+    member matches none of them.
+
+    Prefix lookups use a sorted list of the names, which is built the first
+    time it's needed after a guild is loaded, and kept up to date after that.
+    """
+
+    def __init__(self):
+        # guild id -> _Guild
+        self.guilds = {}
+
+    def __len__(self):
+        return sum(len(guild.members) for guild in self.guilds.values())
+
+    def clear(self):
+        self.guilds.clear()
+
+    def load(self, guild_id, members):
+        """Index a guild's members, from their gateway payloads."""
+        guild = self.guilds.setdefault(guild_id, _Guild())
+        for member in members:
+            user_id = member['user']['id']
+            if user_id in guild.members:
+                self._remove(guild, user_id)
+            self._add(guild, user_id, member_names(member['user'], member.get('nick')))
+        # it's cheaper to sort once than to insert every name in order
+        guild.sorted = None
+
+    def remove_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def update(self, guild_id, member):
+        """Index a member who has joined, or whose names have changed."""
+        guild = self.guilds.setdefault(guild_id, _Guild())
+        user_id = member['user']['id']
+        names = member_names(member['user'], member.get('nick'))
+        if guild.members.get(user_id) != names:
+            self._remove(guild, user_id)
+            self._add(guild, user_id, names)
+
+    def remove(self, guild_id, user_id):
+        guild = self.guilds.get(guild_id)
+        if guild is not None:
+            self._remove(guild, user_id)
+
+    def _add(self, guild, user_id, names):
+        guild.members[user_id] = names
+        for name in names:
+            found = guild.names.get(name)
+            if found is None:
+                guild.names[name] = user_id
+                if guild.sorted is not None:
+                    bisect.insort(guild.sorted, name)
+            elif isinstance(found, set):
+                found.add(user_id)
+            elif found != user_id:
+                guild.names[name] = {found, user_id}
+
+    def _remove(self, guild, user_id):
+        for name in guild.members.pop(user_id, ()):
+            found = guild.names[name]
+            if isinstance(found, set):
+                found.discard(user_id)
+                if len(found) == 1:
+                    guild.names[name] = found.pop()
+                continue
+            del guild.names[name]
+            if guild.sorted is not None:
+                del guild.sorted[bisect.bisect_left(guild.sorted, name)]
+
+    def find(self, guild_id, name):
+        """Returns the ID of the one member known as ``name``, or None."""
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            return None
+        found = guild.names.get(fold(name))
+        return None if isinstance(found, set) else found
+
+    def complete(self, guild_id, prefix):
+        """Returns the ID of the one member with a name starting with ``prefix``, or None."""
+        guild = self.guilds.get(guild_id)
+        prefix = fold(prefix)
+        if guild is None or len(prefix) < MIN_PREFIX:
+            return None
+        if guild.sorted is None:
+            guild.sorted = sorted(guild.names)
+
+        found = None
+        names = guild.sorted
+        position = bisect.bisect_left(names, prefix)
+        while position < len(names) and names[position].startswith(prefix):
+            member = guild.names[names[position]]
+            if isinstance(member, set) or (found is not None and member != found):
+                return None
+            found = member
+            position += 1
+        return found
+
+    def mention(self, guild_id, text):
+        """Turns the names IRC users address in Discord text into mentions of those members."""
+        if guild_id not in self.guilds or ('@' not in text and ':' not in text and ',' not in text):
+            return text
+
+        def replace(match):
+            token = match.group('at') or match.group('address')
+            member = self.find(guild_id, token.replace('\\', ''))
+            tail = ''
+            if member is None:
+                # punctuation after a name usually isn't part of it
+                trimmed = token.rstrip(_trailing)
+                tail = token[len(trimmed):]
+                member = self.find(guild_id, trimmed.replace('\\', ''))
+                if member is None and match.group('at'):
+                    member = self.complete(guild_id, trimmed.replace('\\', ''))
+            if member is None:
+                return match.group(0)
+            # an address keeps the : or , after it
+            separator = match.group(0)[len(token):] if match.group('address') else ''
+            return '<@{}>{}{}'.format(member, tail, separator)
+
+        return _mention.sub(replace, text)
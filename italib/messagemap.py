@@ -0,0 +1,286 @@
+# remembering what relayed messages became on the other side, so edits and
+#   deletions can follow them
+import atexit
+import asyncio
+import collections
+import concurrent.futures
+import re
+import sqlite3
+
+# where a mapped message came from
+DISCORD = 'd'
+IRC = 'i'
+
+# rough bytes each entry costs besides its record's text: the int key, the
+#   record string and the dict's entry and linked list node
+ENTRY_OVERHEAD = 240
+
+# longest text kept for a message. longer texts are cut, and edits to them
+#   are relayed in full rather than as a substitution
+TEXT_LIMIT = 500
+
+# fields are joined with a character neither IRC nor Discord lets through
+_SEPARATOR = '\x00'
+
+# splits text into words and the whitespace between them
+_words = re.compile(r'(\s+)')
+
+
+def substitution(old, new, max_length=80):
+    """Returns an ``s/old/new/`` describing an edit, or None if the new text is clearer.
+
+    The changed part is found a word at a time, and insertions and removals
+    take a neighbouring word along so they say where they happened.
+    """
+    if not old or len(old) > TEXT_LIMIT:
+        return None
+    before, after = _words.split(old), _words.split(new)
+    shortest = min(len(before), len(after))
+    start = 0
+    while start < shortest and before[start] == after[start]:
+        start += 1
+    end = 0
+    while end < shortest - start and before[-1 - end] == after[-1 - end]:
+        end += 1
+    # words are at even indices, so this keeps both ends on whole words
+    start -= start % 2
+    end -= end % 2
+
+    removed, added = before[start:len(before) - end], after[start:len(after) - end]
+    if not removed or not added:
+        if start:
+            start -= 2
+        elif end:
+            end -= 2
+        else:
+            return None
+        removed, added = before[start:len(before) - end], after[start:len(after) - end]
+
+    removed, added = ''.join(removed), ''.join(added)
+    if not removed.strip() or '/' in removed or '/' in added:
+        return None
+    correction = 's/{}/{}/'.format(removed, added)
+    if len(correction) > max_length or len(correction) >= len(new):
+        return None
+    return correction
+
+
+def excerpt(text, length=60):
+    """Returns the start of ``text``, cut at a word if it's longer than ``length``."""
+    if len(text) <= length:
+        return text
+    cut = text.rfind(' ', 0, length)
+    return text[:cut if cut > length // 2 else length].rstrip() + '…'
+
+
+class MessageMap:
+    """Remembers the messages we've relayed, by their Discord ID.
+
+    Each message maps to a few short strings, eg. where it came from and
+    who sent it, which are packed into a single string so an entry costs
+    little more than its text. Entries are kept in memory in least-recently
+    used order, and once they take more than ``memory`` bytes the least
+    recently used are forgotten, so memory use is bounded however long we
+    run. Lookups are a dict access.
+
+    With a ``path``, entries are also written to an SQLite database there,
+    so they outlive both eviction and restarts. Writes are batched and made
+    on a background thread every ``flush_interval`` seconds, and the oldest
+    rows are pruned once there are more than ``max_rows``. Lookups that
+    miss in memory fall back to the database, which is a single read by
+    primary key, made on the same thread so a slow disk never holds up the
+    event loop, and so it sees every write made before it.
+
+    Parameters
+    ----------
+    logger
+        Logger to report database errors to.
+    memory : int
+        Bytes of entries to keep in memory. Defaults to 4 MiB.
+    path : str
+        Optional path of an SQLite database to keep entries in.
+    max_rows : int
+        Most entries to keep in the database. Defaults to 1000000.
+    flush_interval : float
+        Seconds between writes to the database. Defaults to 2.
+    batch_size : int
+        Writes to make at once, even if it's not yet time to. Defaults to 1000.
+    """
+
+    def __init__(self, logger, *, memory=4 * 1024 * 1024, path=None, max_rows=1000000, flush_interval=2.0,
+                 batch_size=1000):
+        self.logger = logger
+        self.memory = memory
+        self.path = path
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        # message id -> packed record, least recently used first
+        self._entries = collections.OrderedDict()
+        self._size = 0
+
+        if path is not None:
+            db = sqlite3.connect(path)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, record TEXT NOT NULL)')
+            db.commit()
+            db.close()
+            # the database thread's connection
+            self._writer = None
+            self._written = 0
+            # message id -> packed record, or None to delete it
+            self._pending = collections.OrderedDict()
+            self._flush_handle = None
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            atexit.register(self.close)
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'disk_hits': self.disk_hits,
+            'evicted': self.evicted,
+        }
+
+    def put(self, message_id, *fields):
+        """Remember the given fields for a message."""
+        message_id = int(message_id)
+        record = _SEPARATOR.join(field.replace(_SEPARATOR, '') for field in fields)
+        self._remember(message_id, record)
+        if self.path is not None:
+            self._write(message_id, record)
+
+    @asyncio.coroutine
+    def get(self, message_id):
+        """Returns the fields remembered for a message, or None.
+
+        Only waits if the message has to be read from the database.
+        """
+        message_id = int(message_id)
+        record = self._entries.get(message_id)
+        if record is not None:
+            self._entries.move_to_end(message_id)
+            self.hits += 1
+        elif self.path is not None:
+            record = yield from self._load(message_id)
+            if record is not None:
+                self.disk_hits += 1
+                # it may have been put or discarded while we were reading
+                if message_id not in self._entries and message_id not in self._pending:
+                    self._remember(message_id, record)
+        if record is None:
+            self.misses += 1
+            return None
+        return tuple(record.split(_SEPARATOR))
+
+    def discard(self, message_id):
+        """Forget a message, eg. because it's been deleted."""
+        message_id = int(message_id)
+        record = self._entries.pop(message_id, None)
+        if record is not None:
+            self._size -= ENTRY_OVERHEAD + len(record)
+        if self.path is not None:
+            self._write(message_id, None)
+
+    def _remember(self, message_id, record):
+        old = self._entries.pop(message_id, None)
+        if old is not None:
+            self._size -= ENTRY_OVERHEAD + len(old)
+        self._entries[message_id] = record
+        self._size += ENTRY_OVERHEAD + len(record)
+        while self._size > self.memory and self._entries:
+            evicted_id, evicted = self._entries.popitem(last=False)
+            self._size -= ENTRY_OVERHEAD + len(evicted)
+            self.evicted += 1
+
+    # persistence
+    @asyncio.coroutine
+    def _load(self, message_id):
+        if message_id in self._pending:
+            return self._pending[message_id]
+        try:
+            return (yield from asyncio.get_event_loop().run_in_executor(self._executor, self._read, message_id))
+        except sqlite3.Error as exc:
+            self.logger.error('message map: failed to read %s: %s', self.path, exc)
+            return None
+
+    def _connection(self):
+        # the database thread's connection, which close() may also use from
+        #   the main thread once that thread has finished
+        if self._writer is None:
+            self._writer = sqlite3.connect(self.path, check_same_thread=False)
+            self._writer.execute('PRAGMA synchronous=NORMAL')
+        return self._writer
+
+    def _read(self, message_id):
+        # runs on the database thread
+        row = self._connection().execute('SELECT record FROM messages WHERE id = ?', (message_id,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _write(self, message_id, record):
+        self._pending[message_id] = record
+        self._pending.move_to_end(message_id)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """Hand pending writes to the database thread."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, collections.OrderedDict()
+        if pending:
+            future = asyncio.get_event_loop().run_in_executor(self._executor, self._commit, pending)
+            future.add_done_callback(self._committed)
+
+    def _commit(self, pending):
+        # runs on the database thread
+        self._connection()
+        with self._writer:
+            self._writer.executemany('INSERT OR REPLACE INTO messages (id, record) VALUES (?, ?)',
+                                     [(key, record) for key, record in pending.items() if record is not None])
+            self._writer.executemany('DELETE FROM messages WHERE id = ?',
+                                     [(key,) for key, record in pending.items() if record is None])
+
+        # discord IDs grow over time, so the lowest are the oldest. pruning
+        #   every so often rather than on every write keeps it cheap
+        self._written += len(pending)
+        if self._written >= max(self.max_rows // 10, 1):
+            self._written = 0
+            with self._writer:
+                self._writer.execute('DELETE FROM messages WHERE id <= '
+                                     '(SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?)', (self.max_rows,))
+
+    def _committed(self, future):
+        if future.exception() is not None:
+            self.logger.error('message map: failed to write %s: %s', self.path, future.exception())
+
+    def close(self):
+        """Write out anything pending, and wait for the writer to finish."""
+        if self.path is None:
+            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._executor.shutdown(wait=True)
+        if self._pending:
+            pending, self._pending = self._pending, collections.OrderedDict()
+            try:
+                self._commit(pending)
+            except sqlite3.Error as exc:
+                self.logger.error('message map: failed to write %s: %s', self.path, exc)
@@ -0,0 +1,389 @@
+# metrics registry, exposed in the prometheus text format
+import asyncio
+import bisect
+import math
+import time
+
+from aiohttp import web
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, suitable for relay latencies that include rate-limit queueing
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if value == -math.inf:
+        return '-Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+class _Value:
+    """A single labelled counter or gauge."""
+
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """Read the value from ``function()`` whenever we're collected."""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class _HistogramValue:
+    """A single labelled histogram."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        # the last bucket is +Inf, so every value lands somewhere
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    def quantile(self, fraction):
+        """Estimates a quantile the way Prometheus does, by interpolating within its bucket."""
+        if not self.count:
+            return math.nan
+        rank = fraction * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i]
+                if math.isinf(upper):
+                    return lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-2]
+
+
+class Metric:
+    """A named metric, with a child for each combination of label values.
+
+    Children are created by :meth:`labels` the first time they're asked
+    for, and can be kept around by callers so hot paths skip the lookup.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def _new_child(self):
+        return _Value()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        self._children.pop(tuple(str(value) for value in values), None)
+
+    def total(self):
+        """Returns the sum of every child's value, for counters and gauges."""
+        return sum(child.get() for child in self._children.values())
+
+    def samples(self):
+        """Yield ``(name, labels, value)`` for each of our samples."""
+        for values, child in sorted(self._children.items()):
+            yield self.name, _format_labels(self.labelnames, values), child.get()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       _format_labels(self.labelnames, values, [('le', _format_value(bound))]),
+                       cumulative)
+            labels = _format_labels(self.labelnames, values)
+            yield self.name + '_sum', labels, child.sum
+            yield self.name + '_count', labels, child.count
+
+
+class Registry:
+    """Holds a set of metrics, and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Metric {} is already registered'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return ''.join(metric.render() + '\n' for metric in self.metrics.values())
+
+
+class RelayMetrics:
+    """The metrics Itabashi keeps about itself.
+
+    The IM modules share one of these, and report messages they receive and
+    send through it. Relay latency is measured from when a message was
+    received to when the send to the other side completed, so it includes
+    any time spent waiting in the outbound queues.
+
+    Parameters
+    ----------
+    registry : Registry
+        Registry to create our metrics in, a new one by default.
+    """
+
+    def __init__(self, registry=None):
+        if registry is None:
+            registry = Registry()
+        self.registry = registry
+
+        self.messages_in = registry.counter(
+            'itabashi_messages_received_total',
+            'Messages received and dispatched, by link and the service they came from.',
+            ['link', 'service'])
+        self.messages_out = registry.counter(
+            'itabashi_messages_sent_total',
+            'Messages relayed, by link and the service they were sent to.',
+            ['link', 'service'])
+        self.flood_control = registry.counter(
+            'itabashi_messages_flood_controlled_total',
+            'Messages from flooding authors that were held back, dropped or summarized, by link, service and action.',
+            ['link', 'service', 'action'])
+        self.gateway_filtered = registry.counter(
+            'itabashi_gateway_events_filtered_total',
+            'Gateway events dropped on arrival because no link needs them, by service and event.',
+            ['service', 'event'])
+        self.relay_latency = registry.histogram(
+            'itabashi_relay_latency_seconds',
+            'Time from receiving a message to finishing sending it, by destination service.',
+            ['service'])
+        self.dispatch_latency = registry.histogram(
+            'itabashi_event_dispatch_seconds',
+            'Time spent queueing each event for its handlers.',
+            ['event'], buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1))
+        self.handler_latency = registry.histogram(
+            'itabashi_event_handler_seconds',
+            'Time each handler spent handling each event.',
+            ['event', 'handler'], buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1.0))
+        self.handler_wait = registry.histogram(
+            'itabashi_event_queue_wait_seconds',
+            'Time events waited in the queue of each handler before being handled.',
+            ['event', 'handler'], buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 1.0))
+        self.handler_depth = registry.gauge(
+            'itabashi_event_queue_depth',
+            'Events waiting in the queue of each handler.',
+            ['event', 'handler'])
+        self.handler_dropped = registry.counter(
+            'itabashi_events_dropped_total',
+            'Events dropped because the queue of a handler was full.',
+            ['event', 'handler'])
+        self.pauses_expired = registry.counter(
+            'itabashi_event_pauses_expired_total',
+            'Times a full queue kept producers paused too long, and dropped its oldest events instead.')
+        self.reconnects = registry.counter(
+            'itabashi_reconnects_total',
+            'Reconnection attempts made, by service.',
+            ['service'])
+        self.queue_depth = registry.gauge(
+            'itabashi_send_queue_depth',
+            'Messages waiting in the outbound queues, by service.',
+            ['service'])
+        self.loop_lag = registry.gauge(
+            'itabashi_event_loop_lag_seconds',
+            'How late the most recent event loop lag check ran.')
+        self.loop_lag_histogram = registry.histogram(
+            'itabashi_event_loop_lag_check_seconds',
+            'How late each event loop lag check ran.',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+        self._lag_handle = None
+
+    # reporting
+    def received(self, links, service):
+        for link in links:
+            self.messages_in.labels(link, service).inc()
+
+    def flooded(self, links, service, action):
+        for link in links:
+            self.flood_control.labels(link, service, action).inc()
+
+    def filtered(self, service, event):
+        self.gateway_filtered.labels(service, event).inc()
+
+    def sent(self, links, service, received, count=1):
+        """Record ``count`` messages that were received at ``received`` being sent.
+
+        ``received`` is a :func:`time.monotonic` timestamp.
+        """
+        for link in links:
+            self.messages_out.labels(link, service).inc(count)
+        latency = self.relay_latency.labels(service)
+        elapsed = time.monotonic() - received
+        for _ in range(count):
+            latency.observe(elapsed)
+
+    def watch_backoff(self, service, backoff):
+        """Report the retries made by an :class:`~italib.backoff.ExponentialBackoff`."""
+        self.reconnects.labels(service).set_function(lambda: backoff.retries)
+
+    def watch_reconnects(self, service, count):
+        """Report the reconnection attempts returned by ``count()``."""
+        self.reconnects.labels(service).set_function(count)
+
+    def watch_queue(self, service, depth):
+        """Report the queue depth returned by ``depth()``."""
+        self.queue_depth.labels(service).set_function(depth)
+
+    def instrument(self, event_manager):
+        """Time every event dispatched through the given event bus, and every handler that runs."""
+        dispatch = event_manager.dispatch
+        register = event_manager.register
+        latency = self.dispatch_latency
+
+        def watch(subscription):
+            labels = (subscription.event, subscription.name)
+            self.handler_depth.labels(*labels).set_function(lambda: len(subscription))
+            self.handler_dropped.labels(*labels).set_function(lambda: subscription.dropped)
+
+        def watched_register(*args, **kwargs):
+            subscription = register(*args, **kwargs)
+            watch(subscription)
+            return subscription
+
+        on_handled = event_manager.on_handled
+
+        def handled(subscription, waited, took):
+            self.handler_wait.labels(subscription.event, subscription.name).observe(waited)
+            self.handler_latency.labels(subscription.event, subscription.name).observe(took)
+            if on_handled is not None:
+                on_handled(subscription, waited, took)
+
+        for subscription in event_manager.subscriptions:
+            watch(subscription)
+        self.pauses_expired.labels().set_function(lambda: event_manager.pauses_expired)
+        event_manager.register = watched_register
+        event_manager.on_handled = handled
+
+        def timed_dispatch(name, *args, **kwargs):
+            started = time.monotonic()
+            try:
+                return dispatch(name, *args, **kwargs)
+            finally:
+                latency.labels(name).observe(time.monotonic() - started)
+
+        event_manager.dispatch = timed_dispatch
+
+    def start_loop_monitor(self, interval=1.0):
+        """Measure event loop lag by checking how late a regular callback runs."""
+        loop = asyncio.get_event_loop()
+
+        def check(expected):
+            lag = max(loop.time() - expected, 0.0)
+            self.loop_lag.labels().set(lag)
+            self.loop_lag_histogram.labels().observe(lag)
+            schedule()
+
+        def schedule():
+            self._lag_handle = loop.call_later(interval, check, loop.time() + interval)
+
+        schedule()
+
+    def stop_loop_monitor(self):
+        if self._lag_handle is not None:
+            self._lag_handle.cancel()
+            self._lag_handle = None
+
+
+@asyncio.coroutine
+def start_metrics_server(registry, port, host='127.0.0.1'):
+    """Serve the given registry's metrics over HTTP at ``/metrics``.
+
+    Returns the listening server.
+    """
+    @asyncio.coroutine
+    def handle_metrics(request):
+        return web.Response(body=registry.render().encode('utf-8'),
+                            headers={'Content-Type': CONTENT_TYPE})
+
+    loop = asyncio.get_event_loop()
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/metrics', handle_metrics)
+    return (yield from loop.create_server(app.make_handler(), host, port))
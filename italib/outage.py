@@ -0,0 +1,136 @@
+# holding messages while the service they're going to is disconnected
+import asyncio
+import collections
+
+from .ratelimit import TokenBucket
+
+
+class OutageBuffer:
+    """Holds messages while the service they're going to is unreachable.
+
+    Messages are passed to ``deliver(item)``, which returns False if the
+    message can't be delivered right now, in which case it's held. Each
+    link has its own bounded ring buffer, so during a long outage a busy
+    link only pushes out its own oldest messages. While a link has
+    messages held, new messages for it are held behind them so they stay
+    in order.
+
+    Once the service is back, :meth:`drain` sends the held messages,
+    taking turns between links, at no more than ``rate`` messages a
+    second so that reconnecting doesn't flood the other side. Draining
+    stops if every link's next message is refused, and should be started
+    again when the service comes back.
+
+    Parameters
+    ----------
+    logger
+        Logger to report dropped messages to.
+    deliver
+        Function called as ``deliver(item)``, which returns True if the
+        message was delivered.
+    maxlen : int
+        Messages held for each link. Defaults to 200.
+    rate : float
+        Messages delivered each second while draining. Defaults to 5.
+    burst : int
+        Messages that can be delivered at once while draining. Defaults to 10.
+    """
+
+    def __init__(self, logger, deliver, *, maxlen=200, rate=5.0, burst=10):
+        self.logger = logger
+        self.maxlen = maxlen
+        self.bucket = TokenBucket(rate, burst)
+
+        self._deliver = deliver
+        # link -> deque of held messages, for links that have any
+        self._buffers = collections.OrderedDict()
+        # links that have dropped messages since their buffer was last empty
+        self._overflowing = set()
+        self._task = None
+
+        # stats
+        self.held = 0
+        self.dropped = 0
+        self.drained = 0
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self._buffers.values())
+
+    @property
+    def stats(self):
+        return {
+            'depth': len(self),
+            'held': self.held,
+            'dropped': self.dropped,
+            'drained': self.drained,
+        }
+
+    def send(self, link, item):
+        """Deliver a message now, or hold it for later.
+
+        Returns True if the message was delivered straight away.
+        """
+        if link in self._buffers or not self._deliver(item):
+            self.hold(link, item)
+            return False
+        return True
+
+    def hold(self, link, item):
+        buffer = self._buffers.get(link)
+        if buffer is None:
+            buffer = self._buffers[link] = collections.deque(maxlen=self.maxlen)
+        if len(buffer) == self.maxlen:
+            # only warn once each time a link's buffer fills up
+            if link not in self._overflowing:
+                self._overflowing.add(link)
+                self.logger.warning('outage buffer for %s is full, dropping its oldest messages', link)
+            self.dropped += 1
+        buffer.append(item)
+        self.held += 1
+
+    def links(self):
+        """Returns the links that have messages held."""
+        return list(self._buffers)
+
+    def pending(self):
+        """Returns the messages held for each link, oldest first, without removing them."""
+        return {link: list(buffer) for link, buffer in self._buffers.items()}
+
+    def discard(self, link):
+        """Drop the messages held for a link, eg. because it's been removed."""
+        buffer = self._buffers.pop(link, None)
+        self._overflowing.discard(link)
+        if buffer:
+            self.dropped += len(buffer)
+
+    def drain(self):
+        """Start delivering held messages again."""
+        if self._task is None and self._buffers:
+            self._task = asyncio.ensure_future(self._drain())
+
+    @asyncio.coroutine
+    def _drain(self):
+        try:
+            while self._buffers:
+                delivered = False
+                for link in list(self._buffers):
+                    delay = self.bucket.delay()
+                    if delay:
+                        yield from asyncio.sleep(delay)
+
+                    buffer = self._buffers.get(link)
+                    if buffer is None or not self._deliver(buffer[0]):
+                        continue
+                    buffer.popleft()
+                    self.bucket.consume()
+                    self.drained += 1
+                    delivered = True
+                    if not buffer:
+                        del self._buffers[link]
+                        self._overflowing.discard(link)
+
+                # nothing can be delivered, so wait to be started again
+                if not delivered:
+                    break
+        finally:
+            self._task = None
@@ -0,0 +1,295 @@
+# folding joins, parts, quits and nick changes into summaries, so a netsplit
+#   is one message that's updated as it goes rather than hundreds
+import asyncio
+import collections
+import re
+import time
+
+from .formatting import escape_markdown
+
+# what happened on IRC
+JOIN = 'join'
+PART = 'part'
+QUIT = 'quit'
+NICK = 'nick'
+
+# where each nick ended up over a storm
+JOINED = 'joined'
+REJOINED = 'rejoined'
+LEFT = 'left'
+QUITTED = 'quit'
+BRIEF = 'brief'
+SPLIT = 'split'
+RETURNED = 'returned'
+
+# how each state is listed, in the order they're listed in
+_labels = [
+    (JOINED, 'Joined'),
+    (REJOINED, 'Rejoined'),
+    (LEFT, 'Left'),
+    (QUITTED, 'Quit'),
+    (BRIEF, 'Joined and left'),
+]
+
+# servers hide the real quit reason behind the two servers that split,
+#   eg. "irc.a.net irc.b.net", or "*.net *.split" on networks that hide them
+_split_reason = re.compile(r'^(\S+\.\S+) (\S+\.\S+)$')
+
+
+def split_servers(reason):
+    """Returns the two servers a netsplit QUIT reason names, or None if it isn't one."""
+    match = _split_reason.match(reason or '')
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+def _names(names, limit):
+    names = [escape_markdown(name) for name in names]
+    if len(names) <= limit:
+        return ', '.join(names)
+    return '{} and {} more'.format(', '.join(names[:limit]), len(names) - limit)
+
+
+class Storm:
+    """The presence changes in one channel that a single summary describes.
+
+    Each nick's changes are folded into the state they leave it in, eg. a
+    quit followed by a join is a rejoin, so however often someone's
+    connection drops they take one entry. Once ``max_nicks`` nicks are
+    being followed, changes for other nicks are only counted.
+    """
+
+    __slots__ = ('key', 'started', 'last', 'nicks', 'renames', 'untracked', 'splits', 'max_nicks',
+                 'version', 'rendered', 'published', 'next_update', 'queued', 'closed', 'message', 'handle')
+
+    def __init__(self, key, now, max_nicks):
+        self.key = key
+        self.started = now
+        self.last = now
+        self.max_nicks = max_nicks
+        # folded nick -> [nick, state, servers they split from]
+        self.nicks = collections.OrderedDict()
+        # folded nick -> (the nick they had when the storm started, their nick now)
+        self.renames = collections.OrderedDict()
+        self.untracked = 0
+        # nicks lost in a netsplit that haven't come back
+        self.splits = 0
+
+        # bumped on every change, so we know when the summary's out of date
+        self.version = 0
+        self.rendered = 0
+        self.published = 0
+        self.next_update = now
+        self.queued = False
+        self.closed = False
+
+        # the summary message, once it's been posted
+        self.message = None
+        self.handle = None
+
+    def _entry(self, nick):
+        folded = nick.lower()
+        entry = self.nicks.get(folded)
+        if entry is None and len(self.nicks) < self.max_nicks:
+            entry = self.nicks[folded] = [nick, None, None]
+        return entry
+
+    def add(self, kind, nick, detail=None):
+        self.version += 1
+        if kind == NICK:
+            self._rename(nick, detail)
+            return
+        entry = self._entry(nick)
+        if entry is None:
+            self.untracked += 1
+            return
+        state = entry[1]
+        if kind == JOIN:
+            if state is None or state == BRIEF:
+                state = JOINED
+            elif state in (LEFT, QUITTED):
+                state = REJOINED
+            elif state == SPLIT:
+                state = RETURNED
+        else:
+            servers = split_servers(detail) if kind == QUIT else None
+            if state in (JOINED, BRIEF):
+                state = BRIEF
+            elif servers is not None:
+                state = SPLIT
+                entry[2] = servers
+            else:
+                state = LEFT if kind == PART else QUITTED
+        self.splits += (state == SPLIT) - (entry[1] == SPLIT)
+        entry[1] = state
+
+    def _rename(self, old, new):
+        folded, new_folded = old.lower(), new.lower()
+        entry = self.nicks.pop(folded, None)
+        if entry is not None:
+            entry[0] = new
+            self.nicks[new_folded] = entry
+        original = self.renames.pop(folded, (old, None))[0]
+        if original.lower() != new_folded and len(self.renames) < self.max_nicks:
+            self.renames[new_folded] = (original, new)
+
+    def render(self, max_names=20):
+        """Returns the summary's text, as Discord markdown."""
+        self.rendered = self.version
+        by_state = collections.defaultdict(list)
+        splits = collections.OrderedDict()
+        for nick, state, servers in self.nicks.values():
+            if state in (SPLIT, RETURNED):
+                counts = splits.setdefault(servers, [0, 0])
+                counts[0] += 1
+                counts[1] += state == RETURNED
+            elif state is not None:
+                by_state[state].append(nick)
+
+        lines = []
+        for servers, (lost, back) in splits.items():
+            lines.append('**Netsplit** between {} and {}: {} lost, {} back'.format(
+                escape_markdown(servers[0]), escape_markdown(servers[1]), lost, back))
+        for state, label in _labels:
+            if by_state[state]:
+                lines.append('**{}:** {}'.format(label, _names(by_state[state], max_names)))
+        if self.renames:
+            renames = ['{} → {}'.format(original, new) for original, new in self.renames.values()]
+            lines.append('**Nick changes:** {}'.format(_names(renames, max_names)))
+        if self.untracked:
+            lines.append('…and {} more changes'.format(self.untracked))
+        return '\n'.join(lines)
+
+
+class PresenceAggregator:
+    """Folds the presence changes in each channel into storms, and publishes their summaries.
+
+    The first change in a quiet channel starts a storm, which gathers
+    changes for ``delay`` seconds before its summary is published. Changes
+    after that update the same summary, no more often than every
+    ``interval`` seconds. A storm ends once its channel has been quiet for
+    ``quiet`` seconds, or ``split_quiet`` seconds while users lost in a
+    netsplit haven't come back, or once it's ``max_age`` seconds old, and
+    the next change starts a new one.
+
+    Memory is bounded by following at most ``max_nicks`` nicks in each of
+    at most ``max_storms`` storms. Storms are forgotten once they've ended.
+
+    Parameters
+    ----------
+    publish
+        Function called as ``publish(storm)`` when a storm's summary should
+        be posted or updated. :meth:`published` must be called once it has.
+    delay : float
+        Seconds a storm gathers changes before it's first published. Defaults to 5.
+    interval : float
+        Least seconds between updates of a summary. Defaults to 10.
+    quiet : float
+        Seconds without changes that end a storm. Defaults to 60.
+    split_quiet : float
+        Seconds without changes that end a storm with users still split. Defaults to 600.
+    max_age : float
+        Seconds after which a storm ends regardless. Defaults to 1800.
+    max_nicks : int
+        Most nicks a storm follows. Defaults to 1000.
+    max_storms : int
+        Most storms followed at once. Defaults to 1000.
+    """
+
+    def __init__(self, publish, *, delay=5.0, interval=10.0, quiet=60.0, split_quiet=600.0, max_age=1800.0,
+                 max_nicks=1000, max_storms=1000):
+        self.publish = publish
+        self.delay = delay
+        self.interval = interval
+        self.quiet = quiet
+        self.split_quiet = split_quiet
+        self.max_age = max_age
+        self.max_nicks = max_nicks
+        self.max_storms = max_storms
+
+        # channel key -> open storm, least recently changed first
+        self.storms = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.storms)
+
+    def add(self, key, kind, nick, detail=None):
+        """Fold a change into the storm in the given channel, starting one if needed."""
+        now = time.monotonic()
+        storm = self.storms.get(key)
+        if storm is not None and self._ended(storm, now):
+            self._close(storm)
+            storm = None
+        if storm is None:
+            storm = Storm(key, now, self.max_nicks)
+            storm.next_update = now + self.delay
+            self.storms[key] = storm
+            while len(self.storms) > self.max_storms:
+                self._close(next(iter(self.storms.values())))
+        else:
+            self.storms.move_to_end(key)
+
+        storm.add(kind, nick, detail)
+        storm.last = now
+        if not storm.queued:
+            self._schedule(storm, storm.next_update - now)
+
+    def published(self, storm):
+        """Note that a storm's summary has been posted or updated, or couldn't be."""
+        storm.queued = False
+        storm.published = storm.rendered
+        storm.next_update = time.monotonic() + self.interval
+        if not storm.closed or storm.version != storm.published:
+            self._schedule(storm, self.interval if storm.version != storm.published else self._expiry(storm))
+
+    def discard(self, storm):
+        """Give up on publishing a storm, eg. because its channel can't be found."""
+        storm.queued = False
+        storm.published = storm.version
+        self._close(storm)
+
+    def close(self):
+        for storm in list(self.storms.values()):
+            self._close(storm)
+
+    def _ended(self, storm, now):
+        return now - storm.last >= self._quiet(storm) or now - storm.started >= self.max_age
+
+    def _quiet(self, storm):
+        return self.split_quiet if storm.splits else self.quiet
+
+    def _expiry(self, storm):
+        return storm.last + self._quiet(storm) - time.monotonic()
+
+    def _schedule(self, storm, delay):
+        if storm.handle is not None:
+            storm.handle.cancel()
+        storm.handle = asyncio.get_event_loop().call_later(max(delay, 0), self._check, storm)
+
+    def _check(self, storm):
+        storm.handle = None
+        if storm.queued:
+            # published() carries on from here
+            return
+        now = time.monotonic()
+        if storm.version != storm.published:
+            if now >= storm.next_update:
+                storm.queued = True
+                self.publish(storm)
+            else:
+                self._schedule(storm, storm.next_update - now)
+        elif storm.closed or self._ended(storm, now):
+            self._close(storm)
+        else:
+            self._schedule(storm, self._expiry(storm))
+
+    def _close(self, storm):
+        # a storm that's closed with changes it hasn't published yet still
+        #   publishes them, it just doesn't take any more
+        storm.closed = True
+        if self.storms.get(storm.key) is storm:
+            del self.storms[storm.key]
+        if storm.handle is not None and storm.version == storm.published:
+            storm.handle.cancel()
+            storm.handle = None
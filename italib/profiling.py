@@ -0,0 +1,367 @@
+# finding out where the event loop's time goes
+import asyncio
+import collections
+import cProfile
+import gc
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from girc.ircreactor import events as girc_events
+
+from .events import handler_name
+
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+
+
+class HandlerStats:
+    """How often a handler ran, and how long it took."""
+
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, took):
+        self.count += 1
+        self.total += took
+        if took > self.max:
+            self.max = took
+
+
+def _coroutine_name(coro):
+    frame = getattr(coro, 'gi_frame', None) or getattr(coro, 'cr_frame', None)
+    # discord.py runs every event handler through the same coroutine, which
+    #   is told the name of the handler to run
+    if frame is not None and frame.f_code.co_name == '_run_event':
+        owner = frame.f_locals.get('self')
+        event = frame.f_locals.get('event')
+        if owner is not None and isinstance(event, str):
+            return handler_name(getattr(owner, event, None) or event)
+    return getattr(coro, '__qualname__', None) or repr(coro)
+
+
+def _coroutine_chain(coro):
+    """Returns the names of the coroutines a coroutine is waiting on, outermost first."""
+    names = []
+    while coro is not None and (hasattr(coro, 'gi_frame') or hasattr(coro, 'cr_frame')):
+        names.append(getattr(coro, '__qualname__', None) or repr(coro))
+        coro = getattr(coro, 'gi_yieldfrom', None) or getattr(coro, 'cr_await', None)
+    return names
+
+
+def _callback_task(callback):
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        return owner
+    if type(callback).__name__ == 'TaskWakeupMethWrapper':
+        # the C task implementation doesn't say which task it's waking up
+        for referent in gc.get_referents(callback):
+            if isinstance(referent, asyncio.Task):
+                return referent
+    return None
+
+
+def _format_stack(frame, limit=8):
+    lines = []
+    for filename, lineno, name, _ in traceback.extract_stack(frame)[-limit:]:
+        lines.append('{}:{} {}'.format(os.path.basename(filename), lineno, name))
+    return ' < '.join(reversed(lines))
+
+
+class Profiler:
+    """Watches the event loop, and reports where its time goes.
+
+    Once started, this:
+
+    * Times every girc and event bus handler, and logs the handlers that
+      took the most time every ``report_interval`` seconds.
+    * Times every callback the event loop runs, and logs those that take
+      longer than ``slow_callback`` seconds, named after the coroutine or
+      protocol they ran, along with the handlers that ran inside them.
+    * Schedules a heartbeat every ``heartbeat`` seconds, which a watchdog
+      thread checks. If the loop misses its heartbeats for ``stall``
+      seconds, the watchdog logs the stack the loop is stuck in.
+    * If ``directory`` is given, writes a profile snapshot there every
+      ``snapshot_interval`` seconds, covering ``snapshot_duration`` seconds.
+      ``sample`` snapshots are the loop's stacks sampled ``sample_rate``
+      times a second, in the folded format flame graph tools read, and
+      ``cprofile`` snapshots are :mod:`cProfile` stats.
+
+    Only the snapshots cost much, and they're only taken for a small part
+    of the time.
+
+    Parameters
+    ----------
+    logger
+        Logger to write reports to.
+    slow_callback : float
+        Callbacks that take longer than this many seconds are logged.
+        Defaults to 0.05.
+    heartbeat : float
+        Seconds between heartbeats. Defaults to 0.1.
+    stall : float
+        Seconds without a heartbeat that count as a stall. Defaults to 0.5.
+    report_interval : float
+        Seconds between handler reports, 0 to not log them. Defaults to 60.
+    directory : str
+        Directory to write profile snapshots to, or None to not take any.
+    kind : str
+        ``sample`` or ``cprofile``. Defaults to ``sample``.
+    snapshot_interval : float
+        Seconds between the start of each snapshot. Defaults to 600.
+    snapshot_duration : float
+        Seconds each snapshot covers. Defaults to 10.
+    sample_rate : float
+        Stacks sampled each second for ``sample`` snapshots. Defaults to 100.
+    """
+
+    def __init__(self, logger, *, slow_callback=0.05, heartbeat=0.1, stall=0.5, report_interval=60.0,
+                 directory=None, kind=SAMPLE, snapshot_interval=600.0, snapshot_duration=10.0, sample_rate=100.0):
+        if kind not in (SAMPLE, CPROFILE):
+            raise ValueError('Unknown profile kind: {}'.format(kind))
+        self.logger = logger
+        self.slow_callback = slow_callback
+        self.heartbeat = heartbeat
+        self.stall = stall
+        self.report_interval = report_interval
+        self.directory = directory
+        self.kind = kind
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_duration = snapshot_duration
+        self.sample_rate = sample_rate
+
+        # handler name -> stats, since the last report and since we started
+        self.handlers = collections.defaultdict(HandlerStats)
+        self.totals = collections.defaultdict(HandlerStats)
+        self.slow_callbacks = 0
+        self.stalls = 0
+        self.max_lag = 0.0
+        self.snapshots = []
+
+        # names of the tasks we've seen start
+        self._task_names = weakref.WeakKeyDictionary()
+        # handlers that have run inside the current callback
+        self._ran = None
+        self._last_beat = time.monotonic()
+        self._beat_handle = None
+        self._report_handle = None
+        self._snapshot_handle = None
+        self._snapshot_count = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._loop_thread = None
+        self._originals = None
+
+    # recording
+    def record(self, name, took):
+        """Record a handler called ``name`` taking ``took`` seconds."""
+        self.handlers[name].add(took)
+        if self._ran is not None:
+            self._ran.append((name, took))
+
+    def instrument(self, event_bus):
+        """Time the handlers of the given event bus."""
+        on_handled = event_bus.on_handled
+
+        def handled(subscription, waited, took):
+            self.record(subscription.name, took)
+            if on_handled is not None:
+                on_handled(subscription, waited, took)
+
+        event_bus.on_handled = handled
+
+    def _describe(self, handle, task):
+        if task is not None:
+            name = self._task_names.get(task) or _coroutine_name(task._coro)
+            chain = _coroutine_chain(task._coro)[1:] if not task.done() else []
+            return ' > '.join([name] + chain)
+        callback = handle._callback
+        protocol = getattr(getattr(callback, '__self__', None), '_protocol', None)
+        if protocol is not None:
+            return '{}.data_received'.format(type(protocol).__name__)
+        return handler_name(callback)
+
+    # starting and stopping
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        self._patch()
+
+        self._beat()
+        self._thread = threading.Thread(target=self._watch, name='itabashi-watchdog', daemon=True)
+        self._thread.start()
+
+        if self.report_interval:
+            self._report_handle = loop.call_later(self.report_interval, self._report)
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._snapshot_handle = loop.call_later(self.snapshot_interval, self._scheduled_snapshot)
+
+    def stop(self):
+        self._stopping.set()
+        for handle in (self._beat_handle, self._report_handle, self._snapshot_handle):
+            if handle is not None:
+                handle.cancel()
+        self._unpatch()
+
+    def _patch(self):
+        profiler = self
+        handle_run = asyncio.events.Handle._run
+        girc_dispatch = girc_events.EventObject.dispatch
+
+        names = {}
+
+        def run(handle):
+            callback = handle._callback
+            frame = getattr(getattr(getattr(callback, '__self__', None), '_coro', None), 'gi_frame', None)
+            if frame is not None and frame.f_lasti < 0:
+                task = callback.__self__
+                # name tasks as they start, while discord.py's event runner
+                #   can still tell us which handler it's running
+                profiler._task_names[task] = _coroutine_name(task._coro)
+
+            outer = profiler._ran
+            profiler._ran = ran = []
+            started = time.perf_counter()
+            try:
+                handle_run(handle)
+            finally:
+                took = time.perf_counter() - started
+                profiler._ran = outer
+            if took >= profiler.slow_callback:
+                profiler._slow(handle, _callback_task(callback), took, ran)
+
+        def dispatch(event_object, ev_msg):
+            for subscriber in event_object.subscribers:
+                started = time.perf_counter()
+                subscriber.callable(ev_msg)
+                took = time.perf_counter() - started
+                name = names.get(subscriber.callable)
+                if name is None:
+                    name = names[subscriber.callable] = handler_name(subscriber.callable)
+                profiler.record(name, took)
+
+        asyncio.events.Handle._run = run
+        girc_events.EventObject.dispatch = dispatch
+        self._originals = (handle_run, girc_dispatch)
+
+    def _unpatch(self):
+        if self._originals is not None:
+            asyncio.events.Handle._run, girc_events.EventObject.dispatch = self._originals
+            self._originals = None
+
+    # slow callbacks
+    def _slow(self, handle, task, took, ran):
+        self.slow_callbacks += 1
+        inside = collections.Counter()
+        for name, handler_took in ran:
+            inside[name] += handler_took
+        details = ', '.join('{} {:.1f}ms'.format(name, handler_took * 1000)
+                            for name, handler_took in inside.most_common(5))
+        self.logger.warning('profile: callback %s took %.1fms%s', self._describe(handle, task), took * 1000,
+                            ', in ' + details if details else '')
+
+    # stalls
+    def _beat(self):
+        now = time.monotonic()
+        lag = now - self._last_beat - self.heartbeat if self._beat_handle is not None else 0.0
+        self.max_lag = max(self.max_lag, lag)
+        self._last_beat = now
+        self._beat_handle = asyncio.get_event_loop().call_later(self.heartbeat, self._beat)
+
+    def _watch(self):
+        stalled = False
+        while not self._stopping.wait(self.stall / 2):
+            quiet = time.monotonic() - self._last_beat
+            if quiet < self.stall + self.heartbeat:
+                stalled = False
+                continue
+            if stalled:
+                continue
+            # only report each stall once, with where it's stuck
+            stalled = True
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread)
+            self.logger.warning('profile: event loop stalled for %.2fs in %s', quiet,
+                                _format_stack(frame) if frame is not None else 'unknown')
+
+    # reports
+    def report(self, limit=10):
+        """Returns the handlers that have taken the most time since we started, with their stats."""
+        for name, stats in self.handlers.items():
+            total = self.totals[name]
+            total.count += stats.count
+            total.total += stats.total
+            total.max = max(total.max, stats.max)
+        self.handlers.clear()
+        busiest = sorted(self.totals.items(), key=lambda item: -item[1].total)[:limit]
+        return [(name, stats.count, stats.total, stats.max) for name, stats in busiest]
+
+    def _report(self):
+        self._report_handle = asyncio.get_event_loop().call_later(self.report_interval, self._report)
+        busiest = sorted(self.handlers.items(), key=lambda item: -item[1].total)[:10]
+        self.report()
+        if not busiest:
+            return
+        self.logger.info('profile: over the last %ds, max loop lag %.1fms, %s slow callbacks, %s stalls. '
+                         'busiest handlers: %s', self.report_interval, self.max_lag * 1000, self.slow_callbacks,
+                         self.stalls, ', '.join('{} {}x {:.1f}ms (max {:.1f}ms)'.format(
+                             name, stats.count, stats.total * 1000, stats.max * 1000) for name, stats in busiest))
+        self.max_lag = 0.0
+
+    # snapshots
+    def _scheduled_snapshot(self):
+        self._snapshot_handle = asyncio.get_event_loop().call_later(self.snapshot_interval,
+                                                                    self._scheduled_snapshot)
+        self.snapshot()
+
+    def snapshot(self):
+        """Write a profile snapshot of the next ``snapshot_duration`` seconds."""
+        loop = asyncio.get_event_loop()
+        self._snapshot_count += 1
+        path = os.path.join(self.directory, 'profile-{}-{}.{}'.format(
+            time.strftime('%Y%m%d-%H%M%S'), self._snapshot_count, 'folded' if self.kind == SAMPLE else 'pstats'))
+
+        if self.kind == CPROFILE:
+            profile = cProfile.Profile()
+            profile.enable()
+
+            def finish():
+                profile.disable()
+                profile.dump_stats(path)
+                self._saved(path)
+
+            loop.call_later(self.snapshot_duration, finish)
+        else:
+            threading.Thread(target=self._sample, args=(path,), name='itabashi-sampler', daemon=True).start()
+
+    def _sample(self, path):
+        stacks = collections.Counter()
+        interval = 1 / self.sample_rate
+        deadline = time.monotonic() + self.snapshot_duration
+        while time.monotonic() < deadline and not self._stopping.is_set():
+            frame = sys._current_frames().get(self._loop_thread)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if names:
+                stacks[';'.join(reversed(names))] += 1
+            time.sleep(interval)
+
+        with open(path, 'w') as snapshot:
+            for stack, count in stacks.most_common():
+                snapshot.write('{} {}\n'.format(stack, count))
+        self._saved(path)
+
+    def _saved(self, path):
+        self.snapshots.append(path)
+        self.logger.info('profile: wrote %s', path)
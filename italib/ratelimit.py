@@ -0,0 +1,114 @@
+# rate limiting primitives shared by the IM modules
+import time
+
+
+class RateLimit:
+    """A fixed-window rate limit, modelled on Discord's rate-limit buckets.
+
+    Allows ``limit`` calls every ``per`` seconds. The window starts on the
+    first call after the previous window has expired, just like Discord's
+    buckets do, and can be overridden from server-provided values with
+    :meth:`update` and :meth:`exhaust`.
+
+    Parameters
+    ----------
+    limit : int
+        Number of calls allowed in each window.
+    per : float
+        Length of each window in seconds.
+    """
+
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+
+        self._remaining = limit
+        self._reset_at = 0.0
+
+    def _refresh(self, now):
+        if now >= self._reset_at:
+            self._remaining = self.limit
+            self._reset_at = now + self.per
+
+    def delay(self):
+        """Return how many seconds to wait before the next call is allowed."""
+        now = time.monotonic()
+        if now >= self._reset_at or self._remaining > 0:
+            return 0.0
+        return self._reset_at - now
+
+    def reset_in(self):
+        """Return how many seconds until the current window ends, 0 once it has."""
+        return max(self._reset_at - time.monotonic(), 0.0)
+
+    def hit(self):
+        """Record a call against this bucket."""
+        self._refresh(time.monotonic())
+        self._remaining = max(self._remaining - 1, 0)
+
+    def update(self, remaining, reset_after):
+        """Sync the bucket with values reported by the server."""
+        self._remaining = remaining
+        self._reset_at = time.monotonic() + reset_after
+
+    def exhaust(self, retry_after=None):
+        """Empty the bucket, eg. after the server replied with a 429."""
+        if retry_after is None:
+            retry_after = self.per
+        self.update(0, retry_after)
+
+
+class TokenBucket:
+    """A token bucket, as used by IRC servers for flood control.
+
+    Holds up to ``capacity`` tokens and regains ``rate`` tokens a second.
+    Each call takes one token, letting short bursts through while keeping
+    the long-term rate at ``rate`` calls a second.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens regained each second.
+    capacity : float
+        Maximum number of tokens, ie. the largest allowed burst.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def delay(self, amount=1):
+        """Return how many seconds until ``amount`` tokens are available."""
+        self._refill()
+        if self._tokens >= amount:
+            return 0.0
+        return (amount - self._tokens) / self.rate
+
+    def consume(self, amount=1):
+        """Take tokens if they're available, returning True if they were."""
+        self._refill()
+        if self._tokens >= amount:
+            self._tokens -= amount
+            return True
+        return False
+
+    def charge(self, amount=1):
+        """Take tokens unconditionally, eg. for lines sent around the bucket.
+
+        The bucket may go into debt, down to ``-capacity`` tokens.
+        """
+        self._refill()
+        self._tokens = max(self._tokens - amount, -self.capacity)
@@ -0,0 +1,85 @@
+# the messages the IM modules pass each other
+import sys
+
+# what a message is
+MESSAGE = 'message'
+ACTION = 'action'
+
+
+def _intern(name):
+    # libraries hand us str subclasses, eg. girc's case-insensitive strings,
+    #   which can't be interned and are what we're trying not to keep
+    return sys.intern(str(name))
+
+
+class RelayMessage:
+    """A message received on one service, to be relayed to the others.
+
+    IM modules dispatch these for the messages they receive rather than the
+    objects their libraries hand them, so queued and archived messages
+    don't keep a library's channels, users and servers alive, and handlers
+    don't each have to dig the names they need back out of them. Messages
+    can't be changed once they're made, since every handler shares the
+    same one. Names are interned as plain strings, since the same few
+    appear over and over.
+
+    Parameters
+    ----------
+    service : str
+        Service the message was received on, ``'irc'`` or ``'discord'``,
+        which is the direction it's relayed in.
+    kind : str
+        :data:`MESSAGE`, or :data:`ACTION` for IRC's ``/me``.
+    links : tuple
+        Names of the links the message's channel belongs to.
+    channel : str
+        The IRC channel's name, or the Discord channel's ID.
+    author : str
+        The sender's IRC nick, or their Discord username.
+    text : str
+        The message as plain text.
+    formatted : str
+        The message with its formatting as IRC formatting codes.
+    received : float
+        The :func:`time.monotonic` time the message was received.
+    network : str
+        The IRC network the message was received on.
+    discriminator : str
+        The sender's Discord discriminator.
+    message_id : str
+        The Discord message's ID.
+    """
+
+    __slots__ = ('service', 'kind', 'links', 'channel', 'author', 'text', 'formatted', 'received', 'network',
+                 'discriminator', 'message_id')
+
+    def __init__(self, service, kind, links, channel, author, text, formatted, received, *, network=None,
+                 discriminator=None, message_id=None):
+        set_field = object.__setattr__
+        set_field(self, 'service', service)
+        set_field(self, 'kind', kind)
+        set_field(self, 'links', links)
+        set_field(self, 'channel', _intern(channel))
+        set_field(self, 'author', _intern(author))
+        set_field(self, 'text', text)
+        set_field(self, 'formatted', formatted)
+        set_field(self, 'received', received)
+        set_field(self, 'network', network if network is None else _intern(network))
+        set_field(self, 'discriminator', discriminator if discriminator is None else _intern(discriminator))
+        set_field(self, 'message_id', message_id)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('relay messages cannot be changed')
+
+    def __delattr__(self, name):
+        raise AttributeError('relay messages cannot be changed')
+
+    def __repr__(self):
+        return '<RelayMessage {} {} in {} from {}>'.format(self.service, self.kind, self.channel, self.tag)
+
+    @property
+    def tag(self):
+        """The sender as ``name#1234`` for Discord, or their nick for IRC."""
+        if self.discriminator is None:
+            return self.author
+        return '{}#{}'.format(self.author, self.discriminator)
@@ -0,0 +1,164 @@
+# precompiled link routing shared by the IM modules
+import string
+
+# characters each IRC casemapping considers to be upper/lower-case pairs
+_casemaps = {
+    'ascii': (string.ascii_uppercase, string.ascii_lowercase),
+    'rfc1459': (string.ascii_uppercase + '[]\\^', string.ascii_lowercase + '{}|~'),
+    'strict-rfc1459': (string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+    'rfc1459-strict': (string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|'),
+}
+
+# network used by links that don't name one
+DEFAULT_NETWORK = 'default'
+
+
+def irc_casemap_table(casemapping):
+    """Returns a str.translate table lower-casing names under the given casemapping."""
+    upper, lower = _casemaps.get(casemapping.lower(), _casemaps['rfc1459'])
+    return str.maketrans(upper, lower)
+
+
+def is_discord_id(value):
+    """Returns True if the given Discord channel reference is an ID."""
+    return isinstance(value, str) and value.isdigit()
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+class LinkRouter:
+    """Compiles ``config['links']`` into hashed routing tables.
+
+    Channels are stored under a normalised key for their service: IRC
+    channels are referred to as ``(network, channel)`` pairs, taking the
+    network from the link's optional ``network`` key, and their names are
+    lower-cased using that network's casemapping. Plain IRC channel names
+    are taken to be on :data:`DEFAULT_NETWORK`. Discord channels are
+    keyed on their ID, or on their lower-cased name until
+    :meth:`bind_discord_id` tells us the ID for that name. Each key
+    maps straight to its destinations on every other service, so finding
+    where a message should go is a single dict lookup however many links
+    there are.
+
+    A link's channel may be given as a single channel or a list of them, and
+    channels may appear in as many links as desired, so links can be
+    many-to-many.
+
+    Parameters
+    ----------
+    links : dict
+        The ``links`` section of the config.
+    casemapping : str
+        IRC casemapping to start with on every network. Defaults to rfc1459,
+        and should be updated with :meth:`set_casemapping` once each
+        network's ISUPPORT arrives.
+    """
+
+    def __init__(self, links, casemapping='rfc1459'):
+        self.links = links
+        self.casemapping = casemapping
+        self._default_trans = irc_casemap_table(casemapping)
+
+        # network -> (casemapping, str.translate table), for networks that differ from the default
+        self._irc_trans = {}
+
+        # names we've learnt Discord IDs for, so we can rebind them on recompile
+        self._discord_ids = {}
+
+        self.compile()
+
+    def set_casemapping(self, casemapping, network=DEFAULT_NETWORK):
+        """Recompile our tables with the given casemapping for an IRC network."""
+        current = self._irc_trans.get(network, (self.casemapping, None))[0]
+        if casemapping == current:
+            return
+        self._irc_trans[network] = (casemapping, irc_casemap_table(casemapping))
+        self.compile()
+
+    def key(self, service, channel):
+        """Returns the normalised routing key for the given channel."""
+        if service == 'irc':
+            if isinstance(channel, tuple):
+                network, channel = channel
+            else:
+                network = DEFAULT_NETWORK
+            trans = self._irc_trans.get(network, (None, self._default_trans))[1]
+            return network, str.translate(channel, trans)
+        elif service == 'discord':
+            if is_discord_id(channel):
+                return channel
+            channel = channel.lower().lstrip('#')
+            return self._discord_ids.get(channel, channel)
+        return channel
+
+    def compile(self):
+        """Build the routing tables from our links."""
+        # (service, key) -> {target service: {destination key: destination}}
+        routes = {}
+        # (service, key) -> (link name, ...)
+        link_names = {}
+        # service -> (channel, ...) for every channel we watch on that service
+        channels = {}
+
+        for name, link in self.links.items():
+            link_channels = {service: _as_list(chans) for service, chans in link['channels'].items() if chans}
+            if 'irc' in link_channels:
+                network = link.get('network', DEFAULT_NETWORK)
+                link_channels['irc'] = [chan if isinstance(chan, tuple) else (network, chan)
+                                        for chan in link_channels['irc']]
+
+            for service, chans in link_channels.items():
+                for chan in chans:
+                    key = (service, self.key(service, chan))
+
+                    if key not in link_names:
+                        channels.setdefault(service, []).append(chan)
+                    if name not in link_names.setdefault(key, []):
+                        link_names[key].append(name)
+
+                    targets = routes.setdefault(key, {})
+                    for target_service, target_chans in link_channels.items():
+                        if target_service == service:
+                            continue
+                        dests = targets.setdefault(target_service, {})
+                        for target_chan in target_chans:
+                            dests.setdefault(self.key(target_service, target_chan), target_chan)
+
+        self._routes = {key: {service: tuple(dests.values()) for service, dests in targets.items()}
+                        for key, targets in routes.items()}
+        self._link_names = {key: tuple(names) for key, names in link_names.items()}
+        self.channels = {service: tuple(chans) for service, chans in channels.items()}
+        # discord channels links refer to by a name we don't know the ID of yet
+        self.unbound_discord_names = frozenset(key for service, key in self._routes
+                                               if service == 'discord' and not is_discord_id(key))
+
+    def update(self, links):
+        """Replace our links, eg. after the config has been reloaded."""
+        self.links = links
+        self.compile()
+
+    def bind_discord_id(self, name, channel_id):
+        """Tell us the ID of a Discord channel that links refer to by name."""
+        name = name.lower().lstrip('#')
+        if self._discord_ids.get(name) != channel_id:
+            self._discord_ids[name] = channel_id
+            self.compile()
+
+    def is_linked(self, service, channel):
+        """Returns True if the given channel is part of any link."""
+        return (service, self.key(service, channel)) in self._routes
+
+    def destinations(self, service, channel, target_service):
+        """Returns the channels on ``target_service`` that this channel relays to.
+
+        IRC channels are returned as ``(network, channel)`` pairs.
+        """
+        return self._routes.get((service, self.key(service, channel)), {}).get(target_service, ())
+
+    def links_for(self, service, channel):
+        """Returns the names of the links the given channel belongs to."""
+        return self._link_names.get((service, self.key(service, channel)), ())
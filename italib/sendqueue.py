@@ -0,0 +1,335 @@
+# ordered, rate-limited outbound send queues
+import asyncio
+import collections
+import time
+
+from .ratelimit import RateLimit
+
+# discord refuses messages longer than this
+MAX_MESSAGE_LENGTH = 2000
+
+
+def is_rate_limited(exc):
+    """Returns True if the given exception represents an HTTP 429."""
+    response = getattr(exc, 'response', None)
+    return getattr(response, 'status', None) == 429
+
+
+def retry_after(exc):
+    """Returns the Retry-After value of a 429 exception in seconds, or None."""
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers['Retry-After'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class _Entry:
+    """A single pending message, which consecutive lines may be merged into."""
+
+    __slots__ = ('key', 'header', 'lines', 'length', 'created', 'received', 'options')
+
+    def __init__(self, key, header, line, created, received, options):
+        self.key = key
+        self.header = header
+        self.lines = [line]
+        self.length = len(header) + len(line)
+        self.created = created
+        self.received = received
+        self.options = options
+
+    @property
+    def content(self):
+        return self.header + '\n'.join(self.lines)
+
+
+class ChannelSendQueue:
+    """Sends messages to a single destination in order, obeying rate limits.
+
+    Messages are held in a bounded queue and sent one at a time by a worker
+    task which only runs while there is something to send. When the queue
+    is full its oldest message is dropped, rather than making whoever's
+    queueing wait, since they queue for every destination and one slow
+    destination shouldn't hold up the rest. Each destination
+    has its own rate-limit bucket, and an optional bucket can be shared
+    between queues to model global limits. When the server replies with a
+    429 the message is retried after the bucket resets, so order is kept.
+
+    Queues can be paused while the destination is unreachable, and hold
+    their messages until they're resumed. A message that fails to send
+    because we were paused while sending it is sent again on resume.
+
+    If ``coalesce`` is set, consecutive lines with the same ``key`` that
+    arrive within that many seconds of each other are merged into a single
+    message, so a burst of lines costs one API call instead of many.
+
+    Parameters
+    ----------
+    logger
+        Logger to report send failures and drops to.
+    send
+        Coroutine function called as ``send(destination, content, **options)``,
+        where ``options`` are those the message was queued with.
+    destination
+        The destination passed through to ``send``.
+    limit : int
+        Messages allowed per ``per`` seconds. Defaults to 5.
+    per : float
+        Rate-limit window in seconds. Defaults to 5.
+    maxsize : int
+        Maximum number of pending messages. Defaults to 100.
+    coalesce : float
+        Coalescing window in seconds, 0 disables coalescing. Defaults to 0.
+    shared_bucket : RateLimit
+        Optional bucket shared with other queues.
+    max_retries : int
+        How many times to retry a rate-limited message. Defaults to 5.
+    on_sent
+        Optional function called as ``on_sent(destination, received, count)``
+        after each successful send, where ``received`` is the monotonic time
+        the oldest line in the message was received and ``count`` is the
+        number of lines it carried.
+    on_idle
+        Optional function called as ``on_idle(queue)`` when the queue has
+        sent everything it had.
+    """
+
+    def __init__(self, logger, send, destination, *, limit=5, per=5.0,
+                 maxsize=100, coalesce=0.0, shared_bucket=None, max_retries=5, on_sent=None, on_idle=None):
+        self.logger = logger
+        self.destination = destination
+        self.maxsize = maxsize
+        self.bucket = RateLimit(limit, per)
+
+        self._send = send
+        self._coalesce = coalesce
+        self._shared_bucket = shared_bucket
+        self._max_retries = max_retries
+        self._on_sent = on_sent
+        self._on_idle = on_idle
+
+        self._pending = collections.deque()
+        self._task = None
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+
+        # stats
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.retries = 0
+        self.failed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def full(self):
+        return len(self._pending) >= self.maxsize
+
+    @property
+    def paused(self):
+        return not self._resumed.is_set()
+
+    @property
+    def idle(self):
+        """True if we have nothing to send."""
+        return not self._pending and self._task is None
+
+    def pause(self):
+        self._resumed.clear()
+
+    def resume(self):
+        self._resumed.set()
+
+    def put_nowait(self, header, line, key=None, received=None, options=None):
+        """Queue a line, dropping the oldest pending message if we're full.
+
+        ``received`` is the monotonic time the line was received at, which
+        defaults to now. ``options`` are extra keyword arguments to send the
+        message with, and lines are only coalesced with a message that has
+        the same options. Returns False if a message had to be dropped to
+        make room.
+        """
+        options = options or {}
+        now = time.monotonic()
+
+        if self._coalesce and key is not None and self._pending:
+            tail = self._pending[-1]
+            if (tail.key == key and tail.options == options and now - tail.created <= self._coalesce and
+                    tail.length + 1 + len(line) <= MAX_MESSAGE_LENGTH):
+                tail.lines.append(line)
+                tail.length += 1 + len(line)
+                self.coalesced += 1
+                return True
+
+        ok = True
+        if self.full():
+            self._pending.popleft()
+            self.dropped += 1
+            ok = False
+            self.logger.warning('send queue for %s is full, dropped oldest message', self.destination)
+
+        self._pending.append(_Entry(key, header, line, now, now if received is None else received, options))
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+        return ok
+
+    def _delay(self):
+        delay = self.bucket.delay()
+        if self._shared_bucket is not None:
+            delay = max(delay, self._shared_bucket.delay())
+        return delay
+
+    def _hit(self):
+        self.bucket.hit()
+        if self._shared_bucket is not None:
+            self._shared_bucket.hit()
+
+    @asyncio.coroutine
+    def _run(self):
+        try:
+            while self._pending:
+                if self.paused:
+                    yield from self._resumed.wait()
+                    continue
+
+                # give a lone message the chance to gather following lines
+                if self._coalesce and len(self._pending) == 1:
+                    age = time.monotonic() - self._pending[0].created
+                    if age < self._coalesce:
+                        yield from asyncio.sleep(self._coalesce - age)
+                        continue
+
+                delay = self._delay()
+                if delay:
+                    yield from asyncio.sleep(delay)
+                    continue
+
+                entry = self._pending.popleft()
+                sent = yield from self._deliver(entry.content, entry.options)
+                if sent is None:
+                    self._pending.appendleft(entry)
+                    continue
+                if sent and self._on_sent is not None:
+                    self._on_sent(self.destination, entry.received, len(entry.lines))
+        finally:
+            self._task = None
+        if self._on_idle is not None:
+            self._on_idle(self)
+
+    @asyncio.coroutine
+    def _deliver(self, content, options):
+        """Send a message.
+
+        Returns True if it was sent, False if it failed, or None if it failed
+        because we were paused and should be sent again once we're resumed.
+        """
+        attempt = 0
+        while True:
+            self._hit()
+            try:
+                yield from self._send(self.destination, content, **options)
+            except Exception as exc:
+                if is_rate_limited(exc) and attempt < self._max_retries:
+                    attempt += 1
+                    self.retries += 1
+                    self.bucket.exhaust(retry_after(exc))
+                    yield from asyncio.sleep(self._delay())
+                    continue
+                if self.paused:
+                    return None
+                self.failed += 1
+                self.logger.exception('failed to send message to %s', self.destination)
+                return False
+            self.sent += 1
+            return True
+
+
+class SendScheduler:
+    """Manages a :class:`ChannelSendQueue` for each destination.
+
+    Queues are created when a destination is first sent to, keyed on the
+    destination's ``id`` where it has one, and dropped once they're empty
+    and their rate-limit window has passed, so destinations we no longer
+    send to don't keep theirs. All queues share a global bucket of
+    ``global_limit`` messages per ``global_per`` seconds. Other keyword
+    arguments are passed through to each queue.
+    """
+
+    def __init__(self, logger, send, *, global_limit=50, global_per=1.0, **queue_options):
+        self.logger = logger
+        self.queues = {}
+        self.global_bucket = RateLimit(global_limit, global_per)
+
+        self._send = send
+        self._queue_options = queue_options
+        self.paused = False
+
+        # destination key -> handle of the check that drops its queue
+        self._expiring = {}
+        # stats of the queues we've dropped
+        self._retired = collections.Counter()
+
+    def queue_for(self, destination):
+        key = getattr(destination, 'id', destination)
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = ChannelSendQueue(self.logger, self._send, destination, shared_bucket=self.global_bucket,
+                                     on_idle=self._idle, **self._queue_options)
+            if self.paused:
+                queue.pause()
+            self.queues[key] = queue
+            # queues that are only used for their bucket never go idle
+            self._expire_later(key, queue)
+        return queue
+
+    def _idle(self, queue):
+        key = getattr(queue.destination, 'id', queue.destination)
+        if self.queues.get(key) is queue:
+            self._expire_later(key, queue)
+
+    def _expire_later(self, key, queue):
+        if key not in self._expiring:
+            self._expiring[key] = asyncio.get_event_loop().call_later(queue.bucket.reset_in(), self._expire, key)
+
+    def _expire(self, key):
+        del self._expiring[key]
+        queue = self.queues.get(key)
+        if queue is None or not queue.idle:
+            # a busy queue checks again once it's sent everything
+            return
+        if queue.bucket.reset_in():
+            self._expire_later(key, queue)
+            return
+        del self.queues[key]
+        for name in ('sent', 'dropped', 'coalesced', 'retries', 'failed'):
+            self._retired[name] += getattr(queue, name)
+
+    def put_nowait(self, destination, header, line, key=None, received=None, options=None):
+        return self.queue_for(destination).put_nowait(header, line, key=key, received=received, options=options)
+
+    def pause(self):
+        """Hold messages in every queue until :meth:`resume` is called."""
+        self.paused = True
+        for queue in self.queues.values():
+            queue.pause()
+
+    def resume(self):
+        self.paused = False
+        for queue in self.queues.values():
+            queue.resume()
+
+    @property
+    def depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    @property
+    def stats(self):
+        totals = {name: self._retired[name] for name in ('sent', 'dropped', 'coalesced', 'retries', 'failed')}
+        for queue in self.queues.values():
+            for name in totals:
+                totals[name] += getattr(queue, name)
+        totals['depth'] = self.depth
+        return totals
@@ -0,0 +1,132 @@
+# posting messages through discord webhooks
+import asyncio
+import json
+import re
+import time
+import urllib.parse
+
+import aiohttp
+
+# discord's limits on the names webhook messages are posted under
+MIN_USERNAME_LENGTH = 2
+MAX_USERNAME_LENGTH = 32
+
+_webhook_path = re.compile(r'/webhooks/(\d+)/([\w-]+)/?$')
+
+
+def webhook_username(nick):
+    """Returns a username Discord will accept for a webhook message from ``nick``."""
+    # discord rejects names containing 'clyde', whatever their case, so we swap
+    #   its last letter for a cyrillic lookalike
+    name = re.sub('(?i)clyde', lambda match: match.group(0)[:-1] + 'е', nick)
+    return name[:MAX_USERNAME_LENGTH].ljust(MIN_USERNAME_LENGTH, '_')
+
+
+def rate_limit_headers(headers):
+    """Returns the ``(remaining, reset_after)`` a response reports, or None."""
+    try:
+        remaining = int(headers['X-RateLimit-Remaining'])
+        if 'X-RateLimit-Reset-After' in headers:
+            reset_after = float(headers['X-RateLimit-Reset-After'])
+        else:
+            reset_after = float(headers['X-RateLimit-Reset']) - time.time()
+    except (KeyError, TypeError, ValueError):
+        return None
+    return remaining, max(reset_after, 0.0)
+
+
+class Webhook:
+    """A Discord webhook, from its URL.
+
+    Webhooks are keyed on their ID, so each gets its own send queue and
+    rate-limit bucket in a :class:`~italib.sendqueue.SendScheduler`.
+    """
+
+    __slots__ = ('id', 'token', 'url', 'channel')
+
+    def __init__(self, url, channel=None):
+        match = _webhook_path.search(urllib.parse.urlsplit(url).path)
+        if match is None:
+            raise ValueError('Not a Discord webhook URL: {}'.format(url))
+        self.id, self.token = match.groups()
+        self.url = url
+        self.channel = channel
+
+    def __repr__(self):
+        return '<Webhook {} for {}>'.format(self.id, self.channel)
+
+
+class WebhookError(Exception):
+    """Executing a webhook failed. ``response`` is the HTTP response we got."""
+
+    def __init__(self, response, message):
+        super().__init__('{} {}: {}'.format(response.status, response.reason, message))
+        self.response = response
+
+
+class WebhookClient:
+    """Executes Discord webhooks over a shared pool of keep-alive connections.
+
+    Every webhook is posted to through the same aiohttp session, so
+    requests reuse open connections rather than making a new one for
+    each message.
+
+    Parameters
+    ----------
+    limit : int
+        Most connections to have open at once. Defaults to 20.
+    keepalive_timeout : float
+        Seconds to keep idle connections open. Defaults to 30.
+    avatar_url : str
+        Optional avatar URL for messages, formatted with the URL-quoted
+        ``nick`` they're posted under, eg. ``https://example.com/{nick}.png``.
+    user_agent : str
+        User-Agent header to send.
+    """
+
+    def __init__(self, *, limit=20, keepalive_timeout=30.0, avatar_url=None, user_agent='Itabashi'):
+        self.avatar_url = avatar_url
+        self.connector = aiohttp.TCPConnector(limit=limit, keepalive_timeout=keepalive_timeout)
+        self.session = aiohttp.ClientSession(connector=self.connector, headers={
+            'User-Agent': user_agent,
+            'Content-Type': 'application/json',
+        })
+
+        # stats
+        self.requests = 0
+
+    @asyncio.coroutine
+    def execute(self, webhook, content, username=None, wait=False):
+        """Post a message through the given webhook.
+
+        Returns ``(limits, message_id)``, where ``limits`` is the
+        ``(remaining, reset_after)`` of the webhook's rate-limit bucket if the
+        response gave them, or None. Discord only answers with the posted
+        message if we ``wait`` for it, so ``message_id`` is None otherwise.
+        Raises :class:`WebhookError` if Discord refused the message.
+        """
+        payload = {'content': content}
+        if username is not None:
+            payload['username'] = webhook_username(username)
+            if self.avatar_url:
+                payload['avatar_url'] = self.avatar_url.format(nick=urllib.parse.quote(username))
+
+        self.requests += 1
+        url = webhook.url + '?wait=true' if wait else webhook.url
+        response = yield from self.session.post(url, data=json.dumps(payload))
+        try:
+            body = yield from response.text()
+            if response.status >= 400:
+                raise WebhookError(response, body)
+            message_id = None
+            if wait and body:
+                try:
+                    message_id = json.loads(body).get('id')
+                except (ValueError, AttributeError):
+                    pass
+            return rate_limit_headers(response.headers), message_id
+        finally:
+            response.release()
+
+    def close(self):
+        self.session.close()
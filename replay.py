@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""replay.py - Itabashi traffic replay.
+
+Feeds traffic captured with ``startlink.py connect --capture=<file>`` back
+through the real IRC and Discord modules, against a fake IRC server for each
+network and a fake Discord API/gateway on localhost, and reports throughput,
+relay latency and how what they sent differs from what was sent when the
+traffic was captured.
+
+Usage:
+    replay.py <capture> [--speed=<x>] [--drain=<s>] [--unthrottled] [--diffs=<n>] [--log=<log>]
+    replay.py (-h | --help)
+
+Options:
+    --speed=<x>     Times faster than real time to replay at, 0 for as fast as possible [default: 1].
+    --drain=<s>     Most seconds to wait for messages to be sent afterwards [default: 30].
+    --unthrottled   Lift our IRC flood and Discord rate limits, to measure raw overhead.
+    --diffs=<n>     Differences to show each way for each service [default: 10].
+    --log=<log>     Log warnings and errors to the specified filename [default: replay.log].
+    (-h | --help)   Show this message.
+"""
+import asyncio
+import collections
+import contextlib
+import io
+import logging
+import resource
+import time
+
+import discord.http
+from docopt import docopt
+
+import italib
+from italib.capture import DISCORD_IN, DISCORD_OUT, IRC_IN, IRC_OUT, read_capture
+from italib.dedupe import FingerprintCache
+from italib.events import EventBus
+from italib.metrics import RelayMetrics
+from italib.routing import DEFAULT_NETWORK, LinkRouter, is_discord_id
+import itabashi
+from tests.fakediscord import FakeDiscord
+from tests.fakeirc import FakeIrcServer, parse_line
+
+# gateway events we pass on. the rest describe state the fake Discord doesn't have
+REPLAYED_EVENTS = ('MESSAGE_CREATE', 'MESSAGE_UPDATE', 'MESSAGE_DELETE', 'MESSAGE_DELETE_BULK',
+                   'GUILD_MEMBER_ADD', 'GUILD_MEMBER_UPDATE', 'GUILD_MEMBER_REMOVE')
+
+# IRC commands that go to the channel they name, and those that go everywhere
+CHANNEL_COMMANDS = ('PRIVMSG', 'NOTICE', 'JOIN', 'PART', 'KICK', 'TOPIC', 'MODE')
+GLOBAL_COMMANDS = ('QUIT', 'NICK')
+
+
+class Replay:
+    def __init__(self, arguments):
+        self.path = arguments['<capture>']
+        self.speed = float(arguments['--speed'])
+        self.drain = float(arguments['--drain'])
+        self.unthrottled = arguments['--unthrottled']
+        self.diffs = int(arguments['--diffs'])
+
+        self.header, self.records = read_capture(self.path)
+        links = self.header['links']
+
+        # links that refer to discord channels by name can't be replayed, since
+        #   captured events only give channel IDs
+        self.channels = {}
+        for name, link in sorted(links.items()):
+            ref = link['channels'].get('discord')
+            if ref is None:
+                continue
+            if is_discord_id(ref):
+                self.channels[ref] = 'replay-{}'.format(name)
+            else:
+                print('skipping discord channel {} of link {}, which is not given by ID'.format(ref, name))
+
+        # the default network always has a server, since other networks take
+        #   their settings from its config
+        networks = {DEFAULT_NETWORK}
+        networks.update(link.get('network', DEFAULT_NETWORK) for link in links.values()
+                        if link['channels'].get('irc'))
+        self.irc_servers = {network: FakeIrcServer(on_message=self.irc_received) for network in networks}
+        self.discord_server = FakeDiscord(self.channels, on_message=self.discord_received)
+
+        # our user ID when the traffic was captured, so we can skip our own messages
+        self.captured_user = None
+
+        # service -> Counter of (destination, line) sent then, and sent now
+        self.expected = {'irc': collections.Counter(), 'discord': collections.Counter()}
+        self.fed = collections.Counter()
+        self.duration = 0.0
+        self.first_fed = None
+        self.last_fed = None
+        self.last_sent = None
+        self.lines_sent = 0
+
+    def config(self):
+        nicknames = self.header['nicknames']
+        networks = {}
+        for network, server in self.irc_servers.items():
+            networks[network] = {
+                'nickname': nicknames.get(network) or nicknames[DEFAULT_NETWORK],
+                'server': '127.0.0.1',
+                'port': server.port,
+                'tls': False,
+            }
+        irc_config = networks.pop(DEFAULT_NETWORK)
+        if networks:
+            irc_config['networks'] = networks
+
+        discord_config = {
+            'email': 'replay@example.com',
+            'password': 'replay',
+            'send_queue_size': 100000,
+        }
+        webhooks = [ref for ref in self.header['webhooks'] if ref in self.channels]
+        if webhooks:
+            discord_config['webhooks'] = {ref: self.discord_server.create_webhook(ref) for ref in webhooks}
+
+        if self.unthrottled:
+            irc_config.update(flood_rate=1000000, flood_burst=1000000, send_queue_size=1000000)
+            for network in networks.values():
+                network.update(flood_rate=1000000, flood_burst=1000000, send_queue_size=1000000)
+            discord_config.update(send_limit=1000000, send_per=1.0,
+                                  global_send_limit=1000000, global_send_per=1.0,
+                                  webhook_send_limit=1000000, webhook_send_per=1.0,
+                                  webhook_global_send_limit=1000000, webhook_global_send_per=1.0,
+                                  outage_drain_rate=1000000, outage_drain_burst=1000000)
+
+        # flood control only makes the same decisions at the speed it was captured at
+        admission = self.header.get('admission', {'limit': 0})
+        if self.unthrottled:
+            admission = {'limit': 0}
+
+        return {
+            'version': italib.CURRENT_CONFIG_VERSION,
+            'modules': {'irc': irc_config, 'discord': discord_config},
+            'links': self.header['links'],
+            'admission': admission,
+        }
+
+    # what the IM modules send
+    def irc_received(self, client, target, text):
+        self.last_sent = time.monotonic()
+        self.lines_sent += 1
+
+    def discord_received(self, channel_id, content):
+        self.last_sent = time.monotonic()
+        self.lines_sent += content.count('\n') + 1
+
+    def sent(self):
+        """Returns a Counter of the ``(destination, line)`` sent to each service during the replay."""
+        sent = {'irc': collections.Counter(), 'discord': collections.Counter()}
+        for network, server in self.irc_servers.items():
+            for when, target, text in server.received:
+                sent['irc'][(network, target.lower(), text)] += 1
+        # coalesced messages are compared line by line, since how lines are
+        #   grouped depends on timing
+        for when, channel_id, content in self.discord_server.received:
+            for line in content.split('\n'):
+                sent['discord'][(channel_id, line)] += 1
+        return sent
+
+    # running
+    @asyncio.coroutine
+    def setup(self):
+        for server in self.irc_servers.values():
+            yield from server.start()
+        yield from self.discord_server.start()
+        discord.http.Route.BASE = self.discord_server.api_base
+
+        config = self.config()
+        self.events = EventBus(logging)
+        router = LinkRouter(config['links'])
+        dedupe = FingerprintCache(**config.get('dedupe', {}))
+        self.metrics = RelayMetrics()
+        self.metrics.instrument(self.events)
+
+        ready = asyncio.Future()
+        self.events.register('discord ready', lambda event: ready.done() or ready.set_result(True))
+
+        self.irc = itabashi.IrcManager(logging, config, self.events, router=router, dedupe=dedupe,
+                                       metrics=self.metrics)
+        self.discord = itabashi.DiscordManager(logging, config, self.events, router=router, dedupe=dedupe,
+                                               metrics=self.metrics)
+
+        joins = []
+        for network, server in self.irc_servers.items():
+            joins.append(server.wait_joined(link['channels']['irc'] for link in config['links'].values()
+                                            if link['channels'].get('irc') and
+                                            link.get('network', DEFAULT_NETWORK) == network))
+        yield from asyncio.wait_for(asyncio.gather(ready, *joins), 60)
+
+    def feed_irc(self, network, line):
+        server = self.irc_servers.get(network)
+        # message tags are only for the clients that asked for them
+        if line.startswith('@'):
+            line = line.split(' ', 1)[-1]
+        source, verb, params = parse_line(line)
+        if server is None or source is None or verb.isdigit():
+            return
+        # lines about ourselves were answers to what we sent then
+        nick = source.split('!')[0]
+        ours = self.header['nicknames'].get(network) or self.header['nicknames'][DEFAULT_NETWORK]
+        if nick.lower().startswith(ours.lower()):
+            return
+
+        if verb in CHANNEL_COMMANDS and params and params[0][:1] in '#&':
+            server.send_raw(line, channel=params[0])
+        elif verb in GLOBAL_COMMANDS:
+            server.send_raw(line)
+        else:
+            return
+        self.fed['irc'] += 1
+
+    def feed_discord(self, event, data):
+        if event == 'READY':
+            self.captured_user = data['user']['id']
+            return
+        if event not in REPLAYED_EVENTS:
+            return
+        if event.startswith('MESSAGE'):
+            if data.get('channel_id') not in self.channels:
+                return
+            if event == 'MESSAGE_CREATE' and (data.get('webhook_id') or
+                                              data.get('author', {}).get('id') == self.captured_user):
+                return
+        else:
+            data = dict(data, guild_id=self.discord_server.guild_id)
+        self.discord_server.dispatch(event, data)
+        self.fed['discord'] += 1
+
+    @asyncio.coroutine
+    def feed(self):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        self.first_fed = time.monotonic()
+        for i, record in enumerate(self.records):
+            offset, kind = record[0], record[1]
+            self.duration = offset
+            if kind == IRC_OUT:
+                network, target, text = record[2:]
+                self.expected['irc'][(network, target.lower(), text)] += 1
+                continue
+            if kind == DISCORD_OUT:
+                for line in record[3].split('\n'):
+                    self.expected['discord'][(record[2], line)] += 1
+                continue
+
+            if self.speed:
+                delay = start + offset / self.speed - loop.time()
+                if delay > 0:
+                    yield from asyncio.sleep(delay)
+            elif not i % 100:
+                # let the IM modules keep up
+                yield from asyncio.sleep(0)
+
+            if kind == IRC_IN:
+                self.feed_irc(*record[2:])
+            elif kind == DISCORD_IN:
+                self.feed_discord(*record[2:])
+        self.last_fed = time.monotonic()
+
+        # wait until everything has been sent, or nothing has been for a while
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.drain
+        expected = sum(sum(counter.values()) for counter in self.expected.values())
+        while loop.time() < deadline:
+            idle = time.monotonic() - max(self.last_sent or 0, self.last_fed)
+            if self.lines_sent >= expected or (idle > 2 and not self.irc.queue_depth and not self.discord.queue_depth and
+                                    not self.events.depth):
+                break
+            yield from asyncio.sleep(0.1)
+
+    @asyncio.coroutine
+    def teardown(self):
+        yield from self.discord.logout()
+        if self.discord.webhook_client is not None:
+            self.discord.webhook_client.close()
+        yield from self.discord_server.close()
+        for server in self.irc_servers.values():
+            server.close()
+
+    def report(self):
+        print('capture: {}  {:.1f}s  links: {}'.format(self.path, self.duration, len(self.header['links'])))
+        elapsed = (self.last_sent or self.last_fed) - self.first_fed
+        print('speed: {}  fed: {} irc, {} discord in {:.1f}s'.format(
+            '{}x'.format(self.speed) if self.speed else 'max', self.fed['irc'], self.fed['discord'],
+            self.last_fed - self.first_fed))
+
+        sent = self.sent()
+        total = sum(sum(counter.values()) for counter in sent.values())
+        print('sent: {} irc, {} discord'.format(sum(sent['irc'].values()), sum(sent['discord'].values())))
+        if elapsed > 0:
+            print('throughput: {:.1f} msg/s'.format(total / elapsed))
+        for service in ('irc', 'discord'):
+            latency = self.metrics.relay_latency.labels(service)
+            if latency.count:
+                print('-> {}: p50 {:.2f}ms  p99 {:.2f}ms  mean {:.2f}ms'.format(
+                    service, latency.quantile(0.5) * 1000, latency.quantile(0.99) * 1000,
+                    latency.sum / latency.count * 1000))
+
+        for service in ('irc', 'discord'):
+            missing = self.expected[service] - sent[service]
+            extra = sent[service] - self.expected[service]
+            print('{}: {} lines as captured, {} missing, {} extra'.format(
+                service, sum(self.expected[service].values()), sum(missing.values()), sum(extra.values())))
+            for sign, lines in (('-', missing), ('+', extra)):
+                for line, count in sorted(lines.items())[:self.diffs]:
+                    print('  {} {}{}'.format(sign, ' '.join(line).encode('unicode_escape').decode('ascii'),
+                                             '  (x{})'.format(count) if count > 1 else ''))
+
+        for name, stats in sorted(self.events.stats.items()):
+            if stats['dropped'] or stats['failed']:
+                print('{}: dropped {}  failed {}'.format(name, stats['dropped'], stats['failed']))
+        # ru_maxrss is in kilobytes on linux
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        print('cpu: {:.2f}s  max rss: {:.1f}MB'.format(usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024))
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    logging.basicConfig(filename=arguments['--log'], level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s:%(name)s:%(message)s')
+
+    replay = Replay(arguments)
+    loop = asyncio.get_event_loop()
+
+    # the IM modules print the channels they find, which isn't useful here
+    with contextlib.redirect_stdout(io.StringIO()):
+        loop.run_until_complete(replay.setup())
+    loop.run_until_complete(replay.feed())
+
+    replay.report()
+    loop.run_until_complete(replay.teardown())
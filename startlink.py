@@ -3,54 +3,156 @@
 """startlink.py - Itabashi Discord-IRC linker.
 
 Usage:
-    startlink.py connect [--log=<log>]
+    startlink.py (connect | upgrade) [--log=<log>] [--log-level=<level>] [--raw-log-rate=<rate>]
+                                     [--raw-log-sample=<n>] [--metrics-port=<port>] [--metrics-host=<host>]
+                                     [--workers=<n>] [--config-poll=<s>] [--profile] [--profile-dir=<dir>]
+                                     [--profile-kind=<kind>] [--profile-interval=<s>] [--slow-callback=<s>]
+                                     [--capture=<file>] [--upgrade-socket=<path>]
     startlink.py --version
     startlink.py (-h | --help)
 
 Options:
-    connect        Connect to the Discord and IRC channels.
-    --log=<log>    Log to the specified filename [default: itabashi.log].
-    --version      Show the running version of Itabashi.
-    (-h | --help)  Show this message.
+    connect                 Connect to the Discord and IRC channels.
+    upgrade                 Replace the Itabashi already running here, taking over its IRC connections
+                            rather than connecting to IRC again.
+    --log=<log>             Log to the specified filename [default: itabashi.log].
+    --log-level=<level>     Logging level, such as debug or info [default: info].
+    --raw-log-rate=<rate>   Most raw IRC lines to log each second, 0 for all [default: 10].
+    --raw-log-sample=<n>    Only log one in every n raw IRC lines [default: 1].
+    --metrics-port=<port>   Serve Prometheus metrics over HTTP on this port.
+    --metrics-host=<host>   Address to serve metrics on [default: 127.0.0.1].
+    --workers=<n>           Split links across this many worker processes [default: 1].
+    --config-poll=<s>       Seconds between checks for changes to config.json, 0 to only reload
+                            on SIGHUP [default: 5].
+    --profile               Log event loop stalls, slow callbacks and the time each handler takes.
+    --profile-dir=<dir>     With --profile, also write profile snapshots to this directory.
+    --profile-kind=<kind>   Snapshots to write, sample for sampled stacks or cprofile [default: sample].
+    --profile-interval=<s>  Seconds between profile snapshots [default: 600].
+    --slow-callback=<s>     With --profile, log callbacks that take longer than this [default: 0.05].
+    --capture=<file>        Record the IRC and Discord traffic we see to this file, for replay.py.
+    --upgrade-socket=<path> Unix socket to hand our IRC connections over to an upgrade on
+                            [default: itabashi.sock].
+    --version               Show the running version of Itabashi.
+    (-h | --help)           Show this message.
 """
 import asyncio
-import json
 import logging
 import os
+import signal
 import sys
+import time
 
 from docopt import docopt
-from girc.ircreactor.events import EventManager
 
-import italib
+from italib.config import ConfigError, ConfigWatcher, load_config
+from italib.logs import start_logging
+from italib.metrics import RelayMetrics, Registry, start_metrics_server
+from italib.profiling import Profiler
 import itabashi
+from itabashi.bridge import Bridge
+from itabashi.upgrade import UpgradeServer, take_over
+from itabashi.workers import Supervisor
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version=itabashi.__version__)
 
-    if arguments['connect']:
+    if arguments['connect'] or arguments['upgrade']:
         if not os.path.exists('config.json'):
             print('Config file does not exist, run create-config.py')
             sys.exit(1)
-        with open('config.json', 'r') as config_file:
-            config = json.loads(config_file.read())[0]
+        if arguments['upgrade'] and int(arguments['--workers']) > 1:
+            print('Upgrading can only take over from a single process, not --workers')
+            sys.exit(1)
 
-        logging.basicConfig(filename=arguments['--log'], level=logging.DEBUG)
+        start_logging(arguments['--log'], arguments['--log-level'],
+                      raw_rate=float(arguments['--raw-log-rate']),
+                      raw_sample=int(arguments['--raw-log-sample']))
         logger = logging
         logger.info('Logger started')
 
-        # check config version
-        if config.get('version', 0) < italib.CURRENT_CONFIG_VERSION:
-            #TODO(dan): automagic config file updating
-            logger.fatal('Config format is too old, please update it.')
-            print('Config format is too old, please update it.')
-            exit(1)
+        try:
+            config = load_config('config.json', logger=logger)
+        except ConfigError as exc:
+            logger.fatal(str(exc))
+            print(exc)
+            sys.exit(1)
+
+        loop = asyncio.get_event_loop()
+        workers = int(arguments['--workers'])
+
+        profile = None
+        if arguments['--profile']:
+            profile = {
+                'slow_callback': float(arguments['--slow-callback']),
+                'directory': arguments['--profile-dir'],
+                'kind': arguments['--profile-kind'],
+                'snapshot_interval': float(arguments['--profile-interval']),
+            }
+
+        if workers > 1:
+            # the supervisor only watches over the workers, which run the links
+            supervisor = Supervisor(logger, config, workers, {
+                'log': arguments['--log'],
+                'log_level': arguments['--log-level'],
+                'raw_rate': float(arguments['--raw-log-rate']),
+                'raw_sample': int(arguments['--raw-log-sample']),
+                'profile': profile,
+                'capture': arguments['--capture'],
+            })
+            registry = Registry()
+            supervisor.register_metrics(registry)
+            supervisor.start()
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)
+        else:
+            metrics = RelayMetrics()
+            registry = metrics.registry
+            bridge = Bridge(logger, config, metrics=metrics, connect_irc=not arguments['upgrade'])
+            if arguments['upgrade']:
+                # the process we're replacing keeps our metrics port until it's handed over
+                loop.run_until_complete(take_over(logger, bridge, arguments['--upgrade-socket']))
+            UpgradeServer(logger, bridge, arguments['--upgrade-socket'], loop.stop).start()
+            logger.debug('Itabashi events: %s', bridge.events.events)
+            if profile is not None:
+                profiler = Profiler(logger, **profile)
+                profiler.instrument(bridge.events)
+                profiler.start()
+            if arguments['--capture']:
+                bridge.start_capture(arguments['--capture'])
+
+        if arguments['--metrics-port']:
+            if workers <= 1:
+                metrics.instrument(bridge.events)
+                metrics.start_loop_monitor()
+            # an upgrade waits for the process it replaced to let go of the port
+            deadline = time.monotonic() + (30.0 if arguments['upgrade'] else 0)
+            while True:
+                try:
+                    loop.run_until_complete(start_metrics_server(registry, int(arguments['--metrics-port']),
+                                                                 host=arguments['--metrics-host']))
+                    break
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        raise
+                    loop.run_until_complete(asyncio.sleep(0.5))
+            logger.info('Serving metrics on %s:%s', arguments['--metrics-host'], arguments['--metrics-port'])
 
-        events = EventManager()
+        target = supervisor if workers > 1 else bridge
 
-        irc = itabashi.IrcManager(logger, config, events)
-        discord = itabashi.DiscordManager(logger, config, events)
+        def reload():
+            try:
+                new_config = load_config('config.json', logger=logger)
+            except ConfigError as exc:
+                logger.error('Not reloading config: %s', exc)
+                return
+            logger.info('Reloading config')
+            target.reload(new_config)
 
-        logger.debug('Itabashi events: {}'.format(events.events))
+        loop.add_signal_handler(signal.SIGHUP, reload)
+        if float(arguments['--config-poll']):
+            ConfigWatcher('config.json', reload, interval=float(arguments['--config-poll'])).start()
 
-        asyncio.get_event_loop().run_forever()
+        try:
+            loop.run_forever()
+        finally:
+            if workers > 1:
+                supervisor.stop()
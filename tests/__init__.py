@@ -0,0 +1,4 @@
+import logging
+
+# the modules under test warn about what they're tested with, eg. flooding
+logging.getLogger('itabashi.tests').addHandler(logging.NullHandler())
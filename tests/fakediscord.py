@@ -0,0 +1,403 @@
+# minimal in-process Discord REST API and gateway, for benchmarking and testing against
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import time
+
+from aiohttp import WSMsgType, web
+
+API_PREFIX = '/api/v6'
+
+# gateway opcodes
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+RESUME = 6
+REQUEST_MEMBERS = 8
+HELLO = 10
+HEARTBEAT_ACK = 11
+
+
+def json_response(data, status=200):
+    # discord.py only decodes responses whose content type is exactly this
+    return web.Response(body=json.dumps(data).encode('utf-8'), status=status,
+                        headers={'Content-Type': 'application/json'})
+
+
+def timestamp():
+    return datetime.datetime.utcnow().isoformat() + '+00:00'
+
+
+class FakeDiscord:
+    """Just enough of Discord's REST API and gateway for discord.py to run against.
+
+    Serves a single guild containing the given text channels, and accepts
+    any credentials. Messages the client sends are recorded with the time
+    they arrived in :attr:`received` and passed to
+    ``on_message(channel_id, content)`` if it's given. Messages from made-up
+    users are sent to connected clients with :meth:`message_create`, and
+    can then be edited and deleted with :meth:`message_update` and
+    :meth:`message_delete`. Edits the client makes to its own messages
+    are recorded in :attr:`edited`.
+
+    To point discord.py at us, set ``discord.http.Route.BASE`` to
+    :attr:`api_base` before the client is created.
+
+    Webhooks made with :meth:`create_webhook` can be posted to as well.
+    Their messages are recorded and passed on the same way, and the
+    usernames they were posted under are counted in :attr:`webhook_authors`.
+
+    Gateway connections can be dropped with :meth:`disconnect`. Clients
+    that resume their session are sent the events they missed, as long as
+    they're among the last ``history`` events. Clients that identify as a
+    shard are only sent that shard's guilds, and their events.
+
+    Parameters
+    ----------
+    channels : dict
+        Channel ID -> name for the text channels in the guild.
+    rate_limit : int
+        If set, every this many sent messages gets a 429 response, so
+        clients' retry handling is exercised.
+    webhook_limit : tuple
+        If set, ``(limit, per)`` rate limit to give each webhook. Webhook
+        responses report the state of the webhook's bucket in their
+        headers, and requests over the limit get a 429 response.
+    history : int
+        Events kept to replay to resuming clients. Defaults to 10000.
+    extra_guilds : int
+        Other guilds to serve, each with ``extra_channels`` channels of
+        their own, so clients have more to look through. Defaults to 0.
+    extra_channels : int
+        Channels in each extra guild. Defaults to 50.
+    """
+
+    def __init__(self, channels, *, rate_limit=None, webhook_limit=None, on_message=None, history=10000,
+                 extra_guilds=0, extra_channels=50):
+        self.channels = dict(channels)
+        self.rate_limit = rate_limit
+        self.on_message = on_message
+
+        self.guild_id = '100000000000000000'
+        self.user = {
+            'id': '100000000000000001',
+            'username': 'itabashi',
+            'discriminator': '0001',
+            'avatar': None,
+            'bot': False,
+        }
+
+        self.received = []
+        self.edited = []
+        self.rate_limited = 0
+
+        # webhook id -> (token, channel id)
+        self.webhooks = {}
+        self.webhook_limit = webhook_limit
+        self.webhook_authors = collections.Counter()
+        self._webhook_buckets = {}
+        self.sockets = []
+        # socket -> (shard id, shard count), for sockets that identified as a shard
+        self.shards = {}
+        self.sequence = 0
+        self.session_id = 'fake-session'
+        self.history = collections.deque(maxlen=history)
+        self.resumes = 0
+
+        self._ids = itertools.count(200000000000000000)
+        # guild id -> {channel id: name}, for the guilds besides our main one.
+        #   their IDs are a snowflake's timestamp apart, so they're spread
+        #   across shards the way real guilds are
+        self.extra_guilds = {}
+        for i in range(extra_guilds):
+            guild_id = str(400000000000000000 + ((i + 1) << 22))
+            self.extra_guilds[guild_id] = {self.next_id(): 'extra{}-{}'.format(i, j) for j in range(extra_channels)}
+        self.channel_guilds = {channel_id: guild_id for guild_id, guild_channels in self.extra_guilds.items()
+                               for channel_id in guild_channels}
+        self.channel_guilds.update((channel_id, self.guild_id) for channel_id in self.channels)
+        self._requests = 0
+        self._server = None
+        self._handler = None
+
+    def next_id(self):
+        return str(next(self._ids))
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=0):
+        """Start listening, returning the port we're listening on."""
+        loop = asyncio.get_event_loop()
+        app = web.Application(loop=loop)
+        app.router.add_route('POST', API_PREFIX + '/auth/login', self.handle_login)
+        app.router.add_route('GET', API_PREFIX + '/users/@me', self.handle_me)
+        app.router.add_route('GET', API_PREFIX + '/gateway', self.handle_gateway)
+        app.router.add_route('POST', API_PREFIX + '/channels/{channel_id}/messages', self.handle_send)
+        app.router.add_route('PATCH', API_PREFIX + '/channels/{channel_id}/messages/{message_id}', self.handle_edit)
+        app.router.add_route('POST', API_PREFIX + '/webhooks/{webhook_id}/{token}', self.handle_webhook)
+        app.router.add_route('GET', '/gateway', self.handle_websocket)
+
+        self._handler = app.make_handler()
+        self._server = yield from loop.create_server(self._handler, host, port)
+        self.host = host
+        self.port = self._server.sockets[0].getsockname()[1]
+        self.api_base = 'http://{}:{}{}'.format(host, self.port, API_PREFIX)
+        return self.port
+
+    @asyncio.coroutine
+    def close(self):
+        for ws in list(self.sockets):
+            yield from ws.close()
+        if self._server is not None:
+            self._server.close()
+            yield from self._server.wait_closed()
+        if self._handler is not None:
+            yield from self._handler.finish_connections(1.0)
+
+    @asyncio.coroutine
+    def disconnect(self, code=4000):
+        """Close every gateway connection, as if Discord had dropped them."""
+        for ws in list(self.sockets):
+            yield from ws.close(code=code)
+
+    # rest api
+    @asyncio.coroutine
+    def handle_login(self, request):
+        return json_response({'token': 'fake-token'})
+
+    @asyncio.coroutine
+    def handle_me(self, request):
+        return json_response(self.user)
+
+    @asyncio.coroutine
+    def handle_gateway(self, request):
+        return json_response({'url': 'ws://{}:{}/gateway'.format(self.host, self.port)})
+
+    @asyncio.coroutine
+    def handle_send(self, request):
+        channel_id = request.match_info['channel_id']
+        if channel_id not in self.channels:
+            return json_response({'code': 10003, 'message': 'Unknown Channel'}, status=404)
+
+        self._requests += 1
+        if self.rate_limit and self._requests % self.rate_limit == 0:
+            self.rate_limited += 1
+            return json_response({'message': 'You are being rate limited.',
+                                      'retry_after': 10, 'global': False}, status=429)
+
+        payload = yield from request.json()
+        content = payload.get('content', '')
+        self.received.append((time.monotonic(), channel_id, content))
+        if self.on_message is not None:
+            self.on_message(channel_id, content)
+
+        return json_response(self.message_data(channel_id, self.user, content))
+
+    @asyncio.coroutine
+    def handle_edit(self, request):
+        channel_id = request.match_info['channel_id']
+        if channel_id not in self.channels:
+            return json_response({'code': 10003, 'message': 'Unknown Channel'}, status=404)
+        payload = yield from request.json()
+        content = payload.get('content', '')
+        self.edited.append((time.monotonic(), channel_id, request.match_info['message_id'], content))
+
+        data = self.message_data(channel_id, self.user, content)
+        data.update(id=request.match_info['message_id'], edited_timestamp=timestamp())
+        return json_response(data)
+
+    def create_webhook(self, channel_id):
+        """Make a webhook for the given channel, returning its URL."""
+        webhook_id, token = self.next_id(), 'token-{}'.format(channel_id)
+        self.webhooks[webhook_id] = (token, channel_id)
+        return '{}/webhooks/{}/{}'.format(self.api_base, webhook_id, token)
+
+    def _webhook_headers(self, webhook_id):
+        # fixed windows, like discord's buckets
+        limit, per = self.webhook_limit
+        now = time.monotonic()
+        remaining, reset_at = self._webhook_buckets.get(webhook_id, (limit, 0.0))
+        if now >= reset_at:
+            remaining, reset_at = limit, now + per
+        headers = {
+            'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Remaining': str(max(remaining - 1, 0)),
+            'X-RateLimit-Reset-After': '{:.3f}'.format(reset_at - now),
+        }
+        self._webhook_buckets[webhook_id] = (remaining - 1, reset_at)
+        return remaining > 0, headers
+
+    @asyncio.coroutine
+    def handle_webhook(self, request):
+        webhook_id = request.match_info['webhook_id']
+        token, channel_id = self.webhooks.get(webhook_id, (None, None))
+        if token is None or token != request.match_info['token']:
+            return json_response({'code': 10015, 'message': 'Unknown Webhook'}, status=404)
+
+        headers = {}
+        if self.webhook_limit is not None:
+            allowed, headers = self._webhook_headers(webhook_id)
+            if not allowed:
+                self.rate_limited += 1
+                response = json_response({'message': 'You are being rate limited.', 'global': False,
+                                          'retry_after': float(headers['X-RateLimit-Reset-After'])}, status=429)
+                response.headers.update(headers)
+                response.headers['Retry-After'] = headers['X-RateLimit-Reset-After']
+                return response
+
+        payload = yield from request.json()
+        content = payload.get('content', '')
+        self.webhook_authors[payload.get('username')] += 1
+        self.received.append((time.monotonic(), channel_id, content))
+        if self.on_message is not None:
+            self.on_message(channel_id, content)
+
+        # discord answers with no content unless ?wait=true is given
+        if request.GET.get('wait') != 'true':
+            return web.Response(status=204, headers=headers)
+        user = {'id': webhook_id, 'username': payload.get('username'), 'discriminator': '0000',
+                'avatar': None, 'bot': True}
+        response = json_response(self.message_data(channel_id, user, content))
+        response.headers.update(headers)
+        return response
+
+    # gateway
+    @asyncio.coroutine
+    def handle_websocket(self, request):
+        ws = web.WebSocketResponse()
+        yield from ws.prepare(request)
+        self.sockets.append(ws)
+
+        ws.send_json({'op': HELLO, 'd': {'heartbeat_interval': 41250}, 's': None, 't': None})
+        try:
+            while True:
+                msg = yield from ws.receive()
+                if msg.type != WSMsgType.TEXT:
+                    break
+                payload = json.loads(msg.data)
+                op = payload.get('op')
+                if op == HEARTBEAT:
+                    ws.send_json({'op': HEARTBEAT_ACK, 'd': None, 's': None, 't': None})
+                elif op == IDENTIFY:
+                    shard = payload['d'].get('shard')
+                    if shard is not None:
+                        self.shards[ws] = tuple(shard)
+                    self.send_event(ws, 'READY', self.ready_data(shard))
+                elif op == RESUME:
+                    # replay what they missed, then tell them they're back
+                    self.resumes += 1
+                    for sequence, event, data in list(self.history):
+                        if sequence > (payload['d'].get('seq') or 0) and self.sends_to(ws, data):
+                            self.send_event(ws, event, data, sequence)
+                    self.send_event(ws, 'RESUMED', {})
+                elif op == REQUEST_MEMBERS:
+                    for guild_id in payload['d']['guild_id']:
+                        self.send_event(ws, 'GUILD_MEMBERS_CHUNK', {'guild_id': guild_id, 'members': []})
+        finally:
+            self.sockets.remove(ws)
+            self.shards.pop(ws, None)
+
+        return ws
+
+    def send_event(self, ws, event, data, sequence=None):
+        if sequence is None:
+            self.sequence += 1
+            sequence = self.sequence
+        ws.send_json({'op': DISPATCH, 't': event, 's': sequence, 'd': data})
+
+    def dispatch(self, event, data):
+        """Send the given event to every connected client whose shard it's for."""
+        self.sequence += 1
+        self.history.append((self.sequence, event, data))
+        for ws in self.sockets:
+            if self.sends_to(ws, data):
+                self.send_event(ws, event, data, self.sequence)
+
+    def on_shard(self, guild_id, shard):
+        return shard is None or (int(guild_id) >> 22) % shard[1] == shard[0]
+
+    def sends_to(self, ws, data):
+        guild_id = data.get('guild_id') or self.channel_guilds.get(data.get('channel_id'))
+        return guild_id is None or self.on_shard(guild_id, self.shards.get(ws))
+
+    def guild_data(self, guild_id, name, channels):
+        channels = [{'id': channel_id, 'name': channel_name, 'type': 0, 'position': position,
+                     'permission_overwrites': [], 'topic': None}
+                    for position, (channel_id, channel_name) in enumerate(sorted(channels.items()))]
+        return {
+            'id': guild_id,
+            'name': name,
+            'owner_id': self.user['id'],
+            # the @everyone role shares the guild's ID
+            'roles': [{'id': guild_id, 'name': '@everyone', 'permissions': 104324161,
+                       'position': 0, 'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+            'members': [{'user': self.user, 'roles': [], 'joined_at': timestamp(),
+                         'deaf': False, 'mute': False}],
+            'channels': channels,
+            'member_count': 1,
+        }
+
+    def ready_data(self, shard=None):
+        # our main guild comes last, so clients have to get past the others to find its channels
+        guilds = [self.guild_data(guild_id, 'Extra Guild {}'.format(i), channels)
+                  for i, (guild_id, channels) in enumerate(sorted(self.extra_guilds.items()))]
+        guilds.append(self.guild_data(self.guild_id, 'Fake Guild', self.channels))
+        data = {
+            'v': 6,
+            'user': self.user,
+            'guilds': [guild for guild in guilds if self.on_shard(guild['id'], shard)],
+            'private_channels': [],
+            'session_id': self.session_id,
+        }
+        if shard is not None:
+            data['shard'] = list(shard)
+        return data
+
+    def message_data(self, channel_id, author, content):
+        return {
+            'id': self.next_id(),
+            'channel_id': channel_id,
+            'author': author,
+            'content': content,
+            'timestamp': timestamp(),
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'type': 0,
+        }
+
+    def message_create(self, channel_id, author, content, *, bot=False):
+        """Send a message from the given username to every connected client."""
+        user = {
+            'id': str(abs(hash(author)) % 10 ** 17 + 10 ** 17),
+            'username': author,
+            'discriminator': '1234',
+            'avatar': None,
+            'bot': bot,
+        }
+        data = self.message_data(channel_id, user, content)
+        self.dispatch('MESSAGE_CREATE', data)
+        return data
+
+    def member_add(self, username, nick=None):
+        """Add a member to our main guild, returning their user ID."""
+        user = {'id': self.next_id(), 'username': username, 'discriminator': '1234', 'avatar': None}
+        self.dispatch('GUILD_MEMBER_ADD', {'guild_id': self.guild_id, 'user': user, 'nick': nick, 'roles': [],
+                                           'joined_at': timestamp(), 'deaf': False, 'mute': False})
+        return user['id']
+
+    def message_update(self, message, content):
+        """Edit a message made with :meth:`message_create`."""
+        message['content'] = content
+        message['edited_timestamp'] = timestamp()
+        self.dispatch('MESSAGE_UPDATE', message)
+
+    def message_delete(self, channel_id, *message_ids):
+        """Delete messages, in bulk if there's more than one."""
+        if len(message_ids) == 1:
+            self.dispatch('MESSAGE_DELETE', {'id': message_ids[0], 'channel_id': channel_id})
+        else:
+            self.dispatch('MESSAGE_DELETE_BULK', {'ids': list(message_ids), 'channel_id': channel_id})
@@ -0,0 +1,203 @@
+# minimal in-process IRC server, for benchmarking and testing against
+import asyncio
+import time
+
+
+def parse_line(line):
+    """Split a raw IRC line into its source, verb and params."""
+    source = None
+    if line.startswith(':'):
+        source, line = line[1:].split(' ', 1)
+
+    if ' :' in line:
+        line, trailing = line.split(' :', 1)
+        params = line.split()
+        params.append(trailing)
+    else:
+        params = line.split()
+
+    verb = params.pop(0).upper() if params else ''
+    return source, verb, params
+
+
+class FakeIrcClient(asyncio.Protocol):
+    """A single client connected to a :class:`FakeIrcServer`."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.nick = None
+        self.user = None
+        self.registered = False
+        self.channels = set()
+
+        self._buffer = b''
+
+    @property
+    def nickmask(self):
+        return '{}!{}@{}'.format(self.nick, self.user, self.server.hostname)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.clients.append(self)
+
+    def connection_lost(self, exc):
+        if self in self.server.clients:
+            self.server.clients.remove(self)
+        for channel in self.channels:
+            self.server.channels.get(channel, set()).discard(self)
+
+    def send(self, line):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(line.encode('utf-8') + b'\r\n')
+
+    def numeric(self, numeric, *params):
+        params = list(params)
+        params[-1] = ':' + params[-1]
+        self.send(':{} {} {} {}'.format(self.server.name, numeric, self.nick or '*', ' '.join(params)))
+
+    def data_received(self, data):
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            line = line.rstrip(b'\r').decode('utf-8', 'replace')
+            if line:
+                self.server.lines_in += 1
+                self.handle_line(line)
+
+    def handle_line(self, line):
+        source, verb, params = parse_line(line)
+        handler = getattr(self, 'irc_' + verb.lower(), None)
+        if handler is not None:
+            handler(params)
+
+    # commands
+    def irc_cap(self, params):
+        if params and params[0].upper() == 'LS':
+            self.send(':{} CAP * LS :'.format(self.server.name))
+
+    def irc_nick(self, params):
+        self.nick = params[0]
+        self._maybe_register()
+
+    def irc_user(self, params):
+        self.user = params[0]
+        self._maybe_register()
+
+    def _maybe_register(self):
+        if self.registered or self.nick is None or self.user is None:
+            return
+        self.registered = True
+        self.numeric('001', 'Welcome to the fake network')
+        self.numeric('005', *(self.server.isupport + ['are supported by this server']))
+        self.numeric('376', 'End of /MOTD command.')
+
+    def irc_ping(self, params):
+        self.send(':{0} PONG {0} :{1}'.format(self.server.name, params[-1] if params else ''))
+
+    def irc_join(self, params):
+        self.server.join_lines += 1
+        for channel in params[0].split(','):
+            key = channel.lower()
+            self.channels.add(key)
+            self.server.channels.setdefault(key, set()).add(self)
+            self.send(':{} JOIN {}'.format(self.nickmask, channel))
+            self.numeric('366', channel, 'End of /NAMES list.')
+            self.server.joins += 1
+        self.server._check_waiters()
+
+    def irc_part(self, params):
+        for channel in params[0].split(','):
+            key = channel.lower()
+            self.channels.discard(key)
+            self.server.channels.get(key, set()).discard(self)
+            self.send(':{} PART {}'.format(self.nickmask, channel))
+
+    def irc_privmsg(self, params):
+        if len(params) < 2:
+            return
+        self.server.received.append((time.monotonic(), params[0], params[1]))
+        if self.server.on_message is not None:
+            self.server.on_message(self, params[0], params[1])
+
+    def irc_quit(self, params):
+        self.transport.close()
+
+
+class FakeIrcServer:
+    """Just enough of an IRC server to register clients and pass messages.
+
+    Clients can register, join and part channels, and send messages, which
+    are recorded with the time they arrived in :attr:`received` and passed
+    to ``on_message(client, target, text)`` if it's given. Messages from
+    made-up users are sent to joined clients with :meth:`privmsg`, and
+    clients can be dropped with :meth:`disconnect`.
+    """
+
+    def __init__(self, *, name='irc.example.com', isupport=None, on_message=None):
+        self.name = name
+        self.hostname = 'fake.host'
+        self.isupport = isupport or ['CASEMAPPING=rfc1459', 'CHANTYPES=#', 'PREFIX=(ov)@+',
+                                     'CHANMODES=beI,k,l,imnpst', 'NETWORK=Fake']
+        self.on_message = on_message
+
+        self.clients = []
+        self.channels = {}
+        self.received = []
+        self.lines_in = 0
+        self.joins = 0
+        self.join_lines = 0
+
+        self._server = None
+        self._waiters = []
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=0):
+        """Start listening, returning the port we're listening on."""
+        loop = asyncio.get_event_loop()
+        self._server = yield from loop.create_server(lambda: FakeIrcClient(self), host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    def close(self):
+        self.disconnect()
+        if self._server is not None:
+            self._server.close()
+
+    def disconnect(self):
+        """Close every client's connection, as if the network had dropped them."""
+        for client in list(self.clients):
+            client.transport.close()
+
+    def privmsg(self, source, channel, text, action=False):
+        """Send a message from the given nick to everyone in the channel."""
+        if action:
+            text = '\x01ACTION {}\x01'.format(text)
+        line = ':{}!user@{} PRIVMSG {} :{}'.format(source, self.hostname, channel, text)
+        for client in self.channels.get(channel.lower(), ()):
+            client.send(line)
+
+    def send_raw(self, line, channel=None):
+        """Send a raw line to everyone in the given channel, or to every client."""
+        clients = self.channels.get(channel.lower(), ()) if channel is not None else self.clients
+        for client in list(clients):
+            client.send(line)
+
+    def joined(self, channels):
+        """Returns True if a client has joined all of the given channels."""
+        return all(self.channels.get(channel.lower()) for channel in channels)
+
+    def wait_joined(self, channels):
+        """Returns a future that completes once all channels have been joined."""
+        future = asyncio.Future()
+        self._waiters.append((list(channels), future))
+        self._check_waiters()
+        return future
+
+    def _check_waiters(self):
+        for waiter in list(self._waiters):
+            channels, future = waiter
+            if self.joined(channels):
+                self._waiters.remove(waiter)
+                if not future.done():
+                    future.set_result(True)
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import types
+import unittest
+from unittest import mock
+
+from italib.admission import ADMITTED, DROP, DROPPED, HELD, SUMMARIZE, AdmissionControl, admission_options
+from italib.relay import MESSAGE, RelayMessage
+
+
+def message(text, author='alice', channel='#chan'):
+    return RelayMessage('irc', MESSAGE, ('main',), channel, author, text, text, 0.0, network='default')
+
+
+class AdmissionOptionsTest(unittest.TestCase):
+    def test_off_by_default(self):
+        self.assertEqual(admission_options({}), {'limit': 0})
+
+    def test_options(self):
+        self.assertEqual(admission_options({'admission': {'limit': 5}}), {'limit': 5})
+
+
+class AdmissionControlTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        # admission's clock is ours to move, while the loop's call_later
+        #   delays still pass in real time
+        self.clock = types.SimpleNamespace(monotonic=lambda: self.now)
+        self.now = 0.0
+        patcher = mock.patch('italib.admission.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dispatched = []
+
+    def admission(self, **options):
+        return AdmissionControl(logging.getLogger('itabashi.tests'), self.dispatched.append, **options)
+
+    def wait(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_unlimited(self):
+        admission = self.admission(limit=0)
+        self.assertEqual([admission.admit(message(str(i))) for i in range(100)], [ADMITTED] * 100)
+        self.assertEqual(len(admission), 0)
+
+    def test_bad_policy(self):
+        with self.assertRaises(ValueError):
+            self.admission(policy='ignore')
+
+    def test_throttle(self):
+        admission = self.admission(limit=2, per=0.1)
+        results = [admission.admit(message(str(i))) for i in range(5)]
+        self.assertEqual(results, [ADMITTED, ADMITTED, HELD, HELD, HELD])
+        # other authors, and the same author in other channels, aren't held up
+        self.assertEqual(admission.admit(message('x', author='bob')), ADMITTED)
+        self.assertEqual(admission.admit(message('x', channel='#other')), ADMITTED)
+
+        self.now = 1.0
+        self.wait(0.2)
+        self.assertEqual([m.text for m in self.dispatched], ['2', '3', '4'])
+        self.assertEqual(admission.stats['held'], 3)
+        self.assertEqual(admission.stats['flooders'], ['alice in #chan'])
+
+    def test_held_messages_keep_their_order(self):
+        admission = self.admission(limit=1, per=0.1)
+        admission.admit(message('1'))
+        self.assertEqual(admission.admit(message('2')), HELD)
+        # the window has moved on, but '3' still waits behind '2'
+        self.now = 0.5
+        self.assertEqual(admission.admit(message('3')), HELD)
+
+    def test_max_held(self):
+        admission = self.admission(limit=1, per=10.0, max_held=2)
+        results = [admission.admit(message(str(i))) for i in range(4)]
+        self.assertEqual(results, [ADMITTED, HELD, HELD, DROPPED])
+
+    def test_release_counts_in_current_window(self):
+        admission = self.admission(limit=1, per=0.1)
+        self.assertEqual(admission.admit(message('1')), ADMITTED)
+        self.assertEqual(admission.admit(message('2')), HELD)
+
+        # '2' is let through in the next window, so the one after that
+        #   counts it almost in full
+        self.now = 0.15
+        self.wait(0.15)
+        self.assertEqual([m.text for m in self.dispatched], ['2'])
+        self.now = 0.19
+        self.assertEqual(admission.admit(message('3')), HELD)
+
+    def test_sliding_window(self):
+        admission = self.admission(limit=2, per=10.0, policy=DROP)
+        admission.admit(message('1'))
+        admission.admit(message('2'))
+        self.assertEqual(admission.admit(message('3')), DROPPED)
+        # half the previous window still counts
+        self.now = 15.0
+        self.assertEqual(admission.admit(message('4')), ADMITTED)
+        self.assertEqual(admission.admit(message('5')), DROPPED)
+        self.now = 30.0
+        self.assertEqual(admission.admit(message('6')), ADMITTED)
+
+    def test_drop(self):
+        admission = self.admission(limit=1, per=10.0, policy=DROP)
+        results = [admission.admit(message(str(i))) for i in range(3)]
+        self.assertEqual(results, [ADMITTED, DROPPED, DROPPED])
+        self.assertEqual(admission.stats['dropped'], 2)
+        self.assertEqual(self.dispatched, [])
+
+    def test_summarize(self):
+        admission = self.admission(limit=1, per=0.05, policy=SUMMARIZE)
+        results = [admission.admit(message(str(i))) for i in range(4)]
+        self.assertEqual(results, [ADMITTED, DROPPED, DROPPED, DROPPED])
+        self.wait(0.1)
+        self.assertEqual([(m.author, m.text) for m in self.dispatched],
+                         [('alice', "(sent 3 more lines that weren't relayed)")])
+        self.assertEqual(admission.stats['summarized'], 1)
+
+    def test_idle_authors_are_forgotten(self):
+        admission = self.admission(limit=1, per=1.0, idle=5.0)
+        admission.admit(message('1', author='alice'))
+        self.now = 10.0
+        admission.admit(message('1', author='bob'))
+        self.assertEqual(len(admission), 1)
+
+    def test_max_authors(self):
+        admission = self.admission(limit=1, per=1.0, max_authors=2)
+        for author in ('alice', 'bob', 'carol'):
+            admission.admit(message('1', author=author))
+        self.assertEqual(len(admission), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+
+from italib.dedupe import FingerprintCache, normalize
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_formatting_and_whitespace(self):
+        self.assertEqual(normalize('\x02Hello\x02   **World**'), ('hello world', False))
+
+    def test_relay_prefix(self):
+        self.assertEqual(normalize('<alice> hi there'), ('hi there', True))
+        self.assertEqual(normalize('[irc] <alice> hi'), ('hi', True))
+
+
+class FingerprintCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('italib.dedupe.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_check_and_expiry(self):
+        cache = FingerprintCache(ttl=10.0)
+        self.assertFalse(cache.check('a'))
+        self.assertTrue(cache.check('a'))
+        self.now += 11
+        self.assertFalse(cache.check('a'))
+
+    def test_maxsize(self):
+        cache = FingerprintCache(maxsize=2)
+        for key in 'abc':
+            cache.add(key)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(cache.check('a'))
+
+    def test_replay(self):
+        cache = FingerprintCache()
+        self.assertFalse(cache.is_repeat(['main'], 'irc', 'alice', 'hi', message_id='1'))
+        self.assertTrue(cache.is_repeat(['main'], 'irc', 'alice', 'hi again', message_id='1'))
+        self.assertEqual(cache.suppressed['replay'], 1)
+
+    def test_echo(self):
+        cache = FingerprintCache()
+        cache.record_relayed(['main'], '\x02hello\x02 world')
+        # people repeating what was said aren't echoes, but relays and bots are
+        self.assertFalse(cache.is_repeat(['main'], 'discord', 'alice', 'hello world'))
+        self.assertTrue(cache.is_repeat(['main'], 'discord', 'relay', '<bob> hello world'))
+        self.assertTrue(cache.is_repeat(['main'], 'discord', 'bot', 'hello world', from_bot=True))
+        self.assertFalse(cache.is_repeat(['other'], 'discord', 'bot', 'hello world', from_bot=True))
+        self.assertEqual(cache.suppressed['echo'], 2)
+
+    def test_duplicates(self):
+        cache = FingerprintCache()
+        self.assertFalse(cache.is_repeat(['main'], 'irc', 'alice', 'ok'))
+        self.assertFalse(cache.is_repeat(['main'], 'irc', 'alice', 'ok'))
+
+        cache = FingerprintCache(duplicates=True)
+        self.assertFalse(cache.is_repeat(['main'], 'irc', 'alice', 'ok'))
+        self.assertTrue(cache.is_repeat(['main'], 'irc', 'alice', 'OK'))
+        self.assertFalse(cache.is_repeat(['main'], 'irc', 'bob', 'ok'))
+        self.assertEqual(cache.suppressed['duplicate'], 1)
+
+    def test_apply_settings(self):
+        cache = FingerprintCache(maxsize=10, ttl=10.0)
+        for key in 'abcd':
+            cache.add(key)
+        cache.apply_settings(maxsize=2, ttl=60.0, duplicates=True)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.duplicates)
+
+        # entries keep the expiry they were given, new ones get the new ttl
+        cache.add('e')
+        self.now += 30
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.check('e'))
+        self.assertFalse(cache.check('d'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from italib.floodcontrol import IRC_LINE_LENGTH, max_message_bytes, pack_targets, split_message
+
+
+class MaxMessageBytesTest(unittest.TestCase):
+    def test_leaves_room_for_prefix(self):
+        max_bytes = max_message_bytes('ita', 'ita', '#chan')
+        line = ':ita!~ita@{} PRIVMSG #chan :{}\r\n'.format('h' * 63, 'x' * max_bytes)
+        self.assertEqual(len(line), IRC_LINE_LENGTH)
+
+    def test_counts_bytes(self):
+        self.assertEqual(max_message_bytes('ita', 'ita', '#chan') - max_message_bytes('ita', 'ita', '#chän'), 1)
+
+
+class SplitMessageTest(unittest.TestCase):
+    def test_short(self):
+        self.assertEqual(split_message('hello world', 100), ['hello world'])
+
+    def test_words(self):
+        self.assertEqual(split_message('one two three four', 9), ['one two', 'three', 'four'])
+
+    def test_newlines(self):
+        self.assertEqual(split_message('one\r\ntwo\rthree\nfour', 100), ['one', 'two', 'three', 'four'])
+
+    def test_formatting_codes_are_not_newlines(self):
+        text = '\x1ditalic\x1d and \x1estruck\x1e'
+        self.assertEqual(split_message(text, 100), [text])
+
+    def test_blank_lines(self):
+        self.assertEqual(split_message('a\n\n   \nb', 10), ['a', 'b'])
+
+    def test_whitespace_chunks(self):
+        self.assertEqual(split_message('  leading  spaces  ', 8), ['leading ', 'spaces  '])
+        self.assertEqual(split_message('   ', 1), [])
+
+    def test_long_word(self):
+        self.assertEqual(split_message('abcdefghij', 4), ['abcd', 'efgh', 'ij'])
+
+    def test_multibyte(self):
+        lines = split_message('日本語テキスト', 7)
+        self.assertEqual(lines, ['日本', '語テ', 'キス', 'ト'])
+        for line in lines:
+            self.assertLessEqual(len(line.encode('utf-8')), 7)
+
+    def test_smaller_than_a_character(self):
+        self.assertEqual(split_message('日本', 2), ['日', '本'])
+        self.assertEqual(split_message('ab', 0), ['a', 'b'])
+
+
+class PackTargetsTest(unittest.TestCase):
+    def test_one_line(self):
+        self.assertEqual(pack_targets(['#a', '#b', '#c']), ['#a,#b,#c'])
+
+    def test_max_targets(self):
+        self.assertEqual(pack_targets(['#a', '#b', '#c'], max_targets=2), ['#a,#b', '#c'])
+
+    def test_line_length(self):
+        targets = ['#' + 'x' * 99 for _ in range(10)]
+        packed = pack_targets(targets, 'JOIN')
+        self.assertEqual(sum(len(line.split(',')) for line in packed), 10)
+        for line in packed:
+            self.assertLessEqual(len('JOIN {}\r\n'.format(line).encode('utf-8')), IRC_LINE_LENGTH)
+
+    def test_empty(self):
+        self.assertEqual(pack_targets([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+from italib.formatting import (BOLD, COLOUR, ITALIC, RESET, SPOILER, STRIKETHROUGH, UNDERLINE, discord_to_irc,
+                               irc_to_discord, strip_irc_formatting)
+
+
+class IrcToDiscordTest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(irc_to_discord('hello'), 'hello')
+
+    def test_escapes_markdown(self):
+        self.assertEqual(irc_to_discord('a*b_c'), 'a\\*b\\_c')
+
+    def test_defuses_mentions(self):
+        self.assertEqual(irc_to_discord('@everyone @here'), '@\u200beveryone @\u200bhere')
+
+    def test_styles(self):
+        self.assertEqual(irc_to_discord(BOLD + 'bold' + BOLD + ' text'), '**bold** text')
+        self.assertEqual(irc_to_discord(UNDERLINE + 'under' + UNDERLINE), '__under__')
+
+    def test_reset_closes_everything(self):
+        self.assertEqual(irc_to_discord(BOLD + ITALIC + 'both' + RESET + ' plain'), '***both*** plain')
+
+    def test_unclosed_style(self):
+        self.assertEqual(irc_to_discord(BOLD + 'unclosed'), '**unclosed**')
+
+    def test_no_whitespace_inside_markers(self):
+        self.assertEqual(irc_to_discord(BOLD + 'bold ' + BOLD + 'text'), '**bold** text')
+        self.assertEqual(irc_to_discord(BOLD + ' ' + BOLD + 'x'), ' x')
+
+    def test_drops_colours(self):
+        self.assertEqual(irc_to_discord(COLOUR + '04red' + COLOUR + ' text'), 'red text')
+
+    def test_urls_are_not_escaped(self):
+        self.assertEqual(irc_to_discord('see https://example.com/a_b_c ok'), 'see https://example.com/a_b_c ok')
+
+
+class DiscordToIrcTest(unittest.TestCase):
+    names = {('@', '1'): 'alice', ('@&', '2'): 'mods', ('#', '3'): 'general'}
+
+    def test_plain(self):
+        self.assertEqual(discord_to_irc('plain'), 'plain')
+
+    def test_styles(self):
+        self.assertEqual(discord_to_irc('**bold** and *it*'), BOLD + 'bold' + BOLD + ' and ' + ITALIC + 'it' + ITALIC)
+        self.assertEqual(discord_to_irc('__under__ _it_'),
+                         UNDERLINE + 'under' + UNDERLINE + ' ' + ITALIC + 'it' + ITALIC)
+        self.assertEqual(discord_to_irc('~~s~~ ||spoil||'),
+                         STRIKETHROUGH + 's' + STRIKETHROUGH + ' ' + SPOILER + 'spoil' + COLOUR)
+
+    def test_unflanked_markers(self):
+        self.assertEqual(discord_to_irc('5 * 3 * 2'), '5 * 3 * 2')
+        self.assertEqual(discord_to_irc('snake_case_name'), 'snake_case_name')
+
+    def test_unclosed_markers(self):
+        self.assertEqual(discord_to_irc('**unclosed'), '**unclosed')
+
+    def test_code(self):
+        self.assertEqual(discord_to_irc('`**code**`'), '**code**')
+        self.assertEqual(discord_to_irc('```py\nx = **1**```'), 'x = **1**')
+
+    def test_escapes(self):
+        self.assertEqual(discord_to_irc('\\*not\\*'), '*not*')
+
+    def test_mentions(self):
+        self.assertEqual(discord_to_irc('<@1> <@!1> <@&2> <#3> <@9>', self.names),
+                         '@alice @alice @mods #general @deleted-user')
+
+    def test_emoji(self):
+        self.assertEqual(discord_to_irc('<:smile:123> <a:wave:45>'), ':smile: :wave:')
+
+    def test_urls(self):
+        self.assertEqual(discord_to_irc('<https://example.com/a_b>'), 'https://example.com/a_b')
+        self.assertEqual(discord_to_irc('https://example.com/**x**'), 'https://example.com/**x**')
+
+
+class StripIrcFormattingTest(unittest.TestCase):
+    def test_strip(self):
+        self.assertEqual(strip_irc_formatting(BOLD + 'a' + COLOUR + '04,01b' + RESET + 'c'), 'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import unittest
+
+from itabashi.irc import IrcConnection, IrcManager, IrcNetwork
+from italib.events import EventBus
+from italib.presence import PresenceAggregator
+
+
+def config():
+    return {
+        'modules': {
+            'irc': {'nickname': 'ita', 'server': 'irc.example.net', 'relay_presence': True},
+            'discord': {},
+        },
+        'links': {
+            'main': {'channels': {'irc': '#chan', 'discord': '1234'}},
+        },
+    }
+
+
+class IrcPresenceTest(unittest.TestCase):
+    """Real girc lines, through the IRC module and into the storm aggregator."""
+
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        logger = logging.getLogger('itabashi.tests')
+        self.events = EventBus(logger)
+        self.manager = IrcManager(logger, config(), self.events, connect=False)
+        network = self.manager.networks['default'] = IrcNetwork(self.manager, 'default',
+                                                                  config()['modules']['irc'])
+        self.connection = IrcConnection(self.manager, network, 0)
+        network.connections.append(self.connection)
+        self.manager.connections[self.connection.name] = self.connection
+
+        self.published = []
+        self.presence = PresenceAggregator(self.published.append, delay=0.0)
+        self.events.register('irc presence', self.handle_presence)
+
+    def tearDown(self):
+        self.presence.close()
+        self.connection.close()
+
+    def handle_presence(self, event):
+        router = self.manager.router
+        for key in event['channels']:
+            for chan in router.destinations('irc', key, 'discord'):
+                self.presence.add(router.key('discord', chan), event['kind'], event['nick'], event['detail'])
+
+    def receive(self, *lines):
+        for line in lines:
+            self.connection.server.data_received('{}\r\n'.format(line).encode('utf-8'))
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def summary(self):
+        self.assertEqual(len(self.published), 1)
+        return self.published[0].render()
+
+    def test_kick(self):
+        self.receive(':op!o@example.net KICK #chan victim :bye')
+        self.assertEqual(self.summary(), '**Left:** victim')
+
+    def test_kick_after_join(self):
+        self.receive(':victim!v@example.net JOIN #chan', ':op!o@example.net KICK #Chan victim :bye')
+        self.assertEqual(self.summary(), '**Joined and left:** victim')
+        self.assertNotIn('victim', self.connection.members)
+
+    def test_kick_in_unlinked_channel(self):
+        self.receive(':op!o@example.net KICK #other victim :bye')
+        self.assertEqual(self.published, [])
+
+    def test_bridge_kicked(self):
+        self.receive(':victim!v@example.net JOIN #chan', ':op!o@example.net KICK #chan ita :bye')
+        self.assertEqual(self.summary(), '**Joined:** victim')
+        self.assertEqual(self.connection.members, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+from italib.members import MemberDirectory, member_names
+
+
+def member(user_id, username, discriminator='0001', nick=None):
+    return {'user': {'id': user_id, 'username': username, 'discriminator': discriminator}, 'nick': nick}
+
+
+class MemberNamesTest(unittest.TestCase):
+    def test_names(self):
+        self.assertEqual(member_names(member('1', 'Alice')['user'], 'Ally'), ('alice', 'alice#0001', 'ally'))
+
+    def test_spaces(self):
+        self.assertEqual(member_names(member('1', 'Big Bob')['user']),
+                         ('big bob', 'big bob#0001', 'bigbob', 'bigbob#0001'))
+
+
+class MemberDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.members = MemberDirectory()
+        self.members.load('g', [member('1', 'Alice', nick='Ally'), member('2', 'alfred'), member('3', 'Big Bob')])
+
+    def test_find(self):
+        self.assertEqual(self.members.find('g', 'ALICE'), '1')
+        self.assertEqual(self.members.find('g', 'ally'), '1')
+        self.assertEqual(self.members.find('g', 'alice#0001'), '1')
+        self.assertEqual(self.members.find('g', 'bigbob'), '3')
+        self.assertIsNone(self.members.find('g', 'carol'))
+        self.assertIsNone(self.members.find('other', 'alice'))
+        self.assertEqual(len(self.members), 3)
+
+    def test_shared_names(self):
+        self.members.update('g', member('4', 'Carol', nick='ally'))
+        self.assertIsNone(self.members.find('g', 'ally'))
+        self.members.remove('g', '4')
+        self.assertEqual(self.members.find('g', 'ally'), '1')
+
+    def test_update(self):
+        self.members.update('g', member('1', 'Alice', nick='Queen'))
+        self.assertIsNone(self.members.find('g', 'ally'))
+        self.assertEqual(self.members.find('g', 'queen'), '1')
+
+    def test_complete(self):
+        self.assertEqual(self.members.complete('g', 'alf'), '2')
+        self.assertIsNone(self.members.complete('g', 'al'))
+        self.assertEqual(self.members.complete('g', 'ali'), '1')
+        self.members.update('g', member('5', 'Alfie'))
+        self.assertIsNone(self.members.complete('g', 'alf'))
+        self.members.remove('g', '5')
+        self.assertEqual(self.members.complete('g', 'alf'), '2')
+
+    def test_mention(self):
+        self.assertEqual(self.members.mention('g', 'hi @alice, and @alf!'), 'hi <@1>, and <@2>!')
+        self.assertEqual(self.members.mention('g', 'ally: look'), '<@1>: look')
+        self.assertEqual(self.members.mention('g', 'mail me at a@alice or @carol'), 'mail me at a@alice or @carol')
+        self.assertEqual(self.members.mention('g', 'later: ally:'), 'later: ally:')
+        self.assertEqual(self.members.mention('other', '@alice'), '@alice')
+
+    def test_remove_guild(self):
+        self.members.remove_guild('g')
+        self.assertIsNone(self.members.find('g', 'alice'))
+        self.assertEqual(len(self.members), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
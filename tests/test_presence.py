@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+
+from italib.presence import JOIN, NICK, PART, QUIT, PresenceAggregator, Storm, split_servers
+
+
+class SplitServersTest(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_servers('irc.a.net irc.b.net'), ('irc.a.net', 'irc.b.net'))
+        self.assertEqual(split_servers('*.net *.split'), ('*.net', '*.split'))
+
+    def test_not_split(self):
+        self.assertIsNone(split_servers('Quit: bye'))
+        self.assertIsNone(split_servers(None))
+
+
+class StormTest(unittest.TestCase):
+    def storm(self, *changes, max_nicks=10):
+        storm = Storm('#chan', 0.0, max_nicks)
+        for change in changes:
+            storm.add(*change)
+        return storm
+
+    def test_states(self):
+        storm = self.storm((JOIN, 'a'), (PART, 'b'), (QUIT, 'c', 'Quit: bye'), (JOIN, 'd'), (PART, 'd'),
+                           (QUIT, 'e', 'bye'), (JOIN, 'e'))
+        self.assertEqual(storm.render(), '**Joined:** a\n**Rejoined:** e\n**Left:** b\n**Quit:** c\n'
+                                         '**Joined and left:** d')
+
+    def test_nicks_fold_case(self):
+        self.assertEqual(self.storm((QUIT, 'Alice', 'bye'), (JOIN, 'alice')).render(), '**Rejoined:** Alice')
+
+    def test_netsplit(self):
+        storm = self.storm((QUIT, 'a', 'irc.a.net irc.b.net'), (QUIT, 'b', 'irc.a.net irc.b.net'))
+        self.assertEqual(storm.splits, 2)
+        storm.add(JOIN, 'a')
+        self.assertEqual(storm.splits, 1)
+        self.assertEqual(storm.render(), '**Netsplit** between irc.a.net and irc.b.net: 2 lost, 1 back')
+
+    def test_renames(self):
+        storm = self.storm((NICK, 'a', 'b'), (NICK, 'b', 'c'), (NICK, 'x', 'y'), (NICK, 'y', 'x'))
+        self.assertEqual(storm.render(), '**Nick changes:** a → c')
+
+    def test_renamed_entry(self):
+        self.assertEqual(self.storm((JOIN, 'a'), (NICK, 'a', 'b'), (PART, 'b')).render(),
+                         '**Joined and left:** b\n**Nick changes:** a → b')
+
+    def test_max_nicks(self):
+        storm = self.storm((JOIN, 'a'), (JOIN, 'b'), (JOIN, 'c'), max_nicks=2)
+        self.assertEqual(storm.render(), '**Joined:** a, b\n…and 1 more changes')
+
+    def test_names_are_limited_and_escaped(self):
+        storm = self.storm(*[(JOIN, 'n_{}'.format(i)) for i in range(4)])
+        self.assertEqual(storm.render(max_names=2), '**Joined:** n\\_0, n\\_1 and 2 more')
+
+    def test_version(self):
+        storm = self.storm((JOIN, 'a'))
+        storm.render()
+        self.assertEqual(storm.rendered, storm.version)
+        storm.add(PART, 'a')
+        self.assertNotEqual(storm.rendered, storm.version)
+
+
+class PresenceAggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.summaries = []
+        self.presence = PresenceAggregator(self.publish, delay=0.01, interval=0.05, quiet=0.2)
+
+    def tearDown(self):
+        self.presence.close()
+
+    def publish(self, storm):
+        self.summaries.append((storm.key, storm.render()))
+        self.presence.published(storm)
+
+    def wait(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_gathers_changes(self):
+        self.presence.add('#a', JOIN, 'x')
+        self.presence.add('#a', JOIN, 'y')
+        self.presence.add('#b', PART, 'z')
+        self.wait(0.03)
+        self.assertEqual(sorted(self.summaries), [('#a', '**Joined:** x, y'), ('#b', '**Left:** z')])
+
+    def test_updates_summary(self):
+        self.presence.add('#a', JOIN, 'x')
+        self.wait(0.03)
+        storm = self.presence.storms['#a']
+        self.presence.add('#a', PART, 'x')
+        self.presence.add('#a', JOIN, 'y')
+        self.wait(0.01)
+        # updates wait for the interval
+        self.assertEqual(len(self.summaries), 1)
+        self.wait(0.1)
+        self.assertEqual(self.summaries, [('#a', '**Joined:** x'), ('#a', '**Joined:** y\n**Joined and left:** x')])
+        self.assertIs(self.presence.storms['#a'], storm)
+
+    def test_quiet_ends_storm(self):
+        self.presence.add('#a', JOIN, 'x')
+        self.wait(0.3)
+        self.assertEqual(len(self.presence), 0)
+        self.presence.add('#a', PART, 'x')
+        self.wait(0.03)
+        self.assertEqual(self.summaries, [('#a', '**Joined:** x'), ('#a', '**Left:** x')])
+
+    def test_max_storms(self):
+        presence = self.presence = PresenceAggregator(self.publish, delay=0.01, max_storms=2)
+        for key in ('#a', '#b', '#c'):
+            presence.add(key, JOIN, 'x')
+        self.assertEqual(list(presence.storms), ['#b', '#c'])
+        # the storm that was pushed out still publishes what it had
+        self.wait(0.03)
+        self.assertEqual(sorted(key for key, _ in self.summaries), ['#a', '#b', '#c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+from italib.routing import DEFAULT_NETWORK, LinkRouter, irc_casemap_table
+
+
+class CasemapTest(unittest.TestCase):
+    def test_rfc1459(self):
+        self.assertEqual('#Chan[]\\^'.translate(irc_casemap_table('rfc1459')), '#chan{}|~')
+
+    def test_ascii(self):
+        self.assertEqual('#Chan[]'.translate(irc_casemap_table('ascii')), '#chan[]')
+
+    def test_unknown_is_rfc1459(self):
+        self.assertEqual('#[]'.translate(irc_casemap_table('unknown')), '#{}')
+
+
+class LinkRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = LinkRouter({
+            'main': {'channels': {'irc': '#Main', 'discord': '1234'}},
+            'many': {'channels': {'irc': ['#a', '#b'], 'discord': ['1234', 'general']}},
+            'other': {'network': 'other', 'channels': {'irc': '#main', 'discord': '5678'}},
+            'irc only': {'channels': {'irc': '#lonely', 'discord': []}},
+        })
+
+    def test_destinations(self):
+        self.assertEqual(self.router.destinations('irc', '#main', 'discord'), ('1234',))
+        self.assertEqual(self.router.destinations('irc', ('other', '#main'), 'discord'), ('5678',))
+        self.assertEqual(self.router.destinations('irc', '#unlinked', 'discord'), ())
+
+    def test_many_to_many(self):
+        self.assertEqual(self.router.destinations('irc', '#a', 'discord'), ('1234', 'general'))
+        self.assertEqual(set(self.router.destinations('discord', '1234', 'irc')),
+                         {(DEFAULT_NETWORK, '#Main'), (DEFAULT_NETWORK, '#a'), (DEFAULT_NETWORK, '#b')})
+        self.assertEqual(self.router.links_for('discord', '1234'), ('main', 'many'))
+
+    def test_irc_case(self):
+        self.assertTrue(self.router.is_linked('irc', '#MAIN'))
+        self.assertEqual(self.router.key('irc', '#MAIN'), (DEFAULT_NETWORK, '#main'))
+
+    def test_set_casemapping(self):
+        router = LinkRouter({'main': {'channels': {'irc': '#a[b]', 'discord': '1234'}}})
+        self.assertTrue(router.is_linked('irc', '#A{B}'))
+        router.set_casemapping('ascii')
+        self.assertFalse(router.is_linked('irc', '#A{B}'))
+        self.assertTrue(router.is_linked('irc', '#A[B]'))
+
+    def test_set_casemapping_per_network(self):
+        self.router.set_casemapping('ascii', 'other')
+        self.assertEqual(self.router.key('irc', ('other', '#A[]')), ('other', '#a[]'))
+        self.assertEqual(self.router.key('irc', '#A[]'), (DEFAULT_NETWORK, '#a{}'))
+
+    def test_unlinked_channels(self):
+        self.assertFalse(self.router.is_linked('discord', '9999'))
+        self.assertEqual(self.router.destinations('irc', '#lonely', 'discord'), ())
+        self.assertEqual(self.router.links_for('irc', '#unlinked'), ())
+
+    def test_bind_discord_id(self):
+        self.assertEqual(self.router.unbound_discord_names, frozenset(['general']))
+        self.router.bind_discord_id('#General', '4321')
+        self.assertEqual(self.router.unbound_discord_names, frozenset())
+        self.assertEqual(self.router.key('discord', 'general'), '4321')
+        self.assertEqual(self.router.destinations('discord', '4321', 'irc'),
+                         ((DEFAULT_NETWORK, '#a'), (DEFAULT_NETWORK, '#b')))
+
+    def test_update(self):
+        self.router.update({'new': {'channels': {'irc': '#new', 'discord': '1'}}})
+        self.assertFalse(self.router.is_linked('irc', '#main'))
+        self.assertEqual(self.router.destinations('discord', '1', 'irc'), ((DEFAULT_NETWORK, '#new'),))
+        self.assertEqual(self.router.channels, {'irc': ((DEFAULT_NETWORK, '#new'),), 'discord': ('1',)})
+
+
+if __name__ == '__main__':
+    unittest.main()